@@ -1,10 +1,12 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse, PlainTextResponse
-import qrcode
-import io
+from fastapi import BackgroundTasks, FastAPI, Header, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 import base64
 from typing import Optional
 
+from shared.qr_codes import QRImage, qr_cache
+from shared.share_links import render_vless_url
+
 app = FastAPI(title="Xray VPN API", description="API для получения конфигураций VPN")
 
 # Данные сервера
@@ -25,46 +27,67 @@ async def root():
         "endpoints": {
             "config": "/api/config/{user_id}/vless",
             "qr": "/api/config/{user_id}/qr",
+            "qr_png": "/api/config/{user_id}/qr.png",
+            "qr_svg": "/api/config/{user_id}/qr.svg",
             "json": "/api/config/{user_id}/json"
         }
     }
 
+async def get_qr_image_cached(vless_url: str, fmt: str) -> QRImage:
+    """QR код из кэша; рендеринг при промахе уходит в пул потоков"""
+    image = qr_cache.lookup(vless_url, fmt)
+    if image is None:
+        image = await run_in_threadpool(qr_cache.get, vless_url, fmt)
+    return image
+
 @app.get("/api/config/{user_id}/vless")
-async def get_vless_config(user_id: int):
+async def get_vless_config(user_id: int, background_tasks: BackgroundTasks):
     """Получение VLESS конфигурации для пользователя"""
     try:
         vless_url = generate_vless_url(user_id)
+        # QR код почти всегда запрашивают следом за ссылкой
+        background_tasks.add_task(qr_cache.warm, vless_url)
         return PlainTextResponse(vless_url)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/config/{user_id}/qr")
-async def get_qr_code(user_id: int):
+async def get_qr_code(user_id: int, if_none_match: Optional[str] = Header(None)):
     """Получение QR кода для конфигурации"""
     try:
         vless_url = generate_vless_url(user_id)
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(vless_url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Конвертируем в base64
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        img_str = base64.b64encode(buffer.getvalue()).decode()
+        image = await get_qr_image_cached(vless_url, "png")
+        headers = {"ETag": image.etag, "Cache-Control": "private, no-cache"}
+        if image.matches(if_none_match):
+            return Response(status_code=304, headers=headers)
         
+        img_str = base64.b64encode(image.body).decode()
         return JSONResponse({
             "qr_code": f"data:image/png;base64,{img_str}",
             "vless_url": vless_url
-        })
+        }, headers=headers)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/config/{user_id}/qr.{fmt}")
+async def get_qr_image(user_id: int, fmt: str, if_none_match: Optional[str] = Header(None)):
+    """QR код картинкой (png или svg) с поддержкой ETag"""
+    if fmt not in ("png", "svg"):
+        raise HTTPException(status_code=404, detail="Поддерживаются форматы png и svg")
+    try:
+        image = await get_qr_image_cached(generate_vless_url(user_id), fmt)
+        headers = {"ETag": image.etag, "Cache-Control": "private, no-cache"}
+        if image.matches(if_none_match):
+            return Response(status_code=304, headers=headers)
+        return Response(content=image.body, media_type=image.media_type, headers=headers)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/config/{user_id}/json")
-async def get_json_config(user_id: int):
+async def get_json_config(user_id: int, background_tasks: BackgroundTasks):
     """Получение JSON конфигурации"""
     try:
+        background_tasks.add_task(qr_cache.warm, generate_vless_url(user_id))
         config = {
             "v": "2",
             "ps": f"XrayVPN-{user_id}",
@@ -92,13 +115,20 @@ async def get_json_config(user_id: int):
 def generate_vless_url(user_id: int) -> str:
     """Генерация VLESS URL для пользователя"""
     config = SERVER_CONFIG
-    vless_url = f"vless://{config['uuid']}@{config['ip']}:{config['port']}?encryption=none&security=reality&sni={config['server_name']}&pbk={config['public_key']}&fp=chrome&type=tcp&headerType=none&flow=#XrayVPN-{user_id}"
-    return vless_url
+    return render_vless_url(
+        "default",
+        host=config["ip"],
+        port=config["port"],
+        public_key=config["public_key"],
+        sni=config["server_name"],
+        client_id=config["uuid"],
+        remark=f"XrayVPN-{user_id}"
+    )
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "service": "xray-vpn-api"}
+    return {"status": "healthy", "service": "xray-vpn-api", "qr_cache": qr_cache.stats()}
 
 if __name__ == "__main__":
     import uvicorn
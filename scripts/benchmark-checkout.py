@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Нагрузочная проверка создания платежей через YooKassaClient.
+
+Создает платежи с заданной параллельностью против фейковой YooKassa
+(scripts/fake-yookassa.py) или другого совместимого API и печатает
+пропускную способность, задержки и число ошибок. Ключ идемпотентности
+каждого платежа уникален, повторы клиента его переиспользуют.
+
+Запуск:
+    python scripts/fake-yookassa.py --latency 50 --error-rate 0.02 &
+    python scripts/benchmark-checkout.py --payments 5000 --concurrency 200
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "services", "payment-service"
+))
+
+from app.services.yookassa_client import YooKassaClient, YooKassaError  # noqa: E402
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(args):
+    client = YooKassaClient(
+        args.shop_id, args.secret_key, base_url=args.url,
+        max_connections=args.concurrency, timeout=args.timeout
+    )
+    queue = asyncio.Queue()
+    for index in range(args.payments):
+        queue.put_nowait(index)
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            index = queue.get_nowait()
+            payment_id = f"yk_{uuid.uuid4().hex[:16]}"
+            started = time.perf_counter()
+            try:
+                await client.create_payment({
+                    "amount": {"value": "299.00", "currency": "RUB"},
+                    "capture": True,
+                    "confirmation": {"type": "redirect", "return_url": "https://example.com/success"},
+                    "description": f"Бенчмарк {index}",
+                    "metadata": {"payment_id": payment_id, "user_id": str(index)}
+                }, idempotence_key=payment_id)
+                latencies.append(time.perf_counter() - started)
+            except YooKassaError:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    await client.close()
+
+    print(f"платежей: {len(latencies)}, ошибок: {errors}, время: {elapsed:.2f}с")
+    print(f"пропускная способность: {len(latencies) / elapsed:.0f} платежей/с")
+    print(
+        f"задержка: p50 {percentile(latencies, 0.5) * 1000:.1f} мс, "
+        f"p99 {percentile(latencies, 0.99) * 1000:.1f} мс, "
+        f"max {max(latencies, default=0) * 1000:.1f} мс"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк создания платежей YooKassa")
+    parser.add_argument("--url", default="http://127.0.0.1:8099/v3")
+    parser.add_argument("--shop-id", default="123456")
+    parser.add_argument("--secret-key", default="test_secret")
+    parser.add_argument("--payments", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Симуляция размещения пользователей по серверам Xray.
+
+Проигрывает поток назначений (по умолчанию 100k) для каждой стратегии
+PlacementEngine. Счетчики connection_count обновляются только раз в
+--refresh-every назначений, как при реальной телеметрии, поэтому видно,
+как стратегии ведут себя на устаревших данных (thundering herd).
+
+Запуск:
+    python scripts/benchmark-placement.py --assignments 100000 --servers 50
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "services", "xray-manager"
+))
+os.environ.setdefault("ENVIRONMENT", "development")
+
+from app.services.placement import STRATEGIES, PlacementEngine  # noqa: E402
+from app.services.server_registry import ServerRecord, ServerRegistry  # noqa: E402
+
+# Стоимость одного подключения в процентах CPU и памяти узла
+CPU_PER_CONNECTION = 0.02
+MEMORY_PER_CONNECTION = 0.015
+
+
+def build_registry(servers: int, seed: int) -> ServerRegistry:
+    """Парк серверов со случайной стартовой нагрузкой"""
+    rng = random.Random(seed)
+    registry = ServerRegistry()
+    for index in range(servers):
+        connections = rng.randint(0, 300)
+        registry.upsert(ServerRecord(
+            id=index + 1,
+            server_id=f"server-{index + 1}",
+            name=f"bench-{index + 1}",
+            host=f"10.0.0.{index + 1}",
+            port=443,
+            uuid="00000000-0000-0000-0000-000000000000",
+            reality_public_key="pbk",
+            reality_short_id="sid",
+            cpu_usage=5 + connections * CPU_PER_CONNECTION,
+            memory_usage=10 + connections * MEMORY_PER_CONNECTION,
+            connection_count=connections
+        ))
+    return registry
+
+
+def simulate(name: str, args, track_pending: bool = True) -> dict:
+    registry = build_registry(args.servers, args.seed)
+    strategy = STRATEGIES[name]()
+    if hasattr(strategy, "rng"):
+        strategy.rng.seed(args.seed)
+    engine = PlacementEngine(registry, strategy)
+
+    actual = {record.server_id: record.connection_count for record in registry}
+    window = {}
+    worst_window_skew = 0.0
+    started = time.perf_counter()
+
+    for step in range(1, args.assignments + 1):
+        record = engine.reserve(user_id=step)
+        actual[record.server_id] += 1
+        window[record.server_id] = window.get(record.server_id, 0) + 1
+        if not track_pending:
+            # Старое поведение: выбор только по устаревшему connection_count
+            registry.update(record.server_id, pending=0)
+
+        if step % args.refresh_every == 0:
+            fair_share = args.refresh_every / args.servers
+            worst_window_skew = max(worst_window_skew, max(window.values()) / fair_share)
+            window.clear()
+            for server_id, count in actual.items():
+                engine.counters_refreshed(
+                    server_id,
+                    count,
+                    cpu_usage=5 + count * CPU_PER_CONNECTION,
+                    memory_usage=10 + count * MEMORY_PER_CONNECTION
+                )
+
+    elapsed = time.perf_counter() - started
+    counts = list(actual.values())
+    mean = sum(counts) / len(counts)
+    variance = sum((count - mean) ** 2 for count in counts) / len(counts)
+    return {
+        "strategy": name if track_pending else f"{name} (без pending)",
+        "max_to_mean": max(counts) / mean,
+        "cv": variance ** 0.5 / mean,
+        "window_skew": worst_window_skew,
+        "rate": args.assignments / elapsed
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Симуляция стратегий размещения")
+    parser.add_argument("--assignments", type=int, default=100_000)
+    parser.add_argument("--servers", type=int, default=50)
+    parser.add_argument("--refresh-every", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    results = [simulate("least_load", args, track_pending=False)]
+    results += [simulate(name, args) for name in STRATEGIES]
+
+    print(f"{args.assignments} назначений, {args.servers} серверов, "
+          f"обновление счетчиков каждые {args.refresh_every}")
+    print(f"{'стратегия':<28}{'max/mean':>10}{'CV':>8}{'skew окна':>11}{'назн./с':>12}")
+    for result in results:
+        print(
+            f"{result['strategy']:<28}{result['max_to_mean']:>10.3f}{result['cv']:>8.3f}"
+            f"{result['window_skew']:>11.1f}{result['rate']:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк генерации VLESS ссылок.
+
+Сравнивает прежнюю сборку ссылки f-строками (без экранирования),
+корректную сборку через urlencode на каждый вызов и предкомпилированные
+шаблоны shared.share_links, а также проверяет, что спецсимволы в
+названии профиля и ключах переживают разбор URL.
+
+Запуск:
+    python scripts/benchmark-share-links.py --links 200000 --servers 50
+"""
+
+import argparse
+import os
+import sys
+import time
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.share_links import ShareLinkRenderer  # noqa: E402
+
+SNI_DOMAINS = ["vk.com", "yandex.ru", "sberbank.ru", "mail.ru"]
+
+
+def build_servers(count: int):
+    return [
+        {
+            "server_id": f"server-{index}",
+            "host": f"10.0.{index // 250}.{index % 250 + 1}",
+            "port": 443,
+            "public_key": f"-TL01QWTd3nVXR4qdfnAea5JgUcEzwa_qvpw9KG+{index}",
+            "short_id": f"{index:08x}"
+        }
+        for index in range(count)
+    ]
+
+
+def legacy_url(server, sni, client_id, remark) -> str:
+    """Прежняя реализация из xray_service"""
+    config_str = f"vless://{client_id}@{server['host']}:{server['port']}"
+    config_str += "?encryption=none&security=reality"
+    config_str += f"&type=tcp&host={sni}"
+    config_str += f"&sni={sni}&pbk={server['public_key']}"
+    config_str += f"&sid={server['short_id']}&fp=chrome"
+    config_str += f"#{remark}"
+    return config_str
+
+
+def encoded_url(server, sni, client_id, remark) -> str:
+    """Корректное экранирование без шаблонов: urlencode на каждый вызов"""
+    query = urlencode({
+        "encryption": "none",
+        "security": "reality",
+        "type": "tcp",
+        "headerType": "none",
+        "sni": sni,
+        "fp": "chrome",
+        "pbk": server["public_key"],
+        "sid": server["short_id"]
+    }, quote_via=quote)
+    return (
+        f"vless://{quote(client_id)}@{server['host']}:{server['port']}"
+        f"?{query}#{quote(remark)}"
+    )
+
+
+def run(name, render, servers, links):
+    started = time.perf_counter()
+    for step in range(links):
+        server = servers[step % len(servers)]
+        sni = SNI_DOMAINS[step % len(SNI_DOMAINS)]
+        render(server, sni, "2227fcce-08c2-473f-87a1-4d9595972646", f"XrayVPN-{step}")
+    elapsed = time.perf_counter() - started
+    print(f"{name:<24}{links / elapsed:>14.0f} ссылок/с{elapsed / links * 1e6:>10.2f} мкс")
+
+
+def check_encoding(renderer: ShareLinkRenderer):
+    """Ключ с '+' и название с пробелом и '#' должны пережить разбор URL"""
+    server = build_servers(1)[0]
+    url = renderer.render(
+        server["server_id"], server["host"], server["port"], server["public_key"],
+        "vk.com", "2227fcce-08c2-473f-87a1-4d9595972646", "Мой VPN #1",
+        short_id=server["short_id"]
+    )
+    parts = urlsplit(url)
+    query = parse_qs(parts.query)
+    assert query["pbk"] == [server["public_key"]], query["pbk"]
+    assert unquote(parts.fragment) == "Мой VPN #1", parts.fragment
+    print(f"Экранирование: OK ({url[:60]}...)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк генерации VLESS ссылок")
+    parser.add_argument("--links", type=int, default=200_000)
+    parser.add_argument("--servers", type=int, default=50)
+    args = parser.parse_args()
+
+    servers = build_servers(args.servers)
+    renderer = ShareLinkRenderer()
+
+    def templated(server, sni, client_id, remark):
+        return renderer.render(
+            server["server_id"], server["host"], server["port"], server["public_key"],
+            sni, client_id, remark, short_id=server["short_id"]
+        )
+
+    print(f"{args.links} ссылок, {args.servers} серверов, {len(SNI_DOMAINS)} SNI")
+    run("f-строки (без экран.)", legacy_url, servers, args.links)
+    run("urlencode на вызов", encoded_url, servers, args.links)
+    run("шаблоны", templated, servers, args.links)
+    print(f"Кэш шаблонов: {renderer.stats()}")
+    check_encoding(renderer)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк проверки подписи webhook.
+
+Сравнивает прежнюю проверку (повторная сериализация разобранного тела
+json.dumps(sort_keys=True) и новый hmac на каждый вызов) с проверкой
+WebhookVerifier по сырым байтам с заранее подготовленным ключом, в том
+числе при нескольких действующих секретах, когда подходит последний.
+
+Запуск:
+    python scripts/benchmark-webhook-signature.py --events 200000
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "services", "payment-service"
+))
+
+from app.services.webhook_signature import WebhookVerifier  # noqa: E402
+
+SECRET = "whsec_current_4f1c2b"
+OLD_SECRETS = ["whsec_previous_9a0d", "whsec_oldest_77e3"]
+
+
+def build_body(index: int) -> bytes:
+    """Уведомление payment.succeeded в формате YooKassa"""
+    payment_id = f"2d{index:030x}"[:36]
+    return json.dumps({
+        "type": "notification",
+        "event": "payment.succeeded",
+        "object": {
+            "id": payment_id,
+            "status": "succeeded",
+            "paid": True,
+            "amount": {"value": "299.00", "currency": "RUB"},
+            "income_amount": {"value": "288.54", "currency": "RUB"},
+            "authorization_details": {"rrn": "603668680243", "auth_code": "000000"},
+            "captured_at": "2024-01-01T12:00:05.000Z",
+            "created_at": "2024-01-01T12:00:00.000Z",
+            "description": f"Подписка на сервис, заказ {index}",
+            "metadata": {"user_id": str(index), "payment_id": f"yk_{index:016x}", "service": "xray_subscription"},
+            "payment_method": {"type": "bank_card", "id": payment_id, "saved": False,
+                               "card": {"first6": "555555", "last4": "4444", "expiry_month": "12",
+                                        "expiry_year": "2030", "card_type": "MasterCard"}},
+            "recipient": {"account_id": "100500", "gateway_id": "100700"},
+            "refundable": True,
+            "test": False
+        }
+    }, ensure_ascii=False).encode()
+
+
+def legacy_verify(payload: dict, signature: str) -> bool:
+    """Прежняя реализация из YooKassaService"""
+    expected = hmac.new(
+        SECRET.encode(),
+        json.dumps(payload, sort_keys=True).encode(),
+        hashlib.sha256
+    ).hexdigest()
+    return hmac.compare_digest(signature, expected)
+
+
+def bench(name: str, func, items, events: int):
+    started = time.perf_counter()
+    ok = 0
+    for index in range(events):
+        ok += func(*items[index % len(items)]) is not False
+    elapsed = time.perf_counter() - started
+    print(f"{name:<44} {events / elapsed:>12,.0f} проверок/с  {elapsed / events * 1e6:6.2f} мкс")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк проверки подписи webhook")
+    parser.add_argument("--events", type=int, default=200_000)
+    parser.add_argument("--distinct", type=int, default=1000)
+    args = parser.parse_args()
+
+    bodies = [build_body(index) for index in range(args.distinct)]
+    raw = [(body, hmac.new(SECRET.encode(), body, hashlib.sha256).hexdigest()) for body in bodies]
+    print(f"тело уведомления: {len(bodies[0])} байт")
+
+    # Прежняя схема: тело уже разобрано, подпись от sort_keys сериализации
+    parsed = []
+    for body in bodies:
+        payload = json.loads(body)
+        parsed.append((payload, hmac.new(SECRET.encode(), json.dumps(payload, sort_keys=True).encode(),
+                                         hashlib.sha256).hexdigest()))
+
+    single = WebhookVerifier([SECRET])
+    rotation = WebhookVerifier(OLD_SECRETS + [SECRET])
+
+    bench("json.dumps(sort_keys) + hmac.new", legacy_verify, parsed, args.events)
+    bench("сырые байты + hmac.new", lambda body, signature: hmac.compare_digest(
+        hmac.new(SECRET.encode(), body, hashlib.sha256).hexdigest(), signature), raw, args.events)
+    assert bench("WebhookVerifier, 1 секрет", single.verify, raw, args.events) == args.events
+    assert bench("WebhookVerifier, 3 секрета, подходит последний", rotation.verify, raw, args.events) == args.events
+    assert single.verify(raw[0][0] + b" ", raw[0][1]) is None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Фейковый узел Xray для офлайн проверки сборщика телеметрии.
+
+Поднимает gRPC StatsService (QueryStats) со счетчиками трафика, которые
+растут при каждом запросе, HandlerService (AlterInbound add/remove user)
+для синхронизации клиентов и HTTP node agent с синтетическими CPU,
+памятью, соединениями и сетью. Несколько узлов запускаются на разных
+loopback адресах (127.0.0.2, 127.0.0.3, ...) с одинаковыми портами.
+
+Запуск:
+    python scripts/fake-xray-stats.py --host 127.0.0.2 --users 500 \\
+        --email config-0123456789abcdef
+
+xray-manager:
+    XRAY_STATS_PORT=10085 NODE_AGENT_PORT=9100
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+
+import grpc
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "services", "xray-manager"
+))
+
+from app.utils.xray_proto import (  # noqa: E402
+    decode_alter_inbound_request,
+    decode_query_stats_request,
+    encode_query_stats_response
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class FakeNode:
+    """Синтетическое состояние узла"""
+
+    def __init__(self, emails, seed):
+        self.rng = random.Random(seed)
+        self.clients = {}
+        self.counters = {}
+        for email in emails:
+            self.add_user(email, f"fake-{email}")
+        self.cpu_total = 0
+        self.cpu_idle = 0
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.connections = self.rng.randint(50, 400)
+
+    def add_user(self, email, client_id):
+        if email in self.clients:
+            return False
+        self.clients[email] = client_id
+        for direction in ("uplink", "downlink"):
+            self.counters.setdefault(f"user>>>{email}>>>traffic>>>{direction}", 0)
+        return True
+
+    def remove_user(self, email):
+        if self.clients.pop(email, None) is None:
+            return False
+        for direction in ("uplink", "downlink"):
+            self.counters.pop(f"user>>>{email}>>>traffic>>>{direction}", None)
+        return True
+
+    def query_stats(self, pattern, reset):
+        stats = []
+        for name in self.counters:
+            if not name.startswith(pattern):
+                continue
+            self.counters[name] += self.rng.randint(0, 5_000_000)
+            stats.append((name, self.counters[name]))
+            if reset:
+                self.counters[name] = 0
+        return stats
+
+    def agent_metrics(self):
+        busy = self.rng.randint(5, 90)
+        self.cpu_total += 1000
+        self.cpu_idle += 1000 - busy * 10
+        self.rx_bytes += self.rng.randint(10**6, 10**8)
+        self.tx_bytes += self.rng.randint(10**6, 10**8)
+        self.connections = max(0, self.connections + self.rng.randint(-20, 20))
+        return {
+            "cpu_total": self.cpu_total,
+            "cpu_idle": self.cpu_idle,
+            "memory_usage": round(self.rng.uniform(20, 80), 2),
+            "disk_usage": round(self.rng.uniform(10, 60), 2),
+            "connections": self.connections,
+            "rx_bytes": self.rx_bytes,
+            "tx_bytes": self.tx_bytes
+        }
+
+
+def stats_handler(node):
+    async def query_stats(request, context):
+        pattern, reset = decode_query_stats_request(request)
+        return encode_query_stats_response(node.query_stats(pattern, reset))
+
+    # Без сериализаторов обработчик получает и возвращает байты
+    return grpc.method_handlers_generic_handler(
+        "xray.app.stats.command.StatsService",
+        {"QueryStats": grpc.unary_unary_rpc_method_handler(query_stats)}
+    )
+
+
+def handler_service(node):
+    async def alter_inbound(request, context):
+        _, operation, email, client_id = decode_alter_inbound_request(request)
+        # Тексты ошибок как у Xray: менеджер считает их уже примененными
+        if operation == "add" and not node.add_user(email, client_id):
+            await context.abort(grpc.StatusCode.UNKNOWN, f"User {email} already exists.")
+        if operation == "remove" and not node.remove_user(email):
+            await context.abort(grpc.StatusCode.UNKNOWN, f"User {email} not found.")
+        return b""
+
+    return grpc.method_handlers_generic_handler(
+        "xray.app.proxyman.command.HandlerService",
+        {"AlterInbound": grpc.unary_unary_rpc_method_handler(alter_inbound)}
+    )
+
+
+async def serve(args):
+    emails = list(args.email) + [f"config-fake{index:011d}" for index in range(args.users)]
+    node = FakeNode(emails, args.seed)
+
+    server = grpc.aio.server()
+    server.add_generic_rpc_handlers((stats_handler(node), handler_service(node)))
+    server.add_insecure_port(f"{args.host}:{args.stats_port}")
+    await server.start()
+
+    app = web.Application()
+
+    async def metrics(request):
+        return web.json_response(node.agent_metrics())
+
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.agent_port).start()
+
+    logger.info(
+        f"Фейковый узел {args.host}: StatsService :{args.stats_port}, "
+        f"агент :{args.agent_port}, {len(emails)} клиентов"
+    )
+    try:
+        await server.wait_for_termination()
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый Xray StatsService и node agent")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--stats-port", type=int, default=10085)
+    parser.add_argument("--agent-port", type=int, default=9100)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--email", action="append", default=[],
+                        help="email клиента (config_id), можно несколько раз")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        logger.info("Остановка фейкового узла")
+
+
+if __name__ == "__main__":
+    main()
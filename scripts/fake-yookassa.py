@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Фейковый API YooKassa для нагрузочной проверки оформления оплаты.
+
+Реализует POST /v3/payments, GET /v3/payments/{id} и
+POST /v3/payments/{id}/cancel с Basic авторизацией и обязательным
+Idempotence-Key: повтор с тем же ключом возвращает тот же платеж.
+Задержка ответа и доля ошибок 500/429 настраиваются, чтобы проверить
+повторы клиента. С --notify-url после создания платежа отправляется
+уведомление payment.succeeded, как это делает YooKassa.
+
+Запуск:
+    python scripts/fake-yookassa.py --port 8099 --latency 50 --error-rate 0.02
+
+payment-service:
+    YOOKASSA_API_URL=http://127.0.0.1:8099/v3
+"""
+
+import argparse
+import asyncio
+import base64
+import logging
+import random
+import uuid
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class FakeYooKassa:
+    """Платежи и ключи идемпотентности в памяти"""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.payments = {}
+        self.idempotence = {}
+        self.requests = 0
+        self.errors = 0
+        self.session = None
+
+    def _authorized(self, request) -> bool:
+        header = request.headers.get("Authorization", "")
+        if not header.startswith("Basic "):
+            return False
+        shop_id, _, _ = base64.b64decode(header[6:]).decode().partition(":")
+        return not self.args.shop_id or shop_id == self.args.shop_id
+
+    async def _delay(self):
+        if self.args.latency:
+            await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.args.latency / 1000)
+
+    def _fail(self):
+        """Случайная ошибка для проверки повторов клиента"""
+        if self.rng.random() >= self.args.error_rate:
+            return None
+        self.errors += 1
+        if self.rng.random() < 0.5:
+            return web.json_response(
+                {"type": "error", "code": "too_many_requests"}, status=429, headers={"Retry-After": "0.05"}
+            )
+        return web.json_response({"type": "error", "code": "internal_server_error"}, status=500)
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.requests += 1
+        if not self._authorized(request):
+            return web.json_response({"type": "error", "code": "invalid_credentials"}, status=401)
+        await self._delay()
+
+        if request.method != "POST":
+            return await handler(request)
+
+        key = request.headers.get("Idempotence-Key")
+        if not key:
+            return web.json_response(
+                {"type": "error", "code": "invalid_request", "description": "Idempotence-Key required"},
+                status=400
+            )
+        failure = self._fail()
+        if failure is not None:
+            return failure
+        cached = self.idempotence.get((request.path, key))
+        if cached is not None:
+            return web.json_response(cached)
+        response = await handler(request)
+        if response.status < 400:
+            self.idempotence[(request.path, key)] = self.payments[response.payment_id]
+        return response
+
+    async def create_payment(self, request):
+        data = await request.json()
+        payment_id = str(uuid.uuid4())
+        payment = {
+            "id": payment_id,
+            "status": "pending",
+            "paid": False,
+            "amount": data["amount"],
+            "description": data.get("description", ""),
+            "metadata": data.get("metadata", {}),
+            "recipient": {"account_id": self.args.shop_id or "000000", "gateway_id": "000000"},
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "confirmation": {
+                "type": "redirect",
+                "confirmation_url": f"http://{request.host}/checkout/{payment_id}",
+                "return_url": data.get("confirmation", {}).get("return_url", "")
+            },
+            "test": True,
+            "refundable": False
+        }
+        self.payments[payment_id] = payment
+        if self.args.notify_url:
+            asyncio.create_task(self._notify(payment_id))
+
+        response = web.json_response(payment)
+        response.payment_id = payment_id
+        return response
+
+    async def get_payment(self, request):
+        payment = self.payments.get(request.match_info["payment_id"])
+        if payment is None:
+            return web.json_response({"type": "error", "code": "not_found"}, status=404)
+        return web.json_response(payment)
+
+    async def cancel_payment(self, request):
+        payment_id = request.match_info["payment_id"]
+        payment = self.payments.get(payment_id)
+        if payment is None:
+            return web.json_response({"type": "error", "code": "not_found"}, status=404)
+        if payment["status"] == "succeeded":
+            return web.json_response({"type": "error", "code": "invalid_request"}, status=400)
+        payment["status"] = "canceled"
+        response = web.json_response(payment)
+        response.payment_id = payment_id
+        return response
+
+    async def _notify(self, payment_id: str):
+        """Уведомление payment.succeeded после имитации оплаты"""
+        await asyncio.sleep(self.args.notify_delay)
+        payment = self.payments[payment_id]
+        if payment["status"] != "pending":
+            return
+        payment.update(status="succeeded", paid=True, captured_at=datetime.now(timezone.utc).isoformat())
+        notification = {"type": "notification", "event": "payment.succeeded", "object": payment}
+        try:
+            async with self.session.post(self.args.notify_url, json=notification) as response:
+                if response.status >= 400:
+                    logger.warning(f"Уведомление {payment_id}: HTTP {response.status}")
+        except aiohttp.ClientError as e:
+            logger.warning(f"Уведомление {payment_id} не доставлено: {e}")
+
+    async def stats(self, request):
+        return web.json_response({
+            "payments": len(self.payments),
+            "requests": self.requests,
+            "injected_errors": self.errors
+        })
+
+
+async def serve(args):
+    fake = FakeYooKassa(args)
+    fake.session = aiohttp.ClientSession()
+    app = web.Application(middlewares=[fake.middleware])
+    app.router.add_post("/v3/payments", fake.create_payment)
+    app.router.add_get("/v3/payments/{payment_id}", fake.get_payment)
+    app.router.add_post("/v3/payments/{payment_id}/cancel", fake.cancel_payment)
+    app.router.add_get("/stats", fake.stats)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    logger.info(f"Фейковая YooKassa: http://{args.host}:{args.port}/v3")
+    try:
+        await asyncio.Future()
+    finally:
+        await fake.session.close()
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый API YooKassa")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--shop-id", default="", help="Проверять shopId (по умолчанию любой)")
+    parser.add_argument("--latency", type=float, default=50, help="Средняя задержка ответа, мс")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 429/500 на POST")
+    parser.add_argument("--notify-url", default="", help="URL webhook payment-service")
+    parser.add_argument("--notify-delay", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,13 @@ import logging
 import sys
 import os
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.xray_config import generate_server_config  # noqa: E402
+
+# Порт gRPC API узла (HandlerService/StatsService), XRAY_STATS_PORT xray-manager
+API_PORT = int(os.getenv("XRAY_STATS_PORT", "10085"))
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -64,93 +71,6 @@ def generate_reality_keys():
         logger.error(f"Ошибка генерации ключей: {e}")
         return None
 
-def generate_server_config(server_id, host, port, keys):
-    """Генерация конфигурации сервера"""
-    config = {
-        "log": {
-            "loglevel": "info",
-            "access": "/var/log/xray/access.log",
-            "error": "/var/log/xray/error.log"
-        },
-        "inbounds": [
-            {
-                "port": port,
-                "protocol": "vless",
-                "settings": {
-                    "clients": [
-                        {
-                            "id": str(uuid.uuid4()),
-                            "level": 0
-                        }
-                    ],
-                    "decryption": "none"
-                },
-                "streamSettings": {
-                    "network": "tcp",
-                    "security": "reality",
-                    "realitySettings": {
-                        "show": False,
-                        "dest": "www.vk.com:443",
-                        "xver": 0,
-                        "serverNames": [
-                            "www.vk.com",
-                            "vk.com"
-                        ],
-                        "privateKey": keys['private_key'],
-                        "shortIds": [
-                            keys['short_id']
-                        ]
-                    }
-                }
-            }
-        ],
-        "outbounds": [
-            {
-                "protocol": "freedom",
-                "settings": {}
-            },
-            {
-                "protocol": "blackhole",
-                "settings": {},
-                "tag": "blocked"
-            }
-        ],
-        "routing": {
-            "rules": [
-                {
-                    "type": "field",
-                    "ip": [
-                        "0.0.0.0/8",
-                        "10.0.0.0/8",
-                        "100.64.0.0/10",
-                        "127.0.0.0/8",
-                        "169.254.0.0/16",
-                        "172.16.0.0/12",
-                        "192.0.0.0/24",
-                        "192.0.2.0/24",
-                        "192.168.0.0/16",
-                        "198.18.0.0/15",
-                        "198.51.100.0/24",
-                        "203.0.113.0/24",
-                        "::1/128",
-                        "fc00::/7",
-                        "fe80::/10"
-                    ],
-                    "outboundTag": "blocked"
-                },
-                {
-                    "type": "field",
-                    "outboundTag": "blocked",
-                    "protocol": [
-                        "bittorrent"
-                    ]
-                }
-            ]
-        }
-    }
-    
-    return config
-
 def save_config(config, filename):
     """Сохранение конфигурации в файл"""
     try:
@@ -187,7 +107,8 @@ def main():
             server['id'], 
             server['host'], 
             server['port'], 
-            keys
+            keys,
+            api_port=API_PORT
         )
         
         filename = f"xray/{server['id']}.json"
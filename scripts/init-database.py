@@ -134,11 +134,43 @@ def create_indexes():
                 ON servers(status);
             """))
             
+            # Статус обязателен: строки с NULL выпадали из keyset пагинации
+            conn.execute(text("""
+                UPDATE servers SET status = 'active' WHERE status IS NULL;
+                ALTER TABLE servers ALTER COLUMN status SET DEFAULT 'active';
+                ALTER TABLE servers ALTER COLUMN status SET NOT NULL;
+            """))
+            
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_servers_status_id 
+                ON servers(status, id);
+            """))
+            
+            conn.execute(text("""
+                CREATE UNIQUE INDEX IF NOT EXISTS uq_servers_host_port 
+                ON servers(host, port);
+            """))
+            
             conn.execute(text("""
                 CREATE INDEX IF NOT EXISTS idx_servers_is_healthy 
                 ON servers(is_healthy);
             """))
             
+            # Собственный UUID клиента конфигурации на узле
+            conn.execute(text("""
+                ALTER TABLE configs ADD COLUMN IF NOT EXISTS client_uuid VARCHAR(36);
+            """))
+            
+            # Учет трафика: квота конфигурации и 64-битные счетчики байт
+            # (в 32-битном INTEGER счетчик переполнялся на 2 ГиБ)
+            conn.execute(text("""
+                ALTER TABLE configs ADD COLUMN IF NOT EXISTS traffic_limit BIGINT;
+                ALTER TABLE configs ALTER COLUMN bytes_uploaded TYPE BIGINT;
+                ALTER TABLE configs ALTER COLUMN bytes_downloaded TYPE BIGINT;
+                ALTER TABLE config_usage ALTER COLUMN bytes_uploaded TYPE BIGINT;
+                ALTER TABLE config_usage ALTER COLUMN bytes_downloaded TYPE BIGINT;
+            """))
+            
             # Индексы для таблицы configs
             conn.execute(text("""
                 CREATE INDEX IF NOT EXISTS idx_configs_user_id 
@@ -160,6 +192,11 @@ def create_indexes():
                 ON configs(expires_at);
             """))
             
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_configs_status_expires_at 
+                ON configs(status, expires_at);
+            """))
+            
             # Индексы для таблицы payments
             conn.execute(text("""
                 CREATE INDEX IF NOT EXISTS idx_payments_user_id 
@@ -192,6 +229,23 @@ def create_indexes():
                 ON subscriptions(end_date);
             """))
             
+            # Индексы для метрик серверов
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_server_metrics_server_timestamp 
+                ON server_metrics(server_id, timestamp);
+            """))
+            
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_server_metrics_rollup_tier_bucket 
+                ON server_metrics_rollup(tier, bucket);
+            """))
+            
+            # Часовые корзины трафика конфигураций
+            conn.execute(text("""
+                CREATE UNIQUE INDEX IF NOT EXISTS uq_config_usage_config_hour 
+                ON config_usage(config_id, timestamp);
+            """))
+            
             conn.commit()
             
         logger.info("Индексы созданы успешно")
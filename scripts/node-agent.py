@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Легкий агент метрик узла Xray для сборщика телеметрии xray-manager.
+
+Отдает GET /metrics в JSON: кумулятивные счетчики CPU и сети (скорости
+считает сборщик по разнице, поэтому агент не хранит состояние), загрузку
+памяти и диска в процентах и число установленных TCP соединений на порту
+Xray. Читает только /proc, без сторонних зависимостей.
+
+PUT /config принимает полный config.json от синхронизации клиентов
+xray-manager (для узлов без HandlerService): файл атомарно заменяется по
+пути --xray-config и выполняется --reload-command. Без --xray-config
+доставка отключена (404); с ним обязателен --token, иначе агент не
+запустится.
+
+Запуск на узле:
+    python3 node-agent.py --port 9100 --xray-port 443 --token $NODE_AGENT_TOKEN \
+        --xray-config /etc/xray/config.json --reload-command "systemctl restart xray"
+"""
+
+import argparse
+import hmac
+import json
+import logging
+import os
+import shlex
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Состояние ESTABLISHED в /proc/net/tcp
+TCP_ESTABLISHED = "01"
+# Предел размера принимаемого config.json
+MAX_CONFIG_SIZE = 64 * 1024 * 1024
+
+
+def read_cpu():
+    """Суммарные и простаивающие jiffies всех ядер"""
+    with open("/proc/stat") as f:
+        values = [int(value) for value in f.readline().split()[1:]]
+    idle = values[3] + (values[4] if len(values) > 4 else 0)
+    return sum(values), idle
+
+
+def read_memory_usage():
+    info = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            name, value = line.split(":", 1)
+            info[name] = int(value.split()[0])
+    total = info.get("MemTotal", 0)
+    available = info.get("MemAvailable", info.get("MemFree", 0))
+    return round(100.0 * (total - available) / total, 2) if total else 0.0
+
+
+def read_disk_usage(path):
+    stat = os.statvfs(path)
+    total = stat.f_blocks * stat.f_frsize
+    free = stat.f_bavail * stat.f_frsize
+    return round(100.0 * (total - free) / total, 2) if total else 0.0
+
+
+def read_network():
+    """Принятые и отправленные байты всех интерфейсов, кроме lo"""
+    rx = tx = 0
+    with open("/proc/net/dev") as f:
+        for line in f.readlines()[2:]:
+            name, data = line.split(":", 1)
+            if name.strip() == "lo":
+                continue
+            fields = data.split()
+            rx += int(fields[0])
+            tx += int(fields[8])
+    return rx, tx
+
+
+def count_connections(port):
+    """Установленные TCP соединения на локальном порту (IPv4 и IPv6)"""
+    count = 0
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except FileNotFoundError:
+            continue
+        for line in lines:
+            fields = line.split()
+            local_port = int(fields[1].rsplit(":", 1)[1], 16)
+            if local_port == port and fields[3] == TCP_ESTABLISHED:
+                count += 1
+    return count
+
+
+def collect(args):
+    cpu_total, cpu_idle = read_cpu()
+    rx_bytes, tx_bytes = read_network()
+    return {
+        "cpu_total": cpu_total,
+        "cpu_idle": cpu_idle,
+        "memory_usage": read_memory_usage(),
+        "disk_usage": read_disk_usage(args.disk_path),
+        "connections": count_connections(args.xray_port),
+        "rx_bytes": rx_bytes,
+        "tx_bytes": tx_bytes
+    }
+
+
+def install_config(args, body):
+    """Атомарная замена config.json и перезапуск Xray"""
+    config = json.loads(body)
+    if not isinstance(config, dict) or "inbounds" not in config:
+        raise ValueError("config.json без inbounds")
+    temporary = f"{args.xray_config}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(body)
+    os.replace(temporary, args.xray_config)
+    if args.reload_command:
+        subprocess.run(shlex.split(args.reload_command), check=True, timeout=60)
+
+
+class AgentHandler(BaseHTTPRequestHandler):
+    # Keep-alive: сборщик держит соединение между проходами
+    protocol_version = "HTTP/1.1"
+
+    def _authorized(self, required=False):
+        """Проверка X-Agent-Token; required - токен нужен, даже если не задан"""
+        token = self.server.args.token
+        if not token and not required:
+            return True
+        if not token or not hmac.compare_digest(self.headers.get("X-Agent-Token", ""), token):
+            self._reply(401, {"error": "unauthorized"})
+            return False
+        return True
+
+    def do_PUT(self):
+        args = self.server.args
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_CONFIG_SIZE:
+            # Тело не читается, поэтому соединение закрывается: иначе его байты
+            # будут разобраны как следующий запрос
+            self.close_connection = True
+            self._reply(413, {"error": "body too large"})
+            return
+        # Допустимое тело читается всегда, чтобы не сломать keep-alive соединение
+        body = self.rfile.read(length) if length > 0 else b""
+        if self.path != "/config" or not args.xray_config:
+            self._reply(404, {"error": "not found"})
+            return
+        # Замена конфигурации Xray всегда требует токена
+        if not self._authorized(required=True):
+            return
+        if not body:
+            self._reply(400, {"error": "empty body"})
+            return
+        try:
+            install_config(args, body)
+        except ValueError as e:
+            self._reply(400, {"error": str(e)})
+            return
+        except Exception as e:
+            logger.error(f"Ошибка установки конфигурации: {e}")
+            self._reply(500, {"error": str(e)})
+            return
+        logger.info(f"Конфигурация Xray обновлена: {len(body)} байт")
+        self._reply(200, {"ok": True})
+
+    def do_GET(self):
+        args = self.server.args
+        if self.path != "/metrics":
+            self._reply(404, {"error": "not found"})
+            return
+        if not self._authorized():
+            return
+        try:
+            self._reply(200, collect(args))
+        except Exception as e:
+            logger.error(f"Ошибка сбора метрик: {e}")
+            self._reply(500, {"error": str(e)})
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Агент метрик узла Xray")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--xray-port", type=int, default=443)
+    parser.add_argument("--disk-path", default="/")
+    parser.add_argument("--token", default=os.getenv("NODE_AGENT_TOKEN"))
+    parser.add_argument("--xray-config", default=None, help="путь config.json Xray для PUT /config")
+    parser.add_argument("--reload-command", default="systemctl restart xray")
+    args = parser.parse_args()
+    if args.xray_config and not args.token:
+        parser.error("--xray-config требует --token или NODE_AGENT_TOKEN: без него config.json Xray сможет заменить любой")
+
+    server = ThreadingHTTPServer((args.host, args.port), AgentHandler)
+    server.daemon_threads = True
+    server.args = args
+    logger.info(f"Агент метрик слушает {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Остановка агента")
+
+
+if __name__ == "__main__":
+    main()
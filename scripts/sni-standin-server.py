@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Локальная TLS заглушка для офлайн проверки выбора SNI доменов.
+
+Принимает TLS рукопожатия для любых server_name с самоподписанным
+сертификатом. Для отдельных доменов можно задать задержку рукопожатия
+или отказ, чтобы проверить EWMA оценки SNIService без доступа в сеть.
+
+Запуск:
+    python scripts/sni-standin-server.py --port 8443 \\
+        --delay vk.com=120 --delay yandex.ru=30 --fail mail.ru
+
+xray-manager:
+    SNI_PROBE_ADDRESS=127.0.0.1:8443 SNI_PROBE_VERIFY=false
+"""
+
+import argparse
+import logging
+import os
+import socketserver
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def generate_certificate(directory):
+    """Генерация самоподписанного сертификата через openssl"""
+    cert_path = os.path.join(directory, "standin.crt")
+    key_path = os.path.join(directory, "standin.key")
+    result = subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", key_path, "-out", cert_path,
+            "-days", "1", "-subj", "/CN=sni-standin"
+        ],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        logger.error(f"Ошибка генерации сертификата: {result.stderr}")
+        sys.exit(1)
+    return cert_path, key_path
+
+
+def parse_delays(values):
+    delays = {}
+    for value in values:
+        domain, _, milliseconds = value.partition("=")
+        delays[domain] = float(milliseconds) / 1000.0
+    return delays
+
+
+def create_context(cert_path, key_path, delays, failures):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_path, key_path)
+
+    def sni_callback(ssl_socket, server_name, ssl_context):
+        # Вызывается в потоке соединения, поэтому задержка не блокирует другие
+        if server_name in failures:
+            return ssl.ALERT_DESCRIPTION_HANDSHAKE_FAILURE
+        delay = delays.get(server_name, delays.get("*", 0.0))
+        if delay:
+            time.sleep(delay)
+        return None
+
+    context.sni_callback = sni_callback
+    return context
+
+
+class StandinHandler(socketserver.BaseRequestHandler):
+    """Рукопожатие TLS и немедленное закрытие соединения"""
+
+    def handle(self):
+        try:
+            with self.server.context.wrap_socket(self.request, server_side=True) as tls:
+                logger.info(f"Рукопожатие {self.client_address[0]} SNI={tls.server_hostname}")
+        except (ssl.SSLError, OSError) as e:
+            logger.info(f"Рукопожатие отклонено: {e}")
+
+
+class StandinServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS заглушка для проб SNI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--delay", action="append", default=[],
+                        help="домен=мс, '*' для всех доменов")
+    parser.add_argument("--fail", action="append", default=[],
+                        help="домен, для которого рукопожатие отклоняется")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert_path, key_path = generate_certificate(directory)
+        context = create_context(cert_path, key_path, parse_delays(args.delay), set(args.fail))
+
+        with StandinServer((args.host, args.port), StandinHandler) as server:
+            server.context = context
+            logger.info(f"TLS заглушка слушает {args.host}:{args.port}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                logger.info("Остановка заглушки")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+import logging
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+
+from app.services.webhook_signature import VerifiedWebhook, verified_webhook
+from app.services.yookassa_service import yookassa_webhook_verifier
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+@router.post("/yookassa")
+async def yookassa_webhook(
+    request: Request,
+    webhook: VerifiedWebhook = Depends(verified_webhook(yookassa_webhook_verifier))
+):
+    """Webhook YooKassa: подпись проверена по сырому телу, событие уходит в inbox"""
+    if not await request.app.state.yookassa_service.process_webhook(webhook):
+        raise HTTPException(status_code=400, detail="Ошибка обработки уведомления")
+    return {"status": "ok"}
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Query
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 import uvicorn
@@ -13,6 +13,8 @@ from app.services.yookassa_service import YooKassaService
 from app.services.robokassa_service import RobokassaService
 from app.services.crypto_service import CryptoService
 from app.services.subscription_service import SubscriptionService
+from app.services.stats_store import stats_store
+from app.services.subscription_lifecycle import subscription_lifecycle
 from app.utils.metrics import setup_metrics
 
 # Настройка логирования
@@ -41,6 +43,9 @@ async def lifespan(app: FastAPI):
     await robokassa_service.initialize()
     await crypto_service.initialize()
     await subscription_service.initialize()
+    await stats_store.initialize()
+    stats_store.start()
+    subscription_lifecycle.start()
     
     # Настройка метрик
     setup_metrics()
@@ -49,6 +54,8 @@ async def lifespan(app: FastAPI):
     yield
     
     logger.info("Остановка Payment Service...")
+    await subscription_lifecycle.stop()
+    await stats_store.stop()
     await yookassa_service.cleanup()
     await robokassa_service.cleanup()
     await crypto_service.cleanup()
@@ -63,6 +70,9 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Сервисы для роутеров
+app.state.yookassa_service = yookassa_service
+
 # Middleware
 app.add_middleware(
     CORSMiddleware,
@@ -121,35 +131,60 @@ async def metrics():
     return get_metrics()
 
 @app.get("/api/v1/stats/payments")
-async def get_payments_stats():
+async def get_payments_stats(days: int = Query(30, ge=1, le=366)):
     """Статистика платежей"""
     try:
-        stats = await subscription_service.get_payments_stats()
+        stats = await stats_store.get_payments_stats(days)
         return stats
     except Exception as e:
         logger.error(f"Ошибка получения статистики платежей: {e}")
         raise HTTPException(status_code=500, detail="Ошибка получения статистики")
 
 @app.get("/api/v1/stats/subscriptions")
-async def get_subscriptions_stats():
+async def get_subscriptions_stats(days: int = Query(30, ge=1, le=366)):
     """Статистика подписок"""
     try:
-        stats = await subscription_service.get_subscriptions_stats()
+        stats = await stats_store.get_subscriptions_stats(days)
         return stats
     except Exception as e:
         logger.error(f"Ошибка получения статистики подписок: {e}")
         raise HTTPException(status_code=500, detail="Ошибка получения статистики")
 
+@app.get("/api/v1/stats/webhooks")
+async def get_webhooks_stats():
+    """Очередь входящих webhook: число событий по статусам"""
+    try:
+        from app.services.webhook_inbox import webhook_inbox
+        return await webhook_inbox.get_stats()
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики webhook: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка получения статистики")
+
+@app.get("/api/v1/stats/lifecycle")
+async def get_lifecycle_stats():
+    """Состояние планировщика истечения подписок"""
+    return subscription_lifecycle.get_status()
+
 @app.get("/api/v1/stats/revenue")
-async def get_revenue_stats():
+async def get_revenue_stats(days: int = Query(30, ge=1, le=366)):
     """Статистика доходов"""
     try:
-        stats = await subscription_service.get_revenue_stats()
+        stats = await stats_store.get_revenue_stats(days)
         return stats
     except Exception as e:
         logger.error(f"Ошибка получения статистики доходов: {e}")
         raise HTTPException(status_code=500, detail="Ошибка получения статистики")
 
+@app.post("/api/v1/stats/rebuild")
+async def rebuild_stats():
+    """Пересборка дневных счетчиков из платежей и подписок"""
+    try:
+        rows = await stats_store.rebuild()
+        return {"status": "ok", "rows": rows}
+    except Exception as e:
+        logger.error(f"Ошибка пересборки статистики: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка пересборки статистики")
+
 if __name__ == "__main__":
     uvicorn.run(
         "app.main:app",
@@ -0,0 +1,327 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from sqlalchemy import (
+    Column, Date, Integer, Numeric, String, Table, UniqueConstraint,
+    case, delete, func, select
+)
+from sqlalchemy.exc import DBAPIError
+
+from app.database import SessionLocal
+from app.models import Base, Payment as PaymentModel, Subscription
+
+logger = logging.getLogger(__name__)
+
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "30"))
+STATS_DAYS = int(os.getenv("STATS_DAYS", "30"))
+# Период полной пересборки счетчиков, секунд (0 - отключена)
+STATS_REBUILD_INTERVAL = float(os.getenv("STATS_REBUILD_INTERVAL", "3600"))
+
+# Подписка на год от этой суммы, иначе на месяц
+YEARLY_MIN_AMOUNT = 2000
+# Попытки пересборки при конфликте с параллельной записью счетчиков
+REBUILD_ATTEMPTS = 3
+
+COUNTERS = (
+    "payments_created",
+    "payments_completed",
+    "payments_canceled",
+    "revenue",
+    "subscriptions_created",
+    "subscriptions_expired",
+)
+
+# Дневные счетчики платежей и подписок: строка на (день, система, тариф, валюта)
+payment_stats_daily = Table(
+    "payment_stats_daily",
+    Base.metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("day", Date, nullable=False),
+    # Истечения подписок ведутся без платежной системы и валюты ("")
+    Column("provider", String(32), nullable=False),
+    Column("plan", String(16), nullable=False),
+    Column("currency", String(3), nullable=False),
+    Column("payments_created", Integer, nullable=False, default=0),
+    Column("payments_completed", Integer, nullable=False, default=0),
+    Column("payments_canceled", Integer, nullable=False, default=0),
+    Column("revenue", Numeric(14, 2, asdecimal=False), nullable=False, default=0),
+    Column("subscriptions_created", Integer, nullable=False, default=0),
+    Column("subscriptions_expired", Integer, nullable=False, default=0),
+    UniqueConstraint("day", "provider", "plan", "currency", name="uq_payment_stats_daily"),
+)
+
+
+def subscription_plan(amount: float) -> Tuple[str, int]:
+    """Тариф и длительность подписки в днях по сумме платежа"""
+    if amount >= YEARLY_MIN_AMOUNT:
+        return "yearly", 365
+    return "monthly", 30
+
+
+def _upsert_statement(dialect: str):
+    """INSERT ... ON CONFLICT DO UPDATE с прибавлением счетчиков"""
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+
+    table = payment_stats_daily
+    statement = dialect_insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=["day", "provider", "plan", "currency"],
+        set_={column: table.c[column] + statement.excluded[column] for column in COUNTERS}
+    )
+
+
+class StatsStore:
+    """Статистика платежей, подписок и доходов из дневных счетчиков
+
+    Счетчики увеличиваются в той же транзакции, что и событие платежа
+    (создание, оплата, отмена, истечение подписки), поэтому они
+    согласованы с данными и не пересчитываются по таблице payments.
+    Чтение статистики проходит по строкам payment_stats_daily - их число
+    зависит от дней, систем и тарифов, а не от числа платежей - и
+    кэшируется на STATS_CACHE_TTL. rebuild() пересобирает счетчики из
+    payments и subscriptions: при первом запуске, после ручных правок и
+    раз в STATS_REBUILD_INTERVAL. Пересборка читает и заменяет счетчики в
+    одном снимке REPEATABLE READ: приращение, закоммиченное после снимка,
+    не теряется, а прерывает пересборку ошибкой сериализации, и она
+    повторяется.
+
+    Инкрементально счетчики ведет только yookassa_service. Платежи
+    Robokassa и криптовалютой проходят мимо него и попадают в статистику
+    с периодической пересборкой, пока их обработчики не вызывают record().
+    """
+
+    def __init__(self, cache_ttl: float = STATS_CACHE_TTL, rebuild_interval: float = STATS_REBUILD_INTERVAL):
+        self.cache_ttl = cache_ttl
+        self.rebuild_interval = rebuild_interval
+        self._cache: Dict[Tuple[str, int], Tuple[float, Dict[str, Any]]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def record(
+        self,
+        db,
+        provider: str,
+        plan: str,
+        currency: str,
+        day: Optional[date] = None,
+        **increments: float
+    ):
+        """Приращение счетчиков в транзакции вызывающего (коммит делает он)"""
+        values = {column: 0 for column in COUNTERS}
+        values.update(increments)
+        db.execute(_upsert_statement(db.bind.dialect.name).values(
+            day=day or date.today(), provider=provider, plan=plan, currency=currency, **values
+        ))
+
+    async def initialize(self):
+        """Первичное заполнение счетчиков по существующим платежам"""
+        def is_empty():
+            db = SessionLocal()
+            try:
+                return db.execute(select(payment_stats_daily.c.id).limit(1)).first() is None
+            finally:
+                db.close()
+
+        if await asyncio.to_thread(is_empty):
+            await self.rebuild()
+
+    def start(self):
+        """Запуск периодической пересборки"""
+        if self._task is None and self.rebuild_interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка периодической пересборки"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.rebuild_interval)
+            try:
+                await self.rebuild()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка пересборки статистики платежей: {e}")
+
+    async def rebuild(self) -> int:
+        """Пересборка счетчиков из payments и subscriptions"""
+        for attempt in range(1, REBUILD_ATTEMPTS + 1):
+            try:
+                rows = await asyncio.to_thread(self._rebuild)
+                break
+            except DBAPIError as e:
+                if attempt == REBUILD_ATTEMPTS:
+                    raise
+                logger.warning(f"Конфликт пересборки статистики, попытка {attempt}: {e}")
+        self._cache.clear()
+        logger.info(f"Статистика платежей пересобрана: {rows} строк")
+        return rows
+
+    @staticmethod
+    def _rebuild() -> int:
+        plan = case((PaymentModel.amount >= YEARLY_MIN_AMOUNT, "yearly"), else_="monthly")
+        totals: Dict[Tuple[Any, ...], Dict[str, float]] = defaultdict(lambda: {column: 0 for column in COUNTERS})
+
+        db = SessionLocal()
+        try:
+            # Агрегаты и DELETE в одном снимке: запись счетчиков после него
+            # вызовет ошибку сериализации вместо потери приращения
+            if db.bind.dialect.name == "postgresql":
+                db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+            queries = [
+                (PaymentModel.created_at, None, {"payments_created": func.count()}),
+                (PaymentModel.completed_at, "completed", {
+                    "payments_completed": func.count(),
+                    "subscriptions_created": func.count(),
+                    "revenue": func.coalesce(func.sum(PaymentModel.amount), 0)
+                }),
+                (PaymentModel.canceled_at, "canceled", {"payments_canceled": func.count()}),
+            ]
+            for timestamp, status, aggregates in queries:
+                statement = (
+                    select(
+                        func.date(timestamp), PaymentModel.payment_system, plan, PaymentModel.currency,
+                        *aggregates.values()
+                    )
+                    .where(timestamp.is_not(None))
+                    .group_by(func.date(timestamp), PaymentModel.payment_system, plan, PaymentModel.currency)
+                )
+                if status:
+                    statement = statement.where(PaymentModel.status == status)
+                for day, provider, row_plan, currency, *values in db.execute(statement):
+                    bucket = totals[(day, provider or "", row_plan, currency or "")]
+                    for column, value in zip(aggregates, values):
+                        bucket[column] += value or 0
+
+            expired = (
+                select(func.date(Subscription.end_date), Subscription.subscription_type, func.count())
+                .where(Subscription.status == "expired")
+                .group_by(func.date(Subscription.end_date), Subscription.subscription_type)
+            )
+            for day, row_plan, count in db.execute(expired):
+                totals[(day, "", row_plan, "")]["subscriptions_expired"] += count
+
+            db.execute(delete(payment_stats_daily))
+            if totals:
+                db.execute(payment_stats_daily.insert(), [
+                    {
+                        # SQLite возвращает date() строкой
+                        "day": date.fromisoformat(day) if isinstance(day, str) else day,
+                        "provider": provider,
+                        "plan": row_plan,
+                        "currency": currency,
+                        **values
+                    }
+                    for (day, provider, row_plan, currency), values in totals.items()
+                ])
+            db.commit()
+            return len(totals)
+        finally:
+            db.close()
+
+    async def _cached(self, name: str, days: int, build: Callable[[list], Dict[str, Any]]) -> Dict[str, Any]:
+        key = (name, days)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        since = date.today() - timedelta(days=days - 1)
+
+        def load():
+            db = SessionLocal()
+            try:
+                return db.execute(
+                    select(payment_stats_daily).where(payment_stats_daily.c.day >= since)
+                ).all()
+            finally:
+                db.close()
+
+        result = build(await asyncio.to_thread(load))
+        result.update(days=days, updated_at=datetime.now().isoformat())
+        self._cache[key] = (time.monotonic() + self.cache_ttl, result)
+        return result
+
+    async def get_payments_stats(self, days: int = STATS_DAYS) -> Dict[str, Any]:
+        """Платежи по дням и платежным системам"""
+        def build(rows):
+            columns = ("payments_created", "payments_completed", "payments_canceled")
+            total = dict.fromkeys(columns, 0)
+            by_provider: Dict[str, Dict[str, int]] = defaultdict(lambda: dict.fromkeys(columns, 0))
+            by_day: Dict[date, Dict[str, int]] = defaultdict(lambda: dict.fromkeys(columns, 0))
+            for row in rows:
+                if not row.provider:
+                    continue
+                for column in columns:
+                    value = row._mapping[column]
+                    total[column] += value
+                    by_provider[row.provider][column] += value
+                    by_day[row.day][column] += value
+            total["conversion"] = (
+                round(total["payments_completed"] / total["payments_created"], 4)
+                if total["payments_created"] else 0.0
+            )
+            return {
+                "total": total,
+                "by_provider": dict(by_provider),
+                "by_day": [{"day": day.isoformat(), **values} for day, values in sorted(by_day.items())]
+            }
+        return await self._cached("payments", days, build)
+
+    async def get_subscriptions_stats(self, days: int = STATS_DAYS) -> Dict[str, Any]:
+        """Новые и истекшие подписки по тарифам"""
+        def build(rows):
+            by_plan: Dict[str, Dict[str, int]] = defaultdict(lambda: {"created": 0, "expired": 0})
+            by_day: Dict[date, Dict[str, int]] = defaultdict(lambda: {"created": 0, "expired": 0})
+            for row in rows:
+                by_plan[row.plan]["created"] += row.subscriptions_created
+                by_plan[row.plan]["expired"] += row.subscriptions_expired
+                by_day[row.day]["created"] += row.subscriptions_created
+                by_day[row.day]["expired"] += row.subscriptions_expired
+            return {
+                "created": sum(values["created"] for values in by_plan.values()),
+                "expired": sum(values["expired"] for values in by_plan.values()),
+                "by_plan": dict(by_plan),
+                "by_day": [{"day": day.isoformat(), **values} for day, values in sorted(by_day.items())]
+            }
+        return await self._cached("subscriptions", days, build)
+
+    async def get_revenue_stats(self, days: int = STATS_DAYS) -> Dict[str, Any]:
+        """Доход по валютам, дням, системам и тарифам"""
+        def build(rows):
+            total: Dict[str, float] = defaultdict(float)
+            by_provider: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+            by_plan: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+            by_day: Dict[date, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+            for row in rows:
+                if not row.revenue:
+                    continue
+                total[row.currency] += row.revenue
+                by_provider[row.provider][row.currency] += row.revenue
+                by_plan[row.plan][row.currency] += row.revenue
+                by_day[row.day][row.currency] += row.revenue
+            rounded = lambda values: {currency: round(value, 2) for currency, value in values.items()}
+            return {
+                "total": rounded(total),
+                "by_provider": {key: rounded(values) for key, values in by_provider.items()},
+                "by_plan": {key: rounded(values) for key, values in by_plan.items()},
+                "by_day": [{"day": day.isoformat(), **rounded(values)} for day, values in sorted(by_day.items())]
+            }
+        return await self._cached("revenue", days, build)
+
+
+# Глобальный экземпляр статистики
+stats_store = StatsStore()
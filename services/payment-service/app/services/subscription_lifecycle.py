@@ -0,0 +1,424 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from sqlalchemy import (
+    BigInteger, Column, DateTime, Index, Integer, String, Table, Text,
+    bindparam, select, update
+)
+
+from app.database import SessionLocal
+from app.models import Base, Subscription, User
+from app.services.stats_store import stats_store
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTION_LIFECYCLE_INTERVAL = float(os.getenv("SUBSCRIPTION_LIFECYCLE_INTERVAL", "60"))
+SUBSCRIPTION_BATCH_SIZE = int(os.getenv("SUBSCRIPTION_BATCH_SIZE", "1000"))
+SUBSCRIPTION_REMINDER_DAYS = int(os.getenv("SUBSCRIPTION_REMINDER_DAYS", "3"))
+XRAY_MANAGER_URL = os.getenv("XRAY_MANAGER_URL", "http://xray-manager:8000")
+TELEGRAM_BOT_TOKEN = os.getenv("BOT_TOKEN", "")
+# Telegram ограничивает рассылку ~30 сообщениями в секунду на бота
+OUTBOX_SEND_RATE = float(os.getenv("OUTBOX_SEND_RATE", "25"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_LEASE = 300
+
+# Отложенные действия жизненного цикла подписок: отзыв конфигураций в
+# xray-manager (revoke) и сообщения пользователям (reminder, expired)
+subscription_outbox = Table(
+    "subscription_outbox",
+    Base.metadata,
+    Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True),
+    Column("kind", String(16), nullable=False),
+    # Не даёт поставить одно напоминание дважды (reminder:<id подписки>)
+    Column("dedup_key", String(128), nullable=True, unique=True),
+    Column("payload", Text, nullable=False),
+    Column("status", String(16), nullable=False, default="pending"),
+    Column("attempts", Integer, nullable=False, default=0),
+    Column("last_error", Text, nullable=True),
+    Column("available_at", DateTime, nullable=False),
+    Column("created_at", DateTime, nullable=False),
+    Column("sent_at", DateTime, nullable=True),
+    Index("idx_subscription_outbox_status_available", "status", "available_at"),
+)
+
+MESSAGE_KINDS = ("reminder", "expired")
+
+
+def _insert_ignore(dialect: str):
+    """INSERT ... ON CONFLICT DO NOTHING по dedup_key"""
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(subscription_outbox).on_conflict_do_nothing(index_elements=["dedup_key"])
+
+
+def _outbox_row(kind: str, payload: Dict[str, Any], now: datetime, dedup_key: Optional[str] = None) -> Dict[str, Any]:
+    return {
+        "kind": kind,
+        "dedup_key": dedup_key,
+        "payload": json.dumps(payload, ensure_ascii=False, default=str),
+        "status": "pending",
+        "attempts": 0,
+        "available_at": now,
+        "created_at": now
+    }
+
+
+class SubscriptionLifecycle:
+    """Истечение подписок, отзыв конфигураций и напоминания
+
+    Раз в SUBSCRIPTION_LIFECYCLE_INTERVAL наступившие подписки
+    выбираются по индексу subscriptions(end_date) пачками до
+    SUBSCRIPTION_BATCH_SIZE через FOR UPDATE SKIP LOCKED. Каждая пачка -
+    одна короткая транзакция: подписки переводятся в expired, у
+    пользователей без других активных подписок снимается is_premium, а в
+    subscription_outbox ставится одна запись отзыва конфигураций на всю
+    пачку и уведомления. Долгих блокировок нет, поэтому накопленные за
+    простой 100k подписок разбираются пачками параллельно с остальной
+    работой и другими репликами.
+
+    Outbox доставляется после коммита: отзыв - одним запросом
+    POST /api/v1/configs/revoke в xray-manager на пачку, сообщения - через
+    Telegram Bot API не чаще OUTBOX_SEND_RATE в секунду. Неудачная
+    доставка повторяется с растущей паузой.
+    """
+
+    def __init__(
+        self,
+        interval: float = SUBSCRIPTION_LIFECYCLE_INTERVAL,
+        batch_size: int = SUBSCRIPTION_BATCH_SIZE,
+        reminder_days: int = SUBSCRIPTION_REMINDER_DAYS,
+        xray_manager_url: str = XRAY_MANAGER_URL,
+        bot_token: str = TELEGRAM_BOT_TOKEN,
+        send_rate: float = OUTBOX_SEND_RATE
+    ):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.reminder_window = timedelta(days=reminder_days)
+        self.xray_manager_url = xray_manager_url.rstrip("/")
+        self.bot_token = bot_token
+        self.send_interval = 1 / send_rate if send_rate > 0 else 0
+        self._reminded_until: Optional[datetime] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+        self.expired_total = 0
+        self.revoked_users_total = 0
+        self.reminders_total = 0
+        self.sent_total = 0
+
+    def start(self):
+        """Запуск планировщика"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка планировщика"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка планировщика подписок: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        """Один проход: истечения, напоминания, доставка outbox"""
+        await self.expire_due()
+        await self.enqueue_reminders()
+        await self.dispatch_outbox()
+
+    async def expire_due(self) -> int:
+        """Истечение наступивших подписок пачками"""
+        expired = 0
+        while True:
+            count = await asyncio.to_thread(self._expire_batch)
+            expired += count
+            if count < self.batch_size:
+                break
+        if expired:
+            self.expired_total += expired
+            logger.info(f"Истекло подписок: {expired}")
+        return expired
+
+    def _expire_batch(self) -> int:
+        now = datetime.now()
+        subscriptions = Subscription.__table__
+        users = User.__table__
+        db = SessionLocal()
+        try:
+            due = (
+                select(subscriptions.c.id)
+                .where(subscriptions.c.status == "active", subscriptions.c.end_date <= now)
+                .order_by(subscriptions.c.end_date)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+                .scalar_subquery()
+            )
+            rows = db.execute(
+                update(subscriptions)
+                .where(subscriptions.c.id.in_(due))
+                .values(status="expired")
+                .returning(
+                    subscriptions.c.id, subscriptions.c.user_id,
+                    subscriptions.c.subscription_type, subscriptions.c.end_date
+                )
+            ).all()
+            if not rows:
+                db.rollback()
+                return 0
+
+            # Премиум снимается только у тех, у кого не осталось активной подписки
+            other = subscriptions.alias("other")
+            still_active = (
+                select(other.c.id)
+                .where(other.c.user_id == users.c.id, other.c.status == "active", other.c.end_date > now)
+                .exists()
+            )
+            lost = db.execute(
+                update(users)
+                .where(users.c.id.in_({row.user_id for row in rows}), ~still_active)
+                .values(is_premium=False, updated_at=now)
+                .returning(users.c.id, users.c.telegram_id)
+            ).all()
+
+            # День истечения, а не день прохода: так же группирует пересчет статистики
+            expired = Counter((row.subscription_type, row.end_date.date()) for row in rows)
+            for (plan, day), count in expired.items():
+                stats_store.record(db, "", plan, "", day=day, subscriptions_expired=count)
+
+            if lost:
+                subscription_by_user = {row.user_id: row.id for row in rows}
+                outbox = [_outbox_row("revoke", {"user_ids": [user.id for user in lost]}, now)]
+                outbox.extend(
+                    _outbox_row(
+                        "expired", {"telegram_id": user.telegram_id}, now,
+                        dedup_key=f"expired:{subscription_by_user[user.id]}"
+                    )
+                    for user in lost if user.telegram_id
+                )
+                db.execute(_insert_ignore(db.bind.dialect.name), outbox)
+
+            db.commit()
+            self.revoked_users_total += len(lost)
+            return len(rows)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def enqueue_reminders(self) -> int:
+        """Напоминания о подписках, истекающих в ближайшие дни
+
+        Окно (последняя граница, now + reminder_days] сдвигается
+        инкрементально; после перезапуска окно читается заново, дубли
+        отсекает dedup_key.
+        """
+        now = datetime.now()
+        since = self._reminded_until or now
+        until = now + self.reminder_window
+        queued = await asyncio.to_thread(self._enqueue_reminders, since, until)
+        self._reminded_until = until
+        if queued:
+            self.reminders_total += queued
+            logger.info(f"Поставлено напоминаний о продлении: {queued}")
+        return queued
+
+    def _enqueue_reminders(self, since: datetime, until: datetime) -> int:
+        subscriptions = Subscription.__table__
+        users = User.__table__
+        queued = 0
+        last = (since, 0)
+        while True:
+            db = SessionLocal()
+            try:
+                # Keyset по (end_date, id) вдоль индекса end_date
+                rows = db.execute(
+                    select(subscriptions.c.id, subscriptions.c.end_date, users.c.telegram_id)
+                    .join(users, users.c.id == subscriptions.c.user_id)
+                    .where(
+                        subscriptions.c.status == "active",
+                        subscriptions.c.end_date <= until,
+                        (subscriptions.c.end_date > last[0])
+                        | ((subscriptions.c.end_date == last[0]) & (subscriptions.c.id > last[1]))
+                    )
+                    .order_by(subscriptions.c.end_date, subscriptions.c.id)
+                    .limit(self.batch_size)
+                ).all()
+                if not rows:
+                    break
+                now = datetime.now()
+                result = db.execute(_insert_ignore(db.bind.dialect.name), [
+                    _outbox_row(
+                        "reminder", {"telegram_id": row.telegram_id, "end_date": row.end_date}, now,
+                        dedup_key=f"reminder:{row.id}"
+                    )
+                    for row in rows if row.telegram_id
+                ]) if any(row.telegram_id for row in rows) else None
+                db.commit()
+                queued += max(result.rowcount, 0) if result is not None else 0
+            finally:
+                db.close()
+            last = (rows[-1].end_date, rows[-1].id)
+            if len(rows) < self.batch_size:
+                break
+        return queued
+
+    async def dispatch_outbox(self) -> int:
+        """Доставка outbox пачками до исчерпания доступных записей"""
+        kinds = ("revoke",) + (MESSAGE_KINDS if self.bot_token else ())
+        delivered = 0
+        while True:
+            items = await asyncio.to_thread(self._claim, kinds)
+            if not items:
+                break
+            results = []
+            for item in items:
+                error = await self._deliver(item)
+                results.append((item, error))
+                if error is None:
+                    delivered += 1
+            await asyncio.to_thread(self._finish, results)
+            if len(items) < self.batch_size:
+                break
+        self.sent_total += delivered
+        return delivered
+
+    def _claim(self, kinds) -> List[Dict[str, Any]]:
+        """Аренда пачки записей outbox, как в webhook inbox"""
+        now = datetime.now()
+        table = subscription_outbox
+        available = (
+            select(table.c.id)
+            .where(
+                table.c.status == "pending",
+                table.c.kind.in_(kinds),
+                table.c.available_at <= now
+            )
+            .order_by(table.c.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                update(table)
+                .where(table.c.id.in_(available))
+                .values(available_at=now + timedelta(seconds=OUTBOX_LEASE), attempts=table.c.attempts + 1)
+                .returning(table.c.id, table.c.kind, table.c.payload, table.c.attempts)
+            ).all()
+            db.commit()
+        finally:
+            db.close()
+        return sorted((dict(row._mapping) for row in rows), key=lambda item: item["id"])
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        return self._session
+
+    async def _deliver(self, item: Dict[str, Any]) -> Optional[str]:
+        """None при успехе, иначе текст ошибки"""
+        payload = json.loads(item["payload"])
+        started = time.monotonic()
+        try:
+            if item["kind"] == "revoke":
+                url = f"{self.xray_manager_url}/api/v1/configs/revoke"
+                body = {"user_ids": payload["user_ids"], "reason": "subscription_expired"}
+            else:
+                url = f"https://api.telegram.org/bot{self.bot_token}/sendMessage"
+                body = {"chat_id": payload["telegram_id"], "text": self._message_text(item["kind"], payload)}
+            async with self._get_session().post(url, json=body) as response:
+                if response.status >= 400:
+                    return f"HTTP {response.status}: {(await response.text())[:200]}"
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return str(e) or e.__class__.__name__
+        finally:
+            if item["kind"] in MESSAGE_KINDS and self.send_interval:
+                await asyncio.sleep(max(0.0, self.send_interval - (time.monotonic() - started)))
+
+    @staticmethod
+    def _message_text(kind: str, payload: Dict[str, Any]) -> str:
+        if kind == "reminder":
+            end_date = datetime.fromisoformat(payload["end_date"])
+            return (
+                f"⏰ Ваша подписка заканчивается {end_date.strftime('%d.%m.%Y')}.\n\n"
+                f"Продлите ее, чтобы VPN продолжил работать: /subscription"
+            )
+        return (
+            "❌ Подписка закончилась, конфигурации отключены.\n\n"
+            "Оформить новую подписку: /subscription"
+        )
+
+    def _finish(self, results):
+        now = datetime.now()
+        table = subscription_outbox
+        params = []
+        for item, error in results:
+            if error is None:
+                status, available_at = "sent", now
+            else:
+                logger.warning(f"Ошибка доставки outbox {item['kind']} #{item['id']}: {error}")
+                status = "failed" if item["attempts"] >= OUTBOX_MAX_ATTEMPTS else "pending"
+                available_at = now + timedelta(seconds=min(3600, 2 ** item["attempts"] * 10))
+            params.append({
+                "_id": item["id"],
+                "_status": status,
+                "_available_at": available_at,
+                "_sent_at": now if error is None else None,
+                "_error": error
+            })
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(table)
+                .where(table.c.id == bindparam("_id"))
+                .values(
+                    status=bindparam("_status"),
+                    available_at=bindparam("_available_at"),
+                    sent_at=bindparam("_sent_at"),
+                    last_error=bindparam("_error")
+                ),
+                params
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def get_status(self) -> Dict[str, Any]:
+        """Счетчики планировщика подписок"""
+        return {
+            "expired_total": self.expired_total,
+            "revoked_users_total": self.revoked_users_total,
+            "reminders_total": self.reminders_total,
+            "sent_total": self.sent_total,
+            "reminded_until": self._reminded_until,
+            "messages_enabled": bool(self.bot_token)
+        }
+
+
+# Глобальный экземпляр планировщика подписок
+subscription_lifecycle = SubscriptionLifecycle()
@@ -0,0 +1,266 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Any, Callable, Dict, List, Union
+
+from sqlalchemy import (
+    BigInteger, Column, DateTime, Index, Integer, String, Table, Text, UniqueConstraint,
+    func, select, update
+)
+
+from app.database import SessionLocal
+from app.models import Base
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_INBOX_WORKERS = int(os.getenv("WEBHOOK_INBOX_WORKERS", "4"))
+WEBHOOK_INBOX_BATCH_SIZE = int(os.getenv("WEBHOOK_INBOX_BATCH_SIZE", "100"))
+WEBHOOK_INBOX_POLL_INTERVAL = float(os.getenv("WEBHOOK_INBOX_POLL_INTERVAL", "1.0"))
+WEBHOOK_INBOX_LEASE = int(os.getenv("WEBHOOK_INBOX_LEASE", "60"))
+WEBHOOK_INBOX_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_INBOX_MAX_ATTEMPTS", "10"))
+
+# Входящие уведомления платежных систем до обработки
+webhook_events = Table(
+    "webhook_events",
+    Base.metadata,
+    Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True),
+    Column("provider", String(32), nullable=False),
+    Column("event_id", String(128), nullable=False),
+    Column("event_type", String(64), nullable=False),
+    # Платеж, к которому относится событие: события одного платежа
+    # применяются по порядку в одной транзакции
+    Column("object_id", String(128), nullable=False),
+    Column("payload", Text, nullable=False),
+    # pending -> processing (аренда до available_at) -> processed | failed
+    Column("status", String(16), nullable=False, default="pending"),
+    Column("attempts", Integer, nullable=False, default=0),
+    Column("last_error", Text, nullable=True),
+    Column("available_at", DateTime, nullable=False, default=func.now()),
+    Column("received_at", DateTime, nullable=False, default=func.now()),
+    Column("processed_at", DateTime, nullable=True),
+    UniqueConstraint("provider", "event_id", name="uq_webhook_events_provider_event"),
+    Index("idx_webhook_events_status_available", "status", "available_at"),
+)
+
+# Обработчик события: (сессия, provider, event_type, payload); коммит делает inbox
+EventHandler = Callable[[Any, str, str, Dict[str, Any]], None]
+
+
+def _insert_ignore(dialect: str):
+    """INSERT ... ON CONFLICT DO NOTHING по (provider, event_id)"""
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(webhook_events).on_conflict_do_nothing(
+        index_elements=["provider", "event_id"]
+    )
+
+
+class WebhookInbox:
+    """Прием уведомлений платежных систем через таблицу webhook_events
+
+    Webhook только записывает сырое событие (один INSERT ... ON CONFLICT
+    DO NOTHING) и сразу отвечает, поэтому время ответа не зависит от
+    нагрузки, а повторная доставка того же события отбрасывается
+    уникальным ключом (provider, event_id).
+
+    Воркеры забирают пачки событий через FOR UPDATE SKIP LOCKED с арендой
+    на WEBHOOK_INBOX_LEASE: события, взятые упавшим воркером, вернутся в
+    обработку после истечения аренды. События одного платежа применяются
+    по порядку в одной транзакции вместе с отметкой processed. Ошибка
+    откатывает транзакцию платежа, событие повторяется с растущей паузой
+    и после WEBHOOK_INBOX_MAX_ATTEMPTS попыток помечается failed.
+    """
+
+    def __init__(
+        self,
+        workers: int = WEBHOOK_INBOX_WORKERS,
+        batch_size: int = WEBHOOK_INBOX_BATCH_SIZE,
+        poll_interval: float = WEBHOOK_INBOX_POLL_INTERVAL,
+        lease: int = WEBHOOK_INBOX_LEASE,
+        max_attempts: int = WEBHOOK_INBOX_MAX_ATTEMPTS
+    ):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = timedelta(seconds=lease)
+        self.max_attempts = max_attempts
+        self.handlers: Dict[str, EventHandler] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    def register(self, provider: str, handler: EventHandler):
+        """Обработчик событий платежной системы"""
+        self.handlers[provider] = handler
+
+    def start(self):
+        """Запуск воркеров"""
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            logger.info(f"Обработка webhook событий запущена: {self.workers} воркеров")
+
+    async def stop(self):
+        """Остановка воркеров; взятые события вернутся по истечении аренды"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def ingest(
+        self,
+        provider: str,
+        event_id: str,
+        event_type: str,
+        object_id: str,
+        payload: Union[bytes, Dict[str, Any]]
+    ) -> bool:
+        """Запись события; False - событие уже было принято
+
+        payload - сырое тело webhook (сохраняется как есть) или словарь.
+        """
+        if isinstance(payload, bytes):
+            payload = payload.decode()
+        else:
+            payload = json.dumps(payload, ensure_ascii=False)
+        created = await asyncio.to_thread(
+            self._insert, provider, event_id, event_type, object_id, payload
+        )
+        if created:
+            self._wakeup.set()
+        else:
+            logger.info(f"Повторное уведомление {provider} {event_id} пропущено")
+        return created
+
+    @staticmethod
+    def _insert(provider: str, event_id: str, event_type: str, object_id: str, payload: str) -> bool:
+        db = SessionLocal()
+        try:
+            now = datetime.now()
+            result = db.execute(_insert_ignore(db.bind.dialect.name).values(
+                provider=provider,
+                event_id=event_id,
+                event_type=event_type,
+                object_id=object_id,
+                payload=payload,
+                status="pending",
+                attempts=0,
+                available_at=now,
+                received_at=now
+            ))
+            db.commit()
+            return result.rowcount > 0
+        finally:
+            db.close()
+
+    async def _worker(self):
+        while True:
+            try:
+                events = await asyncio.to_thread(self._claim)
+                if events:
+                    for _, group in groupby(events, key=lambda event: (event["provider"], event["object_id"])):
+                        await asyncio.to_thread(self._process, list(group))
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка обработки webhook событий: {e}")
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _claim(self) -> List[Dict[str, Any]]:
+        """Аренда пачки доступных событий"""
+        now = datetime.now()
+        table = webhook_events
+        available = (
+            select(table.c.id)
+            .where(
+                table.c.status.in_(("pending", "processing")),
+                table.c.available_at <= now
+            )
+            .order_by(table.c.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        db = SessionLocal()
+        try:
+            result = db.execute(
+                update(table)
+                .where(table.c.id.in_(available))
+                .values(status="processing", available_at=now + self.lease, attempts=table.c.attempts + 1)
+                .returning(
+                    table.c.id, table.c.provider, table.c.event_type, table.c.object_id,
+                    table.c.payload, table.c.attempts
+                )
+            )
+            events = [dict(row._mapping) for row in result]
+            db.commit()
+        finally:
+            db.close()
+        # Порядок поступления внутри платежа
+        events.sort(key=lambda event: (event["provider"], event["object_id"], event["id"]))
+        return events
+
+    def _process(self, events: List[Dict[str, Any]]):
+        """События одного платежа в одной транзакции"""
+        db = SessionLocal()
+        try:
+            for event in events:
+                handler = self.handlers.get(event["provider"])
+                if handler is None:
+                    raise LookupError(f"нет обработчика {event['provider']}")
+                handler(db, event["provider"], event["event_type"], json.loads(event["payload"]))
+            db.execute(
+                update(webhook_events)
+                .where(webhook_events.c.id.in_([event["id"] for event in events]))
+                .values(status="processed", processed_at=datetime.now(), last_error=None)
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка обработки события {events[0]['provider']} {events[0]['object_id']}: {e}")
+            self._retry_later(db, events, str(e))
+        finally:
+            db.close()
+
+    def _retry_later(self, db, events: List[Dict[str, Any]], error: str):
+        now = datetime.now()
+        for event in events:
+            failed = event["attempts"] >= self.max_attempts
+            db.execute(
+                update(webhook_events)
+                .where(webhook_events.c.id == event["id"])
+                .values(
+                    status="failed" if failed else "pending",
+                    available_at=now + timedelta(seconds=min(3600, 2 ** event["attempts"])),
+                    last_error=error[:1000]
+                )
+            )
+            if failed:
+                logger.error(f"Событие {event['provider']} {event['id']} не обработано за {event['attempts']} попыток")
+        db.commit()
+
+    async def get_stats(self) -> Dict[str, int]:
+        """Число событий по статусам"""
+        def count():
+            db = SessionLocal()
+            try:
+                result = db.execute(
+                    select(webhook_events.c.status, func.count()).group_by(webhook_events.c.status)
+                )
+                return {status: total for status, total in result}
+            finally:
+                db.close()
+        return await asyncio.to_thread(count)
+
+
+# Глобальный экземпляр очереди входящих webhook
+webhook_inbox = WebhookInbox()
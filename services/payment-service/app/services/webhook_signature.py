@@ -0,0 +1,78 @@
+import hashlib
+import hmac
+import json
+import logging
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from fastapi import HTTPException, Request
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = "X-Webhook-Signature"
+
+
+class VerifiedWebhook(NamedTuple):
+    """Тело webhook после проверки подписи: сырые байты и разобранный JSON"""
+    body: bytes
+    payload: Dict[str, Any]
+    key_index: int
+
+
+class WebhookVerifier:
+    """HMAC-SHA256 подпись webhook по сырым байтам тела
+
+    Подписываются ровно те байты, что прислала платежная система, без
+    повторной сериализации JSON. Для каждого секрета один раз создается
+    hmac объект с уже обработанным ключом, проверка копирует его и
+    хеширует только тело. Несколько секретов действуют одновременно на
+    время ротации: новый добавляется первым, старый удаляется после
+    переключения на стороне платежной системы.
+    """
+
+    def __init__(self, secrets: Iterable[str], digestmod: Callable = hashlib.sha256):
+        self._keys: List[Any] = [
+            hmac.new(secret.encode(), digestmod=digestmod) for secret in secrets if secret
+        ]
+
+    @classmethod
+    def from_setting(cls, value: Optional[str]) -> "WebhookVerifier":
+        """Секреты через запятую, например YOOKASSA_WEBHOOK_SECRET="новый,старый" """
+        return cls(part.strip() for part in (value or "").split(","))
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._keys)
+
+    def verify(self, body: bytes, signature: Optional[str]) -> Optional[int]:
+        """Номер подошедшего секрета или None"""
+        if not signature:
+            return None
+        if signature.startswith("sha256="):
+            signature = signature[7:]
+        signature = signature.strip().lower()
+        for index, key in enumerate(self._keys):
+            mac = key.copy()
+            mac.update(body)
+            if hmac.compare_digest(mac.hexdigest(), signature):
+                return index
+        return None
+
+
+def verified_webhook(verifier: WebhookVerifier, header: str = SIGNATURE_HEADER):
+    """FastAPI зависимость: тело читается один раз, проверяется и разбирается"""
+
+    async def dependency(request: Request) -> VerifiedWebhook:
+        body = await request.body()
+        key_index = verifier.verify(body, request.headers.get(header))
+        if key_index is None:
+            logger.warning(f"Неверная подпись webhook {request.url.path}")
+            raise HTTPException(status_code=401, detail="Invalid signature")
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON")
+        if key_index:
+            logger.info(f"Webhook {request.url.path} подписан прежним секретом #{key_index}")
+        return VerifiedWebhook(body, payload, key_index)
+
+    return dependency
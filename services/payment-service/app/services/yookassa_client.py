@@ -0,0 +1,145 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import uuid
+from typing import Any, Dict, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3")
+YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", "10"))
+YOOKASSA_MAX_RETRIES = int(os.getenv("YOOKASSA_MAX_RETRIES", "3"))
+YOOKASSA_MAX_CONNECTIONS = int(os.getenv("YOOKASSA_MAX_CONNECTIONS", "100"))
+
+# Ответы, после которых запрос можно повторить с тем же ключом идемпотентности
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class YooKassaError(Exception):
+    """Ошибка API YooKassa"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, body: Optional[Dict[str, Any]] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body or {}
+
+
+class YooKassaClient:
+    """Асинхронный клиент API YooKassa
+
+    Заменяет синхронный SDK, который блокировал event loop на время
+    HTTPS запроса. Одна aiohttp сессия с пулом keep-alive соединений
+    на процесс. POST запросы идут с заголовком Idempotence-Key, и повторы
+    после сетевой ошибки, 429 или 5xx используют тот же ключ, поэтому
+    YooKassa не создаст второй платеж. Пауза между повторами -
+    экспоненциальная с полным джиттером или Retry-After из ответа.
+    """
+
+    def __init__(
+        self,
+        shop_id: str,
+        secret_key: str,
+        base_url: str = YOOKASSA_API_URL,
+        timeout: float = YOOKASSA_TIMEOUT,
+        max_retries: int = YOOKASSA_MAX_RETRIES,
+        max_connections: int = YOOKASSA_MAX_CONNECTIONS,
+        backoff: float = 0.2,
+        max_backoff: float = 5.0
+    ):
+        self.shop_id = shop_id
+        self.secret_key = secret_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_connections = max_connections
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        credentials = base64.b64encode(f"{shop_id}:{secret_key}".encode()).decode()
+        self._headers = {"Authorization": f"Basic {credentials}"}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers=self._headers,
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            )
+        return self._session
+
+    async def close(self):
+        """Закрытие пула соединений"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def _request(
+        self,
+        method: str,
+        path: str,
+        payload: Optional[Dict[str, Any]] = None,
+        idempotence_key: Optional[str] = None,
+        timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
+        headers = {}
+        if method == "POST":
+            headers["Idempotence-Key"] = idempotence_key or uuid.uuid4().hex
+        session = self._get_session()
+        request_timeout = aiohttp.ClientTimeout(total=timeout if timeout is not None else self.timeout)
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                async with session.request(
+                    method, f"{self.base_url}{path}", json=payload, headers=headers, timeout=request_timeout
+                ) as response:
+                    if response.status < 400:
+                        return await response.json(content_type=None)
+                    text = await response.text()
+                    if response.status not in RETRY_STATUSES or attempt >= self.max_retries:
+                        try:
+                            body = json.loads(text)
+                        except ValueError:
+                            body = {"description": text}
+                        raise YooKassaError(
+                            f"YooKassa ответила {response.status}: {body.get('description', '')}",
+                            status_code=response.status,
+                            body=body
+                        )
+                    retry_after = response.headers.get("Retry-After")
+                    logger.warning(f"YooKassa ответила {response.status} на {method} {path}, повтор {attempt + 1}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    raise YooKassaError(f"YooKassa недоступна: {e}") from e
+                logger.warning(f"Ошибка соединения с YooKassa {method} {path}: {e}, повтор {attempt + 1}")
+
+            await asyncio.sleep(self._retry_delay(attempt, retry_after))
+
+        raise YooKassaError(f"YooKassa: исчерпаны повторы {method} {path}")
+
+    async def create_payment(self, payment_data: Dict[str, Any], idempotence_key: str) -> Dict[str, Any]:
+        """Создание платежа"""
+        return await self._request("POST", "/payments", payment_data, idempotence_key)
+
+    async def get_payment(self, external_id: str) -> Dict[str, Any]:
+        """Получение платежа"""
+        return await self._request("GET", f"/payments/{external_id}")
+
+    async def cancel_payment(self, external_id: str, idempotence_key: Optional[str] = None) -> Dict[str, Any]:
+        """Отмена платежа в статусе waiting_for_capture"""
+        return await self._request(
+            "POST", f"/payments/{external_id}/cancel", {},
+            idempotence_key or f"cancel-{external_id}"
+        )
@@ -3,44 +3,45 @@ import logging
 from typing import Dict, Any, Optional
 from datetime import datetime, timedelta
 import uuid
-import hmac
-import hashlib
-import json
 
-from yookassa import Payment, Configuration
 from yookassa.domain.notification import WebhookNotificationEventType, WebhookNotification
-from yookassa.domain.models.amount import Amount
-from yookassa.domain.models.currency import Currency
-from yookassa.domain.models.confirmation import ConfirmationType
-from yookassa.domain.models.payment_data import PaymentData
 
 from app.config import settings
 from app.database import SessionLocal
 from app.models import Payment as PaymentModel, Subscription, User
 from app.schemas.payment import PaymentCreate, PaymentResponse
+from app.services.stats_store import stats_store, subscription_plan
+from app.services.webhook_inbox import webhook_inbox
+from app.services.webhook_signature import VerifiedWebhook, WebhookVerifier
+from app.services.yookassa_client import YooKassaClient
 
 logger = logging.getLogger(__name__)
 
+# Подпись webhook YooKassa: секреты через запятую на время ротации
+yookassa_webhook_verifier = WebhookVerifier.from_setting(settings.YOOKASSA_WEBHOOK_SECRET)
+
 class YooKassaService:
     """Сервис для работы с YooKassa"""
     
     def __init__(self):
         self.shop_id = settings.YOOKASSA_SHOP_ID
         self.secret_key = settings.YOOKASSA_SECRET_KEY
-        self.webhook_secret = settings.YOOKASSA_WEBHOOK_SECRET
+        self.client = YooKassaClient(self.shop_id, self.secret_key)
         
     async def initialize(self):
         """Инициализация сервиса"""
         logger.info("Инициализация YooKassa сервиса...")
         
-        # Настройка конфигурации YooKassa
-        Configuration.account_id = self.shop_id
-        Configuration.secret_key = self.secret_key
+        # Уведомления обрабатываются воркерами inbox, а не в запросе webhook
+        webhook_inbox.register("yookassa", self.apply_event)
+        webhook_inbox.start()
         
-        logger.info("YooKassa сервис инициализирован")
+        logger.info(f"YooKassa сервис инициализирован: {self.client.base_url}")
     
     async def cleanup(self):
         """Очистка ресурсов"""
+        await webhook_inbox.stop()
+        await self.client.close()
         logger.info("YooKassa сервис очищен")
     
     async def check_status(self) -> Dict[str, Any]:
@@ -73,22 +74,24 @@ class YooKassaService:
             # Генерация ID платежа
             payment_id = f"yk_{uuid.uuid4().hex[:16]}"
             
-            # Создание платежа в YooKassa
-            payment_data = PaymentData(
-                amount=Amount(value=str(amount), currency=Currency.RUB),
-                confirmation={
-                    "type": ConfirmationType.REDIRECT,
+            # Создание платежа в YooKassa; payment_id служит ключом
+            # идемпотентности, повторы запроса не создадут второй платеж
+            payment_data = {
+                "amount": {"value": f"{amount:.2f}", "currency": currency},
+                "capture": True,
+                "confirmation": {
+                    "type": "redirect",
                     "return_url": return_url or f"{settings.WEBHOOK_URL}/payment/success"
                 },
-                description=description,
-                metadata={
+                "description": description,
+                "metadata": {
                     "user_id": str(user_id),
                     "payment_id": payment_id,
                     "service": "xray_subscription"
                 }
-            )
+            }
             
-            payment = Payment.create(payment_data)
+            payment = await self.client.create_payment(payment_data, idempotence_key=payment_id)
             
             # Сохранение в БД
             db = SessionLocal()
@@ -100,12 +103,13 @@ class YooKassaService:
                     currency=currency,
                     status="pending",
                     payment_system="yookassa",
-                    external_id=payment.id,
+                    external_id=payment["id"],
                     description=description,
                     created_at=datetime.now()
                 )
                 
                 db.add(db_payment)
+                stats_store.record(db, "yookassa", subscription_plan(amount)[0], currency, payments_created=1)
                 db.commit()
                 db.refresh(db_payment)
                 
@@ -113,9 +117,9 @@ class YooKassaService:
                 
                 return {
                     "payment_id": payment_id,
-                    "external_id": payment.id,
+                    "external_id": payment["id"],
                     "status": "pending",
-                    "confirmation_url": payment.confirmation.confirmation_url,
+                    "confirmation_url": payment["confirmation"]["confirmation_url"],
                     "amount": amount,
                     "currency": currency,
                     "created_at": db_payment.created_at.isoformat()
@@ -128,179 +132,131 @@ class YooKassaService:
             logger.error(f"Ошибка создания платежа: {e}")
             raise
     
-    async def process_webhook(self, webhook_data: Dict[str, Any]) -> bool:
-        """Обработка webhook от YooKassa"""
+    async def process_webhook(self, webhook: VerifiedWebhook) -> bool:
+        """Прием webhook от YooKassa: запись в inbox и немедленный ответ
+        
+        Подпись уже проверена зависимостью verified_webhook по сырым
+        байтам; в inbox сохраняется то же тело без повторной сериализации.
+        """
         try:
-            # Проверка подписи webhook
-            if not self._verify_webhook_signature(webhook_data):
-                logger.warning("Неверная подпись webhook YooKassa")
-                return False
-            
             # Создание объекта уведомления
-            notification = WebhookNotification(webhook_data)
-            
-            if notification.event == WebhookNotificationEventType.PAYMENT_SUCCEEDED:
-                await self._handle_payment_succeeded(notification.object)
-            elif notification.event == WebhookNotificationEventType.PAYMENT_CANCELED:
-                await self._handle_payment_canceled(notification.object)
-            elif notification.event == WebhookNotificationEventType.PAYMENT_WAITING_FOR_CAPTURE:
-                await self._handle_payment_waiting(notification.object)
+            notification = WebhookNotification(webhook.payload)
+            external_id = notification.object.id
             
+            # Одно и то же событие платежа YooKassa может доставить несколько раз
+            await webhook_inbox.ingest(
+                "yookassa",
+                f"{notification.event}:{external_id}",
+                notification.event,
+                external_id,
+                webhook.body
+            )
             return True
             
         except Exception as e:
             logger.error(f"Ошибка обработки webhook YooKassa: {e}")
             return False
     
-    def _verify_webhook_signature(self, webhook_data: Dict[str, Any]) -> bool:
-        """Проверка подписи webhook"""
-        try:
-            # Получение подписи из заголовков
-            signature = webhook_data.get("signature")
-            if not signature:
-                return False
-            
-            # Проверка подписи
-            expected_signature = hmac.new(
-                self.webhook_secret.encode(),
-                json.dumps(webhook_data, sort_keys=True).encode(),
-                hashlib.sha256
-            ).hexdigest()
-            
-            return hmac.compare_digest(signature, expected_signature)
-            
-        except Exception as e:
-            logger.error(f"Ошибка проверки подписи webhook: {e}")
-            return False
+    def apply_event(self, db, provider: str, event_type: str, webhook_data: Dict[str, Any]):
+        """Применение события из inbox в транзакции платежа (коммит делает inbox)"""
+        payment_data = webhook_data["object"]
+        if event_type == WebhookNotificationEventType.PAYMENT_SUCCEEDED:
+            self._handle_payment_succeeded(db, payment_data)
+        elif event_type == WebhookNotificationEventType.PAYMENT_CANCELED:
+            self._handle_payment_canceled(db, payment_data)
+        elif event_type == WebhookNotificationEventType.PAYMENT_WAITING_FOR_CAPTURE:
+            self._handle_payment_waiting(db, payment_data)
+    
+    @staticmethod
+    def _find_payment(db, external_id: str):
+        """Платеж с блокировкой строки до конца транзакции"""
+        payment = db.query(PaymentModel).filter(
+            PaymentModel.external_id == external_id
+        ).with_for_update().first()
+        if not payment:
+            # Уведомление могло опередить запись платежа: inbox повторит позже
+            raise LookupError(f"Платеж {external_id} не найден в БД")
+        return payment
     
-    async def _handle_payment_succeeded(self, payment_data: Dict[str, Any]):
+    def _handle_payment_succeeded(self, db, payment_data: Dict[str, Any]):
         """Обработка успешного платежа"""
-        try:
-            external_id = payment_data["id"]
-            amount = float(payment_data["amount"]["value"])
-            currency = payment_data["amount"]["currency"]
-            metadata = payment_data.get("metadata", {})
-            user_id = int(metadata.get("user_id"))
-            
-            db = SessionLocal()
-            try:
-                # Поиск платежа в БД
-                payment = db.query(PaymentModel).filter(
-                    PaymentModel.external_id == external_id
-                ).first()
-                
-                if not payment:
-                    logger.error(f"Платеж {external_id} не найден в БД")
-                    return
-                
-                # Обновление статуса платежа
-                payment.status = "completed"
-                payment.completed_at = datetime.now()
-                payment.amount = amount
-                payment.currency = currency
-                
-                db.commit()
-                
-                # Создание подписки
-                await self._create_subscription(payment.user_id, amount, currency)
-                
-                logger.info(f"Платеж {payment.payment_id} успешно обработан")
-                
-            finally:
-                db.close()
-                
-        except Exception as e:
-            logger.error(f"Ошибка обработки успешного платежа: {e}")
+        payment = self._find_payment(db, payment_data["id"])
+        if payment.status == "completed":
+            logger.info(f"Платеж {payment.payment_id} уже обработан")
+            return
+        
+        amount = float(payment_data["amount"]["value"])
+        currency = payment_data["amount"]["currency"]
+        
+        # Обновление статуса платежа
+        payment.status = "completed"
+        payment.completed_at = datetime.now()
+        payment.amount = amount
+        payment.currency = currency
+        
+        # Подписка и счетчики статистики меняются в той же транзакции, что
+        # и статус платежа, поэтому учитываются ровно один раз
+        plan = self._create_subscription(db, payment.user_id, amount, currency)
+        stats_store.record(
+            db, "yookassa", plan, currency,
+            payments_completed=1, subscriptions_created=1, revenue=amount
+        )
+        
+        logger.info(f"Платеж {payment.payment_id} успешно обработан")
     
-    async def _handle_payment_canceled(self, payment_data: Dict[str, Any]):
+    def _handle_payment_canceled(self, db, payment_data: Dict[str, Any]):
         """Обработка отмененного платежа"""
-        try:
-            external_id = payment_data["id"]
-            
-            db = SessionLocal()
-            try:
-                payment = db.query(PaymentModel).filter(
-                    PaymentModel.external_id == external_id
-                ).first()
-                
-                if payment:
-                    payment.status = "canceled"
-                    payment.canceled_at = datetime.now()
-                    db.commit()
-                    
-                    logger.info(f"Платеж {payment.payment_id} отменен")
-                
-            finally:
-                db.close()
-                
-        except Exception as e:
-            logger.error(f"Ошибка обработки отмененного платежа: {e}")
+        payment = self._find_payment(db, payment_data["id"])
+        if payment.status == "completed":
+            logger.warning(f"Отмена уже оплаченного платежа {payment.payment_id} пропущена")
+            return
+        
+        if payment.status == "canceled":
+            return
+        
+        payment.status = "canceled"
+        payment.canceled_at = datetime.now()
+        stats_store.record(
+            db, "yookassa", subscription_plan(payment.amount)[0], payment.currency, payments_canceled=1
+        )
+        logger.info(f"Платеж {payment.payment_id} отменен")
     
-    async def _handle_payment_waiting(self, payment_data: Dict[str, Any]):
+    def _handle_payment_waiting(self, db, payment_data: Dict[str, Any]):
         """Обработка платежа в ожидании"""
-        try:
-            external_id = payment_data["id"]
-            
-            db = SessionLocal()
-            try:
-                payment = db.query(PaymentModel).filter(
-                    PaymentModel.external_id == external_id
-                ).first()
-                
-                if payment:
-                    payment.status = "waiting"
-                    db.commit()
-                    
-                    logger.info(f"Платеж {payment.payment_id} в ожидании")
-                
-            finally:
-                db.close()
-                
-        except Exception as e:
-            logger.error(f"Ошибка обработки платежа в ожидании: {e}")
+        payment = self._find_payment(db, payment_data["id"])
+        if payment.status != "pending":
+            return
+        
+        payment.status = "waiting"
+        logger.info(f"Платеж {payment.payment_id} в ожидании")
     
-    async def _create_subscription(self, user_id: int, amount: float, currency: str):
-        """Создание подписки после успешного платежа"""
-        try:
-            db = SessionLocal()
-            try:
-                # Определение типа подписки по сумме
-                if amount >= 2000:
-                    subscription_type = "yearly"
-                    duration_days = 365
-                else:
-                    subscription_type = "monthly"
-                    duration_days = 30
-                
-                # Создание подписки
-                subscription = Subscription(
-                    user_id=user_id,
-                    subscription_type=subscription_type,
-                    status="active",
-                    start_date=datetime.now(),
-                    end_date=datetime.now() + timedelta(days=duration_days),
-                    amount=amount,
-                    currency=currency,
-                    created_at=datetime.now()
-                )
-                
-                db.add(subscription)
-                
-                # Обновление статуса пользователя
-                user = db.query(User).filter(User.id == user_id).first()
-                if user:
-                    user.is_premium = True
-                    user.updated_at = datetime.now()
-                
-                db.commit()
-                
-                logger.info(f"Создана подписка для пользователя {user_id}")
-                
-            finally:
-                db.close()
-                
-        except Exception as e:
-            logger.error(f"Ошибка создания подписки: {e}")
+    def _create_subscription(self, db, user_id: int, amount: float, currency: str) -> str:
+        """Создание подписки после успешного платежа; возвращает тариф"""
+        # Определение типа подписки по сумме
+        subscription_type, duration_days = subscription_plan(amount)
+        
+        # Создание подписки
+        subscription = Subscription(
+            user_id=user_id,
+            subscription_type=subscription_type,
+            status="active",
+            start_date=datetime.now(),
+            end_date=datetime.now() + timedelta(days=duration_days),
+            amount=amount,
+            currency=currency,
+            created_at=datetime.now()
+        )
+        
+        db.add(subscription)
+        
+        # Обновление статуса пользователя
+        user = db.query(User).filter(User.id == user_id).first()
+        if user:
+            user.is_premium = True
+            user.updated_at = datetime.now()
+        
+        logger.info(f"Создана подписка для пользователя {user_id}")
+        return subscription_type
     
     async def get_payment_status(self, payment_id: str) -> Dict[str, Any]:
         """Получение статуса платежа"""
@@ -348,11 +304,16 @@ class YooKassaService:
                 
                 # Отмена в YooKassa
                 if payment.external_id:
-                    Payment.cancel(payment.external_id)
+                    await self.client.cancel_payment(
+                        payment.external_id, idempotence_key=f"cancel-{payment_id}"
+                    )
                 
                 # Обновление в БД
                 payment.status = "canceled"
                 payment.canceled_at = datetime.now()
+                stats_store.record(
+                    db, "yookassa", subscription_plan(payment.amount)[0], payment.currency, payments_canceled=1
+                )
                 db.commit()
                 
                 logger.info(f"Платеж {payment_id} отменен")
@@ -1,18 +1,21 @@
 import asyncio
 import logging
 import os
-from aiogram import Bot, Dispatcher
+from aiogram import Bot
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Update
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiohttp import web
 
 from app.config import settings
+from app.dispatcher import BotDispatcher, UpdateDeduplicator, UpdateQueue, update_chat_id
 from app.handlers import start, profile, configs, subscription, referral, support, url
 from app.middlewares import auth, throttling, logging_middleware
-from app.services.user_service import UserService
+from app.services.user_service import user_service
 from app.services.payment_service import PaymentService
+from app.services.usage_service import usage_service
+from app.services.fsm_storage import create_fsm_storage, create_redis
 
 # Настройка логирования
 logging.basicConfig(
@@ -27,12 +30,25 @@ bot = Bot(
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 
-# Создание диспетчера с MemoryStorage для Vercel
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+# Redis для FSM и дедупликации обновлений; FSM_STORAGE=memory - без Redis
+redis_client = create_redis()
+
+# Создание диспетчера: состояние FSM и учет update_id общие для всех воркеров
+storage = create_fsm_storage(redis_client)
+dp = BotDispatcher(storage=storage, deduplicator=UpdateDeduplicator(redis_client))
+
+# Фоновая обработка обновлений webhook (WEBHOOK_MODE=queue)
+update_queue = UpdateQueue(dp, bot)
+# Дообработка принятых обновлений при остановке: setup_application вызывает
+# shutdown диспетчера у любого приложения, в том числе модульного для Vercel
+dp.shutdown.register(update_queue.stop)
 
 # Регистрация middleware
-dp.message.middleware(throttling.ThrottlingMiddleware())
+throttling_middleware = throttling.ThrottlingMiddleware(
+    redis=redis_client if settings.THROTTLE_BACKEND == "redis" else None
+)
+dp.message.middleware(throttling_middleware)
+dp.callback_query.middleware(throttling_middleware)
 dp.message.middleware(auth.AuthMiddleware())
 dp.message.middleware(logging_middleware.LoggingMiddleware())
 
@@ -46,10 +62,9 @@ dp.include_router(support.router)
 dp.include_router(url.router)
 
 # Инициализация сервисов
-user_service = UserService()
 payment_service = PaymentService()
 
-async def on_startup():
+async def on_startup(app: web.Application):
     """Инициализация при запуске"""
     logger.info("Запуск Telegram Bot на Vercel...")
     
@@ -60,6 +75,9 @@ async def on_startup():
         secret_token=settings.WEBHOOK_SECRET
     )
     
+    if settings.WEBHOOK_MODE == "queue":
+        update_queue.start()
+    
     # Инициализация сервисов (упрощенная для Vercel)
     try:
         await user_service.initialize()
@@ -69,7 +87,7 @@ async def on_startup():
     
     logger.info(f"Bot запущен на Vercel. Webhook: {webhook_url}")
 
-async def on_shutdown():
+async def on_shutdown(app: web.Application):
     """Очистка при остановке"""
     logger.info("Остановка Telegram Bot...")
     
@@ -83,6 +101,7 @@ async def on_shutdown():
     try:
         await user_service.cleanup()
         await payment_service.cleanup()
+        await usage_service.cleanup()
     except Exception as e:
         logger.warning(f"Ошибка очистки сервисов: {e}")
     
@@ -107,9 +126,16 @@ async def webhook_handler(request):
                 logger.warning("Неверный секретный токен webhook")
                 return web.Response(status=403)
         
-        # Обработка обновления
-        await dp.feed_update(bot, data)
+        update = Update.model_validate(data, context={"bot": bot})
+        
+        if settings.WEBHOOK_MODE != "queue":
+            await dp.feed_update(bot, update)
+            return web.Response(text="OK")
         
+        # Ответ сразу, обработка в воркере шарда чата
+        update_queue.start()
+        if not update_queue.enqueue(update, update_chat_id(data)):
+            return web.Response(status=503, headers={"Retry-After": "1"})
         return web.Response(text="OK")
         
     except Exception as e:
@@ -138,7 +164,8 @@ async def health_check(request):
     """Health check endpoint"""
     try:
         # Проверка подключения к Redis
-        await redis_client.ping()
+        if redis_client is not None:
+            await redis_client.ping()
         
         # Проверка статуса бота
         bot_info = await bot.get_me()
@@ -147,6 +174,7 @@ async def health_check(request):
             "status": "healthy",
             "bot_username": bot_info.username,
             "bot_id": bot_info.id,
+            "update_queue": update_queue.get_metrics(),
             "timestamp": "2024-01-01T00:00:00Z"
         })
         
@@ -157,6 +185,10 @@ async def health_check(request):
             status=503
         )
 
+async def queue_metrics(request):
+    """Метрики очереди обновлений: глубина, задержка, отказы"""
+    return web.json_response(update_queue.get_metrics())
+
 def create_app():
     """Создание aiohttp приложения для Vercel"""
     app = web.Application()
@@ -167,6 +199,11 @@ def create_app():
     app.router.add_post("/api/payment/robokassa/webhook", payment_webhook_handler)
     app.router.add_post("/api/payment/crypto/webhook", payment_webhook_handler)
     app.router.add_get("/api/bot/health", health_check)
+    app.router.add_get("/api/bot/queue", queue_metrics)
+    
+    # Настройка приложения: shutdown диспетчера (дообработка очереди)
+    # регистрируется до закрытия сессии бота обработчиком webhook
+    setup_application(app, dp, bot=bot)
     
     # Настройка обработчика Telegram для Vercel
     webhook_handler_obj = SimpleRequestHandler(
@@ -176,9 +213,6 @@ def create_app():
     )
     webhook_handler_obj.register(app, path="/api/bot/webhook")
     
-    # Настройка приложения
-    setup_application(app, dp, bot=bot)
-    
     return app
 
 # Vercel handler
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from app.config import settings
+from app.services.fsm_storage import begin_update_scope, end_update_scope
+
+logger = logging.getLogger(__name__)
+
+class UpdateDeduplicator:
+    """Учет обработанных update_id с коротким TTL
+
+    Telegram повторяет обновление, если webhook ответил медленно или с
+    ошибкой. С Redis первая попытка занимает ключ SET NX EX на всех
+    воркерах сразу, без Redis используется LRU в памяти процесса.
+    """
+
+    def __init__(self, redis=None, ttl: int = settings.UPDATE_DEDUP_TTL, max_size: int = 100000):
+        self.redis = redis
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+
+    async def claim(self, bot_id: int, update_id: int) -> bool:
+        """True, если обновление пришло впервые"""
+        key = f"update:{bot_id}:{update_id}"
+        if self.redis is not None:
+            return bool(await self.redis.set(key, 1, nx=True, ex=self.ttl))
+
+        now = time.monotonic()
+        expires_at = self._seen.get(key)
+        if expires_at is not None and expires_at > now:
+            return False
+        self._seen[key] = now + self.ttl
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return True
+
+    async def release(self, bot_id: int, update_id: int):
+        """Снять отметку: повтор от Telegram будет обработан заново"""
+        key = f"update:{bot_id}:{update_id}"
+        if self.redis is not None:
+            await self.redis.delete(key)
+        else:
+            self._seen.pop(key, None)
+
+class BotDispatcher(Dispatcher):
+    """Диспетчер с дедупликацией обновлений и одним чтением FSM на обновление
+
+    Проверка update_id и область кэша FSM открываются в feed_update, то
+    есть раньше встроенных outer middleware aiogram: повтор отсекается до
+    обращения к хранилищу состояний, а FSMContextMiddleware и обработчик
+    делят одно чтение. Через feed_update проходят webhook и polling.
+    """
+
+    def __init__(self, *args: Any, deduplicator: UpdateDeduplicator, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.deduplicator = deduplicator
+
+    async def feed_update(self, bot: Bot, update: Update, **kwargs: Any) -> Any:
+        try:
+            first = await self.deduplicator.claim(bot.id, update.update_id)
+        except Exception as e:
+            # Недоступность Redis не должна останавливать обработку
+            logger.warning(f"Ошибка дедупликации обновления {update.update_id}: {e}")
+            first = True
+        if not first:
+            logger.info(f"Повторное обновление {update.update_id} пропущено")
+            return None
+
+        token = begin_update_scope()
+        try:
+            return await super().feed_update(bot, update, **kwargs)
+        except Exception:
+            try:
+                await self.deduplicator.release(bot.id, update.update_id)
+            except Exception as e:
+                logger.warning(f"Ошибка снятия отметки обновления {update.update_id}: {e}")
+            raise
+        finally:
+            end_update_scope(token)
+
+def update_chat_id(data: Dict[str, Any]) -> int:
+    """Чат обновления по сырому JSON, без разбора всей модели"""
+    for key, event in data.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        sender = event.get("from") or event.get("user")
+        if sender:
+            return sender["id"]
+    return 0
+
+class UpdateQueue:
+    """Очередь обновлений webhook с обработкой в фоне
+
+    Webhook отвечает Telegram сразу после проверки и постановки
+    обновления в очередь. Очередь разбита на UPDATE_QUEUE_WORKERS шардов
+    по chat_id, у каждого шарда один воркер, поэтому обновления одного
+    чата обрабатываются строго по порядку, а медленный обработчик
+    задерживает только свой шард. Переполненный шард отклоняет
+    обновление (webhook отвечает 503 и Telegram повторит его позже).
+    При остановке новые обновления не принимаются, а очередь дорабатывается
+    до конца в пределах UPDATE_QUEUE_DRAIN_TIMEOUT.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        workers: int = settings.UPDATE_QUEUE_WORKERS,
+        max_size: int = settings.UPDATE_QUEUE_SIZE
+    ):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.shard_size = max(1, max_size // self.workers)
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self.accepting = False
+        self.stopped = False
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.max_lag = 0.0
+        self._lag_total = 0.0
+
+    def start(self):
+        """Запуск воркеров; повторный вызов и вызов после stop ничего не делают"""
+        if self._tasks or self.stopped:
+            return
+        self._queues = [asyncio.Queue(maxsize=self.shard_size) for _ in range(self.workers)]
+        self._tasks = [
+            asyncio.create_task(self._worker(queue)) for queue in self._queues
+        ]
+        self.accepting = True
+        logger.info(f"Очередь обновлений запущена: {self.workers} воркеров по {self.shard_size}")
+
+    def enqueue(self, update: Update, chat_id: int) -> bool:
+        """Постановка обновления в шард чата; False - очередь заполнена или остановлена"""
+        if not self.accepting:
+            self.rejected += 1
+            return False
+        queue = self._queues[hash(chat_id) % self.workers]
+        try:
+            queue.put_nowait((update, time.monotonic()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logger.warning(f"Очередь обновлений заполнена, обновление {update.update_id} отклонено")
+            return False
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, queue.qsize())
+        return True
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            update, enqueued_at = await queue.get()
+            lag = time.monotonic() - enqueued_at
+            self._lag_total += lag
+            self.max_lag = max(self.max_lag, lag)
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                queue.task_done()
+
+    async def stop(self, timeout: float = settings.UPDATE_QUEUE_DRAIN_TIMEOUT):
+        """Остановка с дообработкой принятых обновлений"""
+        self.stopped = True
+        if not self._tasks:
+            return
+        self.accepting = False
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self._queues)), timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            left = sum(queue.qsize() for queue in self._queues)
+            logger.error(f"Очередь обновлений не дообработана за {timeout}с, осталось {left}")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info(f"Очередь обновлений остановлена, обработано {self.processed}")
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Глубина очереди, задержка и счетчики"""
+        depths = [queue.qsize() for queue in self._queues]
+        handled = self.processed + self.failed
+        return {
+            "accepting": self.accepting,
+            "workers": self.workers,
+            "capacity": self.shard_size * self.workers,
+            "depth": sum(depths),
+            "max_shard_depth": max(depths, default=0),
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_lag_ms": round(self._lag_total / handled * 1000, 1) if handled else 0.0,
+            "max_lag_ms": round(self.max_lag * 1000, 1)
+        }
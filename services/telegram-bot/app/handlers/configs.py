@@ -1,5 +1,25 @@
 from aiogram import Router
+from aiogram.types import Message
+from aiogram.filters import Command
+import logging
 
+from app.services.usage_service import usage_service
+from app.utils.formatters import format_traffic_usage
+
+logger = logging.getLogger(__name__)
 router = Router()
 
-# Пустые обработчики для совместимости
+@router.message(Command("usage"), flags={"throttling_key": "usage"})
+async def cmd_usage(message: Message):
+    """Обработчик команды /usage: трафик и остаток квоты"""
+    try:
+        usage = await usage_service.get_usage(message.from_user.id)
+        if usage is None:
+            await message.answer("❌ Не удалось получить статистику трафика. Попробуйте позже.")
+            return
+        
+        await message.answer(format_traffic_usage(usage))
+        
+    except Exception as e:
+        logger.error(f"Ошибка в cmd_usage: {e}")
+        await message.answer("❌ Произошла ошибка. Попробуйте позже.")
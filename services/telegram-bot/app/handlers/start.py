@@ -5,7 +5,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 import logging
 
-from app.services.user_service import UserService
+from app.services.user_service import user_service
 from app.keyboards.main import get_main_keyboard, get_start_keyboard, get_url_keyboard
 from app.schemas.user import UserCreate
 from app.utils.formatters import format_user_info
@@ -13,9 +13,6 @@ from app.utils.formatters import format_user_info
 logger = logging.getLogger(__name__)
 router = Router()
 
-# Инициализация сервиса
-user_service = UserService()
-
 class RegistrationStates(StatesGroup):
     """Состояния регистрации"""
     waiting_for_name = State()
@@ -69,7 +66,7 @@ async def cmd_start(message: Message, state: FSMContext):
             "❌ Произошла ошибка. Попробуйте позже или обратитесь в поддержку."
         )
 
-@router.callback_query(F.data == "register_user")
+@router.callback_query(F.data == "register_user", flags={"throttling_key": "registration"})
 async def process_registration(callback: CallbackQuery, state: FSMContext):
     """Обработка регистрации пользователя"""
     try:
@@ -98,7 +95,7 @@ async def process_registration(callback: CallbackQuery, state: FSMContext):
             # Очистка состояния
             await state.clear()
             
-            logger.info(f"Пользователь {user.telegram_id} успешно зарегистрирован")
+            logger.info(f"Пользователь {user['telegram_id']} успешно зарегистрирован")
         else:
             await callback.message.edit_text(
                 "❌ Ошибка регистрации. Попробуйте позже или обратитесь в поддержку."
@@ -130,6 +127,7 @@ async def cmd_help(message: Message):
 /profile - Информация о профиле
 /configs - Мои конфигурации
 /url - Получить URL конфигурации
+/usage - Трафик и остаток квоты
 /subscribe - Купить подписку
 /referral - Реферальная программа
 /support - Связаться с поддержкой
@@ -180,19 +178,19 @@ async def cmd_profile(message: Message):
         profile_text = f"""
 👤 <b>Ваш профиль</b>
 
-🆔 ID: {user.telegram_id}
-👤 Имя: {user.first_name or 'Не указано'}
-📱 Username: @{user.username or 'Не указано'}
-📅 Регистрация: {user.created_at.strftime('%d.%m.%Y')}
+🆔 ID: {user['telegram_id']}
+👤 Имя: {user['first_name'] or 'Не указано'}
+📱 Username: @{user['username'] or 'Не указано'}
+📅 Регистрация: {user['created_at'].strftime('%d.%m.%Y')}
 
 📊 <b>Статистика:</b>
-🔹 Устройств: {user.device_count}/{user.max_devices}
-🔹 Статус: {'✅ Активен' if user.is_active else '❌ Заблокирован'}
-🔹 Премиум: {'✅ Да' if user.is_premium else '❌ Нет'}
+🔹 Устройств: {user['device_count']}/{user['max_devices']}
+🔹 Статус: {'✅ Активен' if user['is_active'] else '❌ Заблокирован'}
+🔹 Премиум: {'✅ Да' if user['is_premium'] else '❌ Нет'}
 
 💳 <b>Подписка:</b>
-🔹 Статус: {'✅ Активна' if user.is_premium else '❌ Неактивна'}
-🔹 Последний вход: {user.last_seen.strftime('%d.%m.%Y %H:%M') if user.last_seen else 'Никогда'}
+🔹 Статус: {'✅ Активна' if user['is_premium'] else '❌ Неактивна'}
+🔹 Последний вход: {user['last_seen'].strftime('%d.%m.%Y %H:%M') if user['last_seen'] else 'Никогда'}
         """
         
         await message.answer(profile_text, reply_markup=get_main_keyboard())
@@ -299,7 +297,7 @@ async def main_menu(callback: CallbackQuery):
         if user:
             await callback.message.edit_text(
                 f"🏠 <b>Главное меню</b>\n\n"
-                f"Добро пожаловать, {user.first_name or 'Пользователь'}!\n\n"
+                f"Добро пожаловать, {user['first_name'] or 'Пользователь'}!\n\n"
                 f"Выберите действие:",
                 reply_markup=get_main_keyboard()
             )
@@ -5,15 +5,13 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 import logging
 
-from app.services.user_service import UserService
+from app.services.user_service import user_service
 from app.keyboards.main import get_url_keyboard, get_main_keyboard
 from app.utils.formatters import format_user_info
+from shared.share_links import render_vless_url
 
 logger = logging.getLogger(__name__)
-router = Router()
-
-# Инициализация сервиса
-user_service = UserService()
+router = Router(name="url")
 
 class URLStates(StatesGroup):
     """Состояния для работы с URL"""
@@ -208,7 +206,7 @@ async def get_desktop_url(callback: CallbackQuery):
             "❌ Ошибка получения конфигурации. Попробуйте позже."
         )
 
-@router.callback_query(F.data == "get_config_file")
+@router.callback_query(F.data == "get_config_file", flags={"throttling_key": "config"})
 async def get_config_file(callback: CallbackQuery):
     """Получение файла конфигурации"""
     try:
@@ -261,9 +259,15 @@ async def generate_user_vless_url(user) -> str:
         public_key = "-TL01QWTd3nVXR4qdfnAea5JgUcEzwa_qvpw9KGtTRc"
         server_name = "www.microsoft.com"
         
-        vless_url = f"vless://{uuid}@{server_ip}:{port}?encryption=none&security=reality&sni={server_name}&pbk={public_key}&fp=chrome&type=tcp&headerType=none&flow=#XrayVPN-{user['telegram_id']}"
-        
-        return vless_url
+        return render_vless_url(
+            "default",
+            host=server_ip,
+            port=port,
+            public_key=public_key,
+            sni=server_name,
+            client_id=uuid,
+            remark=f"XrayVPN-{user['telegram_id']}"
+        )
         
     except Exception as e:
         logger.error(f"Ошибка генерации VLESS URL: {e}")
@@ -1,15 +1,187 @@
 import logging
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
 from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
 from aiogram.types import Message, CallbackQuery
 
+from app.config import settings
+
 logger = logging.getLogger(__name__)
 
+class Limit(NamedTuple):
+    """Лимит: token bucket (rate в секунду, burst) и скользящее окно"""
+    rate: float
+    burst: float
+    window: float
+    limit: int
+
+DEFAULT_LIMITS = {
+    "default": Limit(rate=1.0, burst=5, window=60, limit=30),
+    "callback": Limit(rate=2.0, burst=10, window=60, limit=60),
+    # Генерация конфигураций и QR кодов
+    "config": Limit(rate=0.1, burst=2, window=300, limit=5),
+    "registration": Limit(rate=0.2, burst=2, window=300, limit=5),
+    "usage": Limit(rate=0.2, burst=3, window=60, limit=10)
+}
+
+def parse_limits(spec: str) -> Dict[str, Limit]:
+    """THROTTLE_LIMITS: "ключ=rate:burst:window:limit;..." поверх значений по умолчанию"""
+    limits = dict(DEFAULT_LIMITS)
+    for item in filter(None, (part.strip() for part in spec.split(";"))):
+        name, values = item.split("=", 1)
+        rate, burst, window, limit = values.split(":")
+        limits[name.strip()] = Limit(float(rate), float(burst), float(window), int(limit))
+    return limits
+
+def _hit(state: list, limit: Limit, now: float) -> float:
+    """Один запрос по состоянию [tokens, ts, window_start, current, previous]
+
+    Возвращает 0, если запрос разрешен, иначе секунды до следующей попытки.
+    Скользящее окно считается по двум фиксированным окнам с весом
+    предыдущего, без хранения отметок времени запросов.
+    """
+    tokens, updated, window_start, current, previous = state
+    tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+    if now >= window_start + limit.window:
+        previous = current if now < window_start + 2 * limit.window else 0
+        current = 0
+        window_start = now - now % limit.window
+    estimate = previous * (1 - (now - window_start) / limit.window) + current
+
+    retry_after = (1 - tokens) / limit.rate if tokens < 1 else 0.0
+    if estimate + 1 > limit.limit:
+        retry_after = max(retry_after, window_start + limit.window - now)
+    if not retry_after:
+        tokens -= 1
+        current += 1
+    state[:] = [tokens, now, window_start, current, previous]
+    return retry_after
+
+class MemoryRateLimiter:
+    """Таблица лимитов в памяти процесса с вытеснением LRU"""
+
+    def __init__(self, max_size: int = settings.THROTTLE_TABLE_SIZE):
+        self.max_size = max_size
+        self._states: "OrderedDict[str, list]" = OrderedDict()
+
+    async def hit(self, key: str, limit: Limit) -> float:
+        now = time.monotonic()
+        state = self._states.get(key)
+        if state is None:
+            state = [limit.burst, now, now - now % limit.window, 0, 0]
+            self._states[key] = state
+            if len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+        else:
+            self._states.move_to_end(key)
+        return _hit(state, limit, now)
+
+# Тот же алгоритм, что и _hit, атомарно на стороне Redis
+RATE_LIMIT_SCRIPT = """
+local rate, burst, window, limit = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local now = tonumber(ARGV[5])
+local s = redis.call('HMGET', KEYS[1], 't', 'ts', 'ws', 'c', 'p')
+local tokens = tonumber(s[1]) or burst
+local updated = tonumber(s[2]) or now
+local ws = tonumber(s[3]) or (now - now % window)
+local current = tonumber(s[4]) or 0
+local previous = tonumber(s[5]) or 0
+tokens = math.min(burst, tokens + (now - updated) * rate)
+if now >= ws + window then
+  if now < ws + 2 * window then previous = current else previous = 0 end
+  current = 0
+  ws = now - now % window
+end
+local estimate = previous * (1 - (now - ws) / window) + current
+local retry = 0
+if tokens < 1 then retry = (1 - tokens) / rate end
+if estimate + 1 > limit then retry = math.max(retry, ws + window - now) end
+if retry == 0 then
+  tokens = tokens - 1
+  current = current + 1
+end
+redis.call('HSET', KEYS[1], 't', tostring(tokens), 'ts', tostring(now), 'ws', tostring(ws), 'c', current, 'p', previous)
+redis.call('EXPIRE', KEYS[1], math.ceil(2 * window))
+return tostring(retry)
+"""
+
+class RedisRateLimiter:
+    """Общие для всех воркеров лимиты: один EVALSHA на запрос"""
+
+    def __init__(self, redis, fallback: Optional[MemoryRateLimiter] = None):
+        self.redis = redis
+        self.script = redis.register_script(RATE_LIMIT_SCRIPT)
+        self.fallback = fallback or MemoryRateLimiter()
+
+    async def hit(self, key: str, limit: Limit) -> float:
+        try:
+            retry_after = await self.script(
+                keys=[f"throttle:{key}"],
+                args=[limit.rate, limit.burst, limit.window, limit.limit, time.time()]
+            )
+            return float(retry_after)
+        except Exception as e:
+            # Без Redis лимиты продолжают работать в пределах воркера
+            logger.warning(f"Ошибка Redis лимитера, используется память: {e}")
+            return await self.fallback.hit(key, limit)
+
 class ThrottlingMiddleware(BaseMiddleware):
-    """Упрощенный middleware для ограничения частоты запросов"""
-    
+    """Ограничение частоты запросов по пользователю и обработчику
+
+    Ключ лимита: флаг обработчика throttling_key, иначе имя роутера, иначе
+    тип события (default для сообщений, callback для кнопок). Отказ
+    стоит одного ответа: для кнопки - всплывающее уведомление, для
+    сообщения - одно предупреждение за период ожидания.
+    """
+
+    def __init__(self, redis=None, limits: Optional[Dict[str, Limit]] = None):
+        self.limits = limits or parse_limits(settings.THROTTLE_LIMITS)
+        self.limiter = RedisRateLimiter(redis) if redis is not None else MemoryRateLimiter()
+        self._warned: "OrderedDict[int, float]" = OrderedDict()
+
+    def _scope(self, event, data) -> str:
+        scope = get_flag(data, "throttling_key")
+        if scope:
+            return scope
+        router = data.get("event_router")
+        if router is not None and router.name in self.limits:
+            return router.name
+        return "callback" if isinstance(event, CallbackQuery) else "default"
+
     async def __call__(self, handler, event, data):
-        # Простая проверка без Redis
-        return await handler(event, data)
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        scope = self._scope(event, data)
+        limit = self.limits.get(scope, self.limits["default"])
+        retry_after = await self.limiter.hit(f"{user.id}:{scope}", limit)
+        if not retry_after:
+            return await handler(event, data)
+
+        logger.info(f"Ограничение частоты: пользователь {user.id}, {scope}, повтор через {retry_after:.1f}с")
+        await self._slow_down(event, user.id, retry_after)
+        return None
+
+    async def _slow_down(self, event, user_id: int, retry_after: float):
+        text = f"⏳ Слишком часто. Попробуйте через {max(1, round(retry_after))} с."
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(text)
+                return
+            now = time.monotonic()
+            if self._warned.get(user_id, 0) > now:
+                return
+            self._warned[user_id] = now + retry_after
+            self._warned.move_to_end(user_id)
+            if len(self._warned) > settings.THROTTLE_TABLE_SIZE:
+                self._warned.popitem(last=False)
+            if isinstance(event, Message):
+                await event.answer(text)
+        except Exception as e:
+            logger.warning(f"Ошибка ответа об ограничении частоты: {e}")
 
 class AuthMiddleware(BaseMiddleware):
     """Упрощенный middleware для аутентификации"""
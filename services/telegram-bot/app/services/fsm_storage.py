@@ -0,0 +1,121 @@
+import json
+import logging
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Состояния, прочитанные в рамках текущего обновления: ключ -> (state, data)
+_update_scope: ContextVar[Optional[Dict[str, Tuple[Optional[str], Dict[str, Any]]]]] = ContextVar(
+    "fsm_update_scope", default=None
+)
+
+
+def begin_update_scope():
+    """Начало обработки обновления: чтения FSM кэшируются до его конца"""
+    return _update_scope.set({})
+
+
+def end_update_scope(token):
+    """Конец обработки обновления"""
+    _update_scope.reset(token)
+
+
+class RedisFSMStorage(BaseStorage):
+    """FSM хранилище в Redis: состояние и данные в одном hash
+
+    Чтение забирает оба поля одним HMGET и кэширует их до конца обработки
+    обновления (см. begin_update_scope), поэтому get_state в middleware
+    и get_data в обработчике стоят одного обращения к Redis. Запись идет
+    конвейером вместе с продлением TTL. Хранилище общее для всех
+    webhook воркеров.
+    """
+
+    def __init__(self, redis, state_ttl: int = settings.FSM_STATE_TTL, prefix: str = "fsm"):
+        self.redis = redis
+        self.state_ttl = state_ttl
+        self.prefix = prefix
+
+    def _key(self, key: StorageKey) -> str:
+        parts = [self.prefix, str(key.bot_id), str(key.chat_id)]
+        if key.thread_id:
+            parts.append(str(key.thread_id))
+        parts += [str(key.user_id), key.destiny]
+        return ":".join(parts)
+
+    async def _read(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+        redis_key = self._key(key)
+        scope = _update_scope.get()
+        if scope is not None and redis_key in scope:
+            return scope[redis_key]
+
+        state, data = await self.redis.hmget(redis_key, "state", "data")
+        if isinstance(state, bytes):
+            state = state.decode()
+        value = (state, json.loads(data) if data else {})
+        if scope is not None:
+            scope[redis_key] = value
+        return value
+
+    async def _write(self, key: StorageKey, field: str, value: Optional[str]):
+        redis_key = self._key(key)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if value is None:
+                pipe.hdel(redis_key, field)
+            else:
+                pipe.hset(redis_key, field, value)
+                if self.state_ttl:
+                    pipe.expire(redis_key, self.state_ttl)
+            await pipe.execute()
+
+    def _remember(self, key: StorageKey, state: Any = ..., data: Any = ...):
+        scope = _update_scope.get()
+        redis_key = self._key(key)
+        if scope is None or redis_key not in scope:
+            return
+        cached_state, cached_data = scope[redis_key]
+        scope[redis_key] = (
+            cached_state if state is ... else state,
+            cached_data if data is ... else data
+        )
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self._write(key, "state", value)
+        self._remember(key, state=value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._read(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._write(key, "data", json.dumps(data, ensure_ascii=False) if data else None)
+        self._remember(key, data=dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._read(key))[1])
+
+    async def close(self) -> None:
+        await self.redis.close()
+
+
+def create_redis():
+    """Клиент Redis для FSM и дедупликации или None в режиме памяти"""
+    if settings.FSM_STORAGE != "redis":
+        return None
+    from redis.asyncio import Redis
+    return Redis.from_url(settings.REDIS_URL)
+
+
+def create_fsm_storage(redis=None) -> BaseStorage:
+    """FSM хранилище по FSM_STORAGE: redis или memory (тесты, один процесс)"""
+    if redis is None:
+        logger.info("FSM хранилище в памяти процесса")
+        return MemoryStorage()
+    logger.info("FSM хранилище в Redis")
+    return RedisFSMStorage(redis)
@@ -0,0 +1,53 @@
+import logging
+import time
+from typing import Optional, Dict, Any, Tuple
+
+import httpx
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+class UsageService:
+    """Трафик пользователя из xray-manager с коротким кэшем
+
+    Повторные /usage в пределах USAGE_CACHE_TTL отвечают из памяти бота,
+    поэтому ни xray-manager, ни PostgreSQL не получают лишних запросов.
+    """
+    
+    def __init__(self, base_url: str = settings.XRAY_MANAGER_URL, ttl: int = settings.USAGE_CACHE_TTL):
+        self.base_url = base_url.rstrip("/")
+        self.ttl = ttl
+        self._cache: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    async def cleanup(self):
+        """Закрытие HTTP клиента"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def get_usage(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        """Трафик конфигураций пользователя или None при ошибке"""
+        cached = self._cache.get(telegram_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=5.0)
+        try:
+            response = await self._client.get(f"/api/v1/configs/usage/{telegram_id}")
+            response.raise_for_status()
+            usage = response.json()
+        except Exception as e:
+            logger.error(f"Ошибка получения трафика пользователя {telegram_id}: {e}")
+            return None
+        
+        if len(self._cache) > 10000:
+            now = time.monotonic()
+            self._cache = {key: value for key, value in self._cache.items() if value[0] > now}
+        self._cache[telegram_id] = (time.monotonic() + self.ttl, usage)
+        return usage
+
+# Глобальный экземпляр сервиса трафика
+usage_service = UsageService()
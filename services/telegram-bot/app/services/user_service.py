@@ -1,42 +1,207 @@
+import asyncio
 import logging
-from typing import Optional, Dict, Any
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple, Union
+
+from app.config import settings
+from app.schemas.user import UserCreate
 
 logger = logging.getLogger(__name__)
 
+USER_COLUMNS = (
+    "id, telegram_id, username, first_name, last_name, is_active, is_premium, "
+    "max_devices, device_count, created_at, updated_at, last_seen"
+)
+
+# Поля, которые можно менять через update_user
+UPDATABLE_FIELDS = {
+    "username", "first_name", "last_name", "is_active", "is_premium",
+    "max_devices", "device_count", "last_seen"
+}
+
 class UserService:
-    """Упрощенный сервис пользователей для Vercel"""
+    """Пользователи из таблицы users с кэшем чтения
+
+    get_user_by_telegram_id вызывается почти на каждое обновление, поэтому
+    ответы кэшируются в памяти процесса на USER_CACHE_TTL, а отсутствие
+    пользователя - на USER_NEGATIVE_CACHE_TTL. Одновременные промахи по
+    одному telegram_id ждут один запрос к базе. Любая запись через сервис
+    сбрасывает запись кэша.
+    """
     
-    def __init__(self):
-        self.users = {}  # Простое хранилище в памяти
+    def __init__(
+        self,
+        database_url: str = settings.DATABASE_URL,
+        ttl: int = settings.USER_CACHE_TTL,
+        negative_ttl: int = settings.USER_NEGATIVE_CACHE_TTL,
+        max_size: int = settings.USER_CACHE_SIZE
+    ):
+        self.database_url = database_url
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._pool = None
+        self._pool_lock = asyncio.Lock()
+        # telegram_id -> (срок, пользователь или None)
+        self._cache: "OrderedDict[int, Tuple[float, Optional[Dict[str, Any]]]]" = OrderedDict()
+        self._loading: Dict[int, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
     
     async def initialize(self):
-        """Инициализация сервиса"""
-        logger.info("UserService инициализирован (Vercel режим)")
+        """Создание пула соединений"""
+        await self._get_pool()
+        logger.info("UserService инициализирован")
     
     async def cleanup(self):
-        """Очистка сервиса"""
+        """Закрытие пула соединений"""
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+        self._cache.clear()
         logger.info("UserService очищен")
     
+    async def _get_pool(self):
+        if self._pool is None:
+            async with self._pool_lock:
+                if self._pool is None:
+                    import asyncpg
+                    self._pool = await asyncpg.create_pool(
+                        self.database_url.replace("postgresql+asyncpg://", "postgresql://"),
+                        min_size=settings.DATABASE_POOL_MIN_SIZE,
+                        max_size=settings.DATABASE_POOL_MAX_SIZE
+                    )
+        return self._pool
+    
+    def _cache_get(self, telegram_id: int):
+        cached = self._cache.get(telegram_id)
+        if cached is None or cached[0] <= time.monotonic():
+            return False, None
+        return True, cached[1]
+    
+    def _cache_set(self, telegram_id: int, user: Optional[Dict[str, Any]]):
+        ttl = self.ttl if user is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        self._cache[telegram_id] = (time.monotonic() + ttl, user)
+        self._cache.move_to_end(telegram_id)
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+    
+    def invalidate(self, telegram_id: int):
+        """Сброс кэша пользователя"""
+        self._cache.pop(telegram_id, None)
+        # Чтение, начатое до записи, не должно вернуть старые данные в кэш
+        self._loading.pop(telegram_id, None)
+    
     async def get_user_by_telegram_id(self, telegram_id: int) -> Optional[Dict[str, Any]]:
         """Получение пользователя по Telegram ID"""
-        return self.users.get(telegram_id)
-    
-    async def create_user(self, user_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        """Создание пользователя"""
-        user = {
-            "telegram_id": user_data.get("telegram_id"),
-            "username": user_data.get("username"),
-            "first_name": user_data.get("first_name"),
-            "last_name": user_data.get("last_name"),
-            "max_devices": user_data.get("max_devices", 3),
-            "device_count": 0,
-            "is_active": True,
-            "is_premium": False,
-            "created_at": "2024-01-01T00:00:00Z",
-            "last_seen": "2024-01-01T00:00:00Z"
-        }
-        self.users[user_data["telegram_id"]] = user
+        found, user = self._cache_get(telegram_id)
+        if found:
+            self.hits += 1
+            return user
+        
+        loading = self._loading.get(telegram_id)
+        if loading is not None:
+            # wait не отменяет чужую загрузку при отмене ожидающего
+            await asyncio.wait({loading})
+            if not loading.cancelled():
+                return loading.result()
+            # Загрузка отменена: считаем это промахом и читаем сами
+            return await self.get_user_by_telegram_id(telegram_id)
+        
+        self.misses += 1
+        loading = asyncio.get_running_loop().create_future()
+        self._loading[telegram_id] = loading
+        try:
+            user = await self._fetch_user(telegram_id, loading)
+            loading.set_result(user)
+        except Exception as e:
+            # Ошибка базы не кэшируется: следующий запрос повторит чтение
+            logger.error(f"Ошибка получения пользователя {telegram_id}: {e}")
+            user = None
+            loading.set_result(None)
+        finally:
+            # При отмене загрузки ожидающие не должны зависнуть
+            if not loading.done():
+                loading.cancel()
+            if self._loading.get(telegram_id) is loading:
+                del self._loading[telegram_id]
+        return user
+    
+    async def _fetch_user(self, telegram_id: int, loading: asyncio.Future) -> Optional[Dict[str, Any]]:
+        pool = await self._get_pool()
+        row = await pool.fetchrow(
+            f"SELECT {USER_COLUMNS} FROM users WHERE telegram_id = $1", telegram_id
+        )
+        user = dict(row) if row is not None else None
+        if self._loading.get(telegram_id) is loading:
+            self._cache_set(telegram_id, user)
         return user
+    
+    async def create_user(self, user_data: Union[UserCreate, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Создание пользователя; повторная регистрация обновляет имя"""
+        if not isinstance(user_data, dict):
+            user_data = vars(user_data)
+        telegram_id = user_data["telegram_id"]
+        try:
+            pool = await self._get_pool()
+            row = await pool.fetchrow(
+                f"""
+                INSERT INTO users (
+                    telegram_id, username, first_name, last_name, max_devices,
+                    device_count, is_active, is_premium, created_at, updated_at, last_seen
+                )
+                VALUES ($1, $2, $3, $4, $5, 0, TRUE, FALSE, now(), now(), now())
+                ON CONFLICT (telegram_id) DO UPDATE SET
+                    username = EXCLUDED.username,
+                    first_name = EXCLUDED.first_name,
+                    last_name = EXCLUDED.last_name,
+                    updated_at = now(),
+                    last_seen = now()
+                RETURNING {USER_COLUMNS}
+                """,
+                telegram_id,
+                user_data.get("username"),
+                user_data.get("first_name"),
+                user_data.get("last_name"),
+                user_data.get("max_devices", 3)
+            )
+        except Exception as e:
+            logger.error(f"Ошибка создания пользователя {telegram_id}: {e}")
+            return None
+        finally:
+            self.invalidate(telegram_id)
+        return dict(row)
+    
+    async def update_user(self, telegram_id: int, **fields) -> Optional[Dict[str, Any]]:
+        """Обновление полей пользователя"""
+        unknown = set(fields) - UPDATABLE_FIELDS
+        if unknown:
+            raise ValueError(f"Неизвестные поля пользователя: {', '.join(sorted(unknown))}")
+        if not fields:
+            return await self.get_user_by_telegram_id(telegram_id)
+        
+        names = list(fields)
+        assignments = ", ".join(f"{name} = ${index}" for index, name in enumerate(names, start=2))
+        try:
+            pool = await self._get_pool()
+            row = await pool.fetchrow(
+                f"UPDATE users SET {assignments}, updated_at = now() "
+                f"WHERE telegram_id = $1 RETURNING {USER_COLUMNS}",
+                telegram_id, *(fields[name] for name in names)
+            )
+        except Exception as e:
+            logger.error(f"Ошибка обновления пользователя {telegram_id}: {e}")
+            return None
+        finally:
+            self.invalidate(telegram_id)
+        return dict(row) if row is not None else None
+    
+    def get_cache_stats(self) -> Dict[str, int]:
+        """Статистика кэша пользователей"""
+        return {"size": len(self._cache), "hits": self.hits, "misses": self.misses}
 
 class PaymentService:
     """Упрощенный сервис платежей для Vercel"""
@@ -56,3 +221,6 @@ class PaymentService:
         """Обработка webhook платежа"""
         logger.info(f"Обработка платежа: {data}")
         return True
+
+# Глобальный экземпляр сервиса пользователей
+user_service = UserService()
@@ -14,3 +14,34 @@ def format_user_info(user: Optional[Dict[str, Any]]) -> str:
 🔹 Статус: {'✅ Активен' if user.get('is_active') else '❌ Заблокирован'}
 🔹 Премиум: {'✅ Да' if user.get('is_premium') else '❌ Нет'}
     """
+
+def format_bytes(value: Optional[int]) -> str:
+    """Размер в удобных единицах"""
+    size = float(value or 0)
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.2f} ТБ"
+
+def format_traffic_usage(usage: Optional[Dict[str, Any]]) -> str:
+    """Форматирование трафика конфигураций пользователя"""
+    if not usage or not usage.get("configs"):
+        return "У вас пока нет конфигураций"
+    
+    lines = [
+        "📊 <b>Трафик</b>",
+        f"Всего: {format_bytes(usage.get('bytes_total'))}",
+        f"За сутки: {format_bytes(usage.get('bytes_last_24h'))}",
+        ""
+    ]
+    for config in usage["configs"]:
+        status = "✅" if config.get("status") == "active" else "⛔"
+        line = f"{status} <code>{config.get('config_id')}</code>: {format_bytes(config.get('bytes_total'))}"
+        if config.get("traffic_limit"):
+            line += (
+                f" из {format_bytes(config['traffic_limit'])}"
+                f" (осталось {format_bytes(config.get('bytes_remaining'))})"
+            )
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,61 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+import json
+import logging
+
+from app.config import settings
+from app.schemas import ConfigBulkCreate, ConfigRevoke
+from app.services.xray_service import xray_service
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+@router.post("/bulk")
+async def generate_configs_bulk(request: ConfigBulkCreate):
+    """Массовая генерация конфигураций с прогрессом в формате NDJSON"""
+    if len(request.user_ids) > settings.CONFIG_BULK_MAX_USERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Не более {settings.CONFIG_BULK_MAX_USERS} пользователей за запрос"
+        )
+
+    async def stream():
+        async for progress in xray_service.generate_configs_bulk(
+            request.user_ids,
+            server_id=request.server_id,
+            expires_at=request.expires_at
+        ):
+            yield json.dumps(progress, ensure_ascii=False, default=str) + "\n"
+
+    logger.info(f"Запущена массовая генерация конфигураций: {len(request.user_ids)} пользователей")
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@router.post("/revoke", response_model=dict)
+async def revoke_user_configs(request: ConfigRevoke):
+    """Отзыв активных конфигураций пользователей одним запросом"""
+    if len(request.user_ids) > settings.CONFIG_BULK_MAX_USERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Не более {settings.CONFIG_BULK_MAX_USERS} пользователей за запрос"
+        )
+    try:
+        revoked = await xray_service.revoke_user_configs(request.user_ids)
+    except Exception as e:
+        logger.error(f"Ошибка отзыва конфигураций: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка отзыва конфигураций")
+    logger.info(f"Отзыв конфигураций ({request.reason or 'без причины'}): {len(request.user_ids)} пользователей, {revoked} конфигураций")
+    return {"users": len(request.user_ids), "revoked": revoked}
+
+@router.get("/usage/{telegram_id}", response_model=dict)
+async def get_user_usage(telegram_id: int):
+    """Трафик конфигураций пользователя: итоги, сутки и остаток квоты"""
+    try:
+        return await xray_service.get_user_usage(telegram_id)
+    except Exception as e:
+        logger.error(f"Ошибка получения трафика пользователя {telegram_id}: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка получения трафика")
+
+@router.get("/expiry/status", response_model=dict)
+async def get_expiry_status():
+    """Очередь ближайших истечений конфигураций"""
+    return xray_service.expiry.get_status()
@@ -1,42 +1,81 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, insert, select, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+import base64
+import json
 import logging
 
-from app.database import get_db
+from app.config import settings
+from app.database import get_async_db
 from app.schemas import (
-    ServerCreate, ServerUpdate, ServerResponse, 
-    PaginationParams, PaginatedResponse, MessageResponse
+    ServerCreate, ServerBulkCreate, ServerUpdate, ServerResponse, 
+    PaginationParams, PaginatedResponse, MessageResponse, ServerStatus
 )
-from app.services.xray_service import XrayService
-from app.models import Server
+from app.services.id_allocator import server_ids
+from app.services.metrics_export import ENCODERS, EXPORT_MEDIA_TYPES, arrow_available
+from app.services.xray_service import xray_service
+from app.models import Server, Config
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-# Инициализация сервиса
-xray_service = XrayService()
+async def _get_server_by_server_id(db: AsyncSession, server_id: str) -> Optional[Server]:
+    """Поиск сервера по строковому идентификатору"""
+    result = await db.execute(select(Server).where(Server.server_id == server_id))
+    return result.scalars().first()
+
+def _encode_cursor(server: Server) -> str:
+    """Непрозрачный курсор по ключу сортировки (status, id)"""
+    payload = json.dumps([server.status, server.id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str) -> Tuple[str, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        status, id = json.loads(base64.urlsafe_b64decode(padded))
+        return str(status), int(id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
 
 @router.get("/", response_model=PaginatedResponse)
 async def get_servers(
     pagination: PaginationParams = Depends(),
-    status: Optional[str] = None,
-    db: Session = Depends(get_db)
+    status: Optional[ServerStatus] = None,
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Получить список серверов с пагинацией"""
+    """Получить список серверов с пагинацией
+    
+    С cursor используется keyset пагинация по (status, id), без него -
+    прежний режим page/size. Оба режима возвращают next_cursor.
+    """
     try:
-        query = db.query(Server)
+        query = select(Server)
         
         # Фильтрация по статусу
         if status:
-            query = query.filter(Server.status == status)
+            query = query.where(Server.status == status.value)
         
-        # Подсчет общего количества
-        total = query.count()
+        # Приблизительное количество из кэша по фильтру
+        total, cached = await xray_service.server_counts.get(
+            status.value if status else None,
+            lambda: db.scalar(select(func.count()).select_from(query.subquery()))
+        )
+        
+        # Пагинация: курсор или смещение
+        query = query.order_by(Server.status, Server.id)
+        if pagination.cursor:
+            query = query.where(tuple_(Server.status, Server.id) > _decode_cursor(pagination.cursor))
+        else:
+            query = query.offset((pagination.page - 1) * pagination.size)
+        result = await db.execute(query.limit(pagination.size + 1))
+        servers = result.scalars().all()
         
-        # Пагинация
-        offset = (pagination.page - 1) * pagination.size
-        servers = query.offset(offset).limit(pagination.size).all()
+        has_more = len(servers) > pagination.size
+        servers = servers[:pagination.size]
         
         # Преобразование в словари
         items = [ServerResponse.from_orm(server).dict() for server in servers]
@@ -44,19 +83,60 @@ async def get_servers(
         return PaginatedResponse(
             items=items,
             total=total,
-            page=pagination.page,
+            page=None if pagination.cursor else pagination.page,
             size=pagination.size,
-            pages=(total + pagination.size - 1) // pagination.size
+            pages=(total + pagination.size - 1) // pagination.size,
+            next_cursor=_encode_cursor(servers[-1]) if has_more else None,
+            total_is_approximate=cached
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка получения серверов: {e}")
         raise HTTPException(status_code=500, detail="Ошибка получения серверов")
 
+@router.get("/health/latency", response_model=dict)
+async def get_health_latency():
+    """Гистограммы латентности проверок здоровья"""
+    return xray_service.get_health_latency_stats()
+
+@router.post("/health/check", response_model=dict)
+async def check_servers_health():
+    """Запустить проверку здоровья всех серверов"""
+    try:
+        return await xray_service.check_all_servers_health()
+    except Exception as e:
+        logger.error(f"Ошибка проверки здоровья серверов: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка проверки здоровья серверов")
+
+@router.post("/telemetry/collect", response_model=dict)
+async def collect_telemetry():
+    """Запустить сбор телеметрии со всех узлов"""
+    try:
+        return await xray_service.collect_telemetry()
+    except Exception as e:
+        logger.error(f"Ошибка сбора телеметрии: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка сбора телеметрии")
+
+@router.get("/sync/status", response_model=dict)
+async def get_node_sync_status():
+    """Расхождения желаемых и примененных списков клиентов узлов"""
+    return xray_service.get_node_sync_status()
+
+@router.post("/sync", response_model=dict)
+async def sync_nodes():
+    """Применить накопленные изменения клиентов без ожидания debounce"""
+    try:
+        return await xray_service.node_sync.sync()
+    except Exception as e:
+        logger.error(f"Ошибка синхронизации узлов: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка синхронизации узлов")
+
 @router.get("/{server_id}", response_model=ServerResponse)
-async def get_server(server_id: str, db: Session = Depends(get_db)):
+async def get_server(server_id: str, db: AsyncSession = Depends(get_async_db)):
     """Получить информацию о сервере"""
     try:
-        server = db.query(Server).filter(Server.server_id == server_id).first()
+        server = await _get_server_by_server_id(db, server_id)
         if not server:
             raise HTTPException(status_code=404, detail="Сервер не найден")
         
@@ -71,15 +151,17 @@ async def get_server(server_id: str, db: Session = Depends(get_db)):
 async def create_server(
     server_data: ServerCreate,
     background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Создать новый сервер"""
     try:
         # Проверка существования сервера
-        existing_server = db.query(Server).filter(
-            Server.host == server_data.host,
-            Server.port == server_data.port
-        ).first()
+        existing_server = await db.scalar(
+            select(Server.id).where(
+                Server.host == server_data.host,
+                Server.port == server_data.port
+            )
+        )
         
         if existing_server:
             raise HTTPException(
@@ -89,7 +171,7 @@ async def create_server(
         
         # Создание сервера
         server = Server(
-            server_id=f"server-{len(db.query(Server).all()) + 1}",
+            server_id=await server_ids.next_id(),
             name=server_data.name,
             host=server_data.host,
             port=server_data.port,
@@ -99,8 +181,9 @@ async def create_server(
         )
         
         db.add(server)
-        db.commit()
-        db.refresh(server)
+        await db.commit()
+        await db.refresh(server)
+        await xray_service.notify_server_changed(db, "upsert", server.server_id)
         
         # Запуск проверки здоровья в фоне
         background_tasks.add_task(xray_service.check_server_health, server.id)
@@ -112,28 +195,98 @@ async def create_server(
         raise
     except Exception as e:
         logger.error(f"Ошибка создания сервера: {e}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Ошибка создания сервера")
 
+@router.post("/bulk", response_model=List[ServerResponse])
+async def create_servers_bulk(
+    request: ServerBulkCreate,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Массовая регистрация серверов одной транзакцией"""
+    if len(request.servers) > settings.SERVER_BULK_MAX:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Не более {settings.SERVER_BULK_MAX} серверов за запрос"
+        )
+    
+    addresses = [(server.host, server.port) for server in request.servers]
+    if len(set(addresses)) != len(addresses):
+        raise HTTPException(status_code=400, detail="В запросе повторяются хост и порт")
+    
+    try:
+        # Одна проверка дубликатов на весь пакет
+        result = await db.execute(
+            select(Server.host, Server.port).where(tuple_(Server.host, Server.port).in_(addresses))
+        )
+        existing = [f"{host}:{port}" for host, port in result.all()]
+        if existing:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Серверы уже существуют: {', '.join(existing)}"
+            )
+        
+        ids = await server_ids.allocate(len(request.servers))
+        result = await db.scalars(
+            insert(Server).returning(Server),
+            [
+                {
+                    "server_id": server_id,
+                    "name": server.name,
+                    "host": server.host,
+                    "port": server.port,
+                    "reality_private_key": server.reality_private_key,
+                    "reality_public_key": server.reality_public_key,
+                    "reality_short_id": server.reality_short_id
+                }
+                for server_id, server in zip(ids, request.servers)
+            ]
+        )
+        servers = result.all()
+        response = [ServerResponse.from_orm(server) for server in servers]
+        await db.commit()
+        await xray_service.notify_servers_changed(db, "upsert", ids)
+        
+        # Проверка здоровья новых серверов одним проходом
+        background_tasks.add_task(xray_service.check_all_servers_health)
+        
+        logger.info(f"Зарегистрировано серверов: {len(servers)}")
+        return response
+        
+    except HTTPException:
+        raise
+    except IntegrityError as e:
+        await db.rollback()
+        logger.error(f"Конфликт при массовой регистрации серверов: {e}")
+        raise HTTPException(status_code=409, detail="Серверы с такими адресами уже зарегистрированы")
+    except Exception as e:
+        logger.error(f"Ошибка массовой регистрации серверов: {e}")
+        await db.rollback()
+        raise HTTPException(status_code=500, detail="Ошибка массовой регистрации серверов")
+
 @router.put("/{server_id}", response_model=ServerResponse)
 async def update_server(
     server_id: str,
     server_data: ServerUpdate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Обновить сервер"""
     try:
-        server = db.query(Server).filter(Server.server_id == server_id).first()
+        server = await _get_server_by_server_id(db, server_id)
         if not server:
             raise HTTPException(status_code=404, detail="Сервер не найден")
         
         # Обновление полей
         update_data = server_data.dict(exclude_unset=True)
+        if update_data.get("status") is None:
+            update_data.pop("status", None)
         for field, value in update_data.items():
             setattr(server, field, value)
         
-        db.commit()
-        db.refresh(server)
+        await db.commit()
+        await db.refresh(server)
+        await xray_service.notify_server_changed(db, "upsert", server.server_id)
         
         logger.info(f"Обновлен сервер: {server_id}")
         return ServerResponse.from_orm(server)
@@ -142,22 +295,24 @@ async def update_server(
         raise
     except Exception as e:
         logger.error(f"Ошибка обновления сервера {server_id}: {e}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Ошибка обновления сервера")
 
 @router.delete("/{server_id}", response_model=MessageResponse)
-async def delete_server(server_id: str, db: Session = Depends(get_db)):
+async def delete_server(server_id: str, db: AsyncSession = Depends(get_async_db)):
     """Удалить сервер"""
     try:
-        server = db.query(Server).filter(Server.server_id == server_id).first()
+        server = await _get_server_by_server_id(db, server_id)
         if not server:
             raise HTTPException(status_code=404, detail="Сервер не найден")
         
         # Проверка наличия активных конфигураций
-        active_configs = db.query(Config).filter(
-            Config.server_id == server.id,
-            Config.status == "active"
-        ).count()
+        active_configs = await db.scalar(
+            select(func.count(Config.id)).where(
+                Config.server_id == server.id,
+                Config.status == "active"
+            )
+        )
         
         if active_configs > 0:
             raise HTTPException(
@@ -165,8 +320,9 @@ async def delete_server(server_id: str, db: Session = Depends(get_db)):
                 detail=f"Нельзя удалить сервер с {active_configs} активными конфигурациями"
             )
         
-        db.delete(server)
-        db.commit()
+        await db.delete(server)
+        await db.commit()
+        await xray_service.notify_server_changed(db, "delete", server_id)
         
         logger.info(f"Удален сервер: {server_id}")
         return MessageResponse(message=f"Сервер {server_id} успешно удален")
@@ -175,18 +331,18 @@ async def delete_server(server_id: str, db: Session = Depends(get_db)):
         raise
     except Exception as e:
         logger.error(f"Ошибка удаления сервера {server_id}: {e}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Ошибка удаления сервера")
 
 @router.post("/{server_id}/restart", response_model=MessageResponse)
 async def restart_server(
     server_id: str,
     background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Перезапустить сервер"""
     try:
-        server = db.query(Server).filter(Server.server_id == server_id).first()
+        server = await _get_server_by_server_id(db, server_id)
         if not server:
             raise HTTPException(status_code=404, detail="Сервер не найден")
         
@@ -203,10 +359,10 @@ async def restart_server(
         raise HTTPException(status_code=500, detail="Ошибка перезапуска сервера")
 
 @router.get("/{server_id}/status", response_model=dict)
-async def get_server_status(server_id: str, db: Session = Depends(get_db)):
+async def get_server_status(server_id: str, db: AsyncSession = Depends(get_async_db)):
     """Получить статус сервера"""
     try:
-        server = db.query(Server).filter(Server.server_id == server_id).first()
+        server = await _get_server_by_server_id(db, server_id)
         if not server:
             raise HTTPException(status_code=404, detail="Сервер не найден")
         
@@ -233,25 +389,66 @@ async def get_server_status(server_id: str, db: Session = Depends(get_db)):
         logger.error(f"Ошибка получения статуса сервера {server_id}: {e}")
         raise HTTPException(status_code=500, detail="Ошибка получения статуса сервера")
 
-@router.get("/{server_id}/metrics", response_model=List[dict])
+@router.get("/{server_id}/metrics", response_model=dict)
 async def get_server_metrics(
     server_id: str,
     hours: int = 24,
-    db: Session = Depends(get_db)
+    max_points: Optional[int] = Query(None, ge=1, le=100000),
+    format: Optional[str] = Query(None, pattern="^(ndjson|csv|arrow)$"),
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    step: Optional[int] = Query(None, ge=1, description="Шаг агрегации в секундах"),
+    metrics: Optional[str] = Query(None, description="Метрики через запятую"),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Получить метрики сервера за период"""
+    """Получить метрики сервера за период
+    
+    С параметром format ответ отдается потоком (NDJSON, CSV или Arrow IPC),
+    агрегация по step выполняется в БД.
+    """
     try:
-        server = db.query(Server).filter(Server.server_id == server_id).first()
+        server = await _get_server_by_server_id(db, server_id)
         if not server:
             raise HTTPException(status_code=404, detail="Сервер не найден")
         
-        # Получение метрик за период
-        metrics = await xray_service.get_server_metrics(server.id, hours)
+        end = end or datetime.now()
+        start = start or end - timedelta(hours=hours)
+        if start >= end:
+            raise HTTPException(status_code=400, detail="Параметр from должен быть меньше to")
+        names = metrics.split(",") if metrics else None
+        
+        if format:
+            if format == "arrow" and not arrow_available():
+                raise HTTPException(status_code=400, detail="Экспорт в Arrow недоступен: не установлен pyarrow")
+            if step and not xray_service.can_export_metrics(start, step):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Нет хранящихся метрик для шага {step} с: за этот период step должен быть кратен интервалу агрегатов"
+                )
+            return StreamingResponse(
+                _stream_metrics(server_id, format, xray_service.export_server_metrics(server.id, start, end, step, names)),
+                media_type=EXPORT_MEDIA_TYPES[format]
+            )
         
-        return metrics
+        # Получение метрик за период
+        return await xray_service.get_server_metrics(server.id, start, end, names, max_points)
         
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Ошибка получения метрик сервера {server_id}: {e}")
         raise HTTPException(status_code=500, detail="Ошибка получения метрик сервера")
+
+async def _stream_metrics(server_id: str, format: str, chunks):
+    """Кодирование чанков метрик
+
+    Статус 200 к этому моменту уже отправлен, поэтому ошибка посреди потока
+    логируется и пробрасывается дальше: соединение обрывается, и клиент не
+    примет усеченную выгрузку за полную.
+    """
+    try:
+        async for data in ENCODERS[format](chunks):
+            yield data
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки метрик сервера {server_id}: {e}")
+        raise
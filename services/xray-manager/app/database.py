@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.config import settings
@@ -17,6 +18,48 @@ engine = create_engine(
 # Создание фабрики сессий
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def _async_database_url(url: str) -> str:
+    """Подстановка асинхронного драйвера в URL базы данных"""
+    if url.startswith("postgresql://") or url.startswith("postgresql+psycopg2://"):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1]
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url.split("://", 1)[1]
+    return url
+
+def _async_engine_options(url: str) -> dict:
+    """Параметры пула для асинхронного движка"""
+    options = {"echo": settings.DEBUG}
+    if url.startswith("sqlite"):
+        return options
+    
+    options.update(
+        pool_pre_ping=True,
+        pool_recycle=300,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT
+    )
+    if url.startswith("postgresql+asyncpg"):
+        options["connect_args"] = {
+            "statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE
+        }
+    return options
+
+# Асинхронный движок для event loop (asyncpg / aiosqlite)
+ASYNC_DATABASE_URL = _async_database_url(settings.DATABASE_URL)
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    **_async_engine_options(ASYNC_DATABASE_URL)
+)
+
+# Фабрика асинхронных сессий
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
+)
+
 # Базовый класс для моделей
 Base = declarative_base()
 
@@ -28,6 +71,11 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    """Dependency для получения асинхронной сессии базы данных"""
+    async with AsyncSessionLocal() as db:
+        yield db
+
 def init_db():
     """Инициализация базы данных"""
     try:
@@ -42,10 +90,20 @@ def check_db_connection():
     """Проверка подключения к базе данных"""
     try:
         db = SessionLocal()
-        db.execute("SELECT 1")
+        db.execute(text("SELECT 1"))
         db.close()
         logger.info("Подключение к базе данных успешно")
         return True
     except Exception as e:
         logger.error(f"Ошибка подключения к базе данных: {e}")
         return False
+
+async def check_async_db_connection() -> bool:
+    """Проверка подключения через асинхронный пул"""
+    try:
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка подключения к базе данных: {e}")
+        return False
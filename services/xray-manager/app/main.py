@@ -7,11 +7,11 @@ import logging
 from typing import List, Optional
 
 from app.config import settings
-from app.database import engine, SessionLocal
+from app.database import engine, check_async_db_connection
 from app.models import Base
 from app.api import servers, configs, sni
-from app.services.xray_service import XrayService
-from app.services.sni_service import SNIService
+from app.services.xray_service import xray_service
+from app.services.sni_service import sni_service
 from app.utils.metrics import setup_metrics
 
 # Настройка логирования
@@ -24,10 +24,6 @@ logger = logging.getLogger(__name__)
 # Создание таблиц БД
 Base.metadata.create_all(bind=engine)
 
-# Инициализация сервисов
-xray_service = XrayService()
-sni_service = SNIService()
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Управление жизненным циклом приложения"""
@@ -88,10 +84,9 @@ async def root():
 async def health_check():
     """Health check endpoint"""
     try:
-        # Проверка подключения к БД
-        db = SessionLocal()
-        db.execute("SELECT 1")
-        db.close()
+        # Проверка подключения к БД через асинхронный пул
+        if not await check_async_db_connection():
+            raise RuntimeError("База данных недоступна")
         
         # Проверка статуса сервисов
         servers_status = await xray_service.get_servers_status()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, ForeignKey, Float
+from sqlalchemy import BigInteger, Column, Integer, String, DateTime, Boolean, Text, ForeignKey, Float, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -10,6 +10,11 @@ Base = declarative_base()
 class Server(Base):
     """Модель сервера Xray"""
     __tablename__ = "servers"
+    __table_args__ = (
+        # Ключ keyset пагинации списка серверов
+        Index("idx_servers_status_id", "status", "id"),
+        UniqueConstraint("host", "port", name="uq_servers_host_port"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     server_id = Column(String(50), unique=True, index=True, nullable=False)
@@ -24,7 +29,8 @@ class Server(Base):
     reality_short_id = Column(String(50), nullable=False)
     
     # Статус и мониторинг
-    status = Column(String(20), default="active")  # active, inactive, maintenance
+    # Не NULL: (status, id) - ключ keyset пагинации, NULL выпал бы из сравнения
+    status = Column(String(20), nullable=False, default="active", server_default="active")  # active, inactive, maintenance
     is_healthy = Column(Boolean, default=True)
     last_health_check = Column(DateTime, default=func.now())
     
@@ -44,12 +50,19 @@ class Server(Base):
 class Config(Base):
     """Модель конфигурации пользователя"""
     __tablename__ = "configs"
+    __table_args__ = (
+        Index("idx_configs_status_expires_at", "status", "expires_at"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     config_id = Column(String(50), unique=True, index=True, nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     server_id = Column(Integer, ForeignKey("servers.id"), nullable=False)
     
+    # UUID клиента на узле (email клиента - config_id); у старых записей
+    # пусто, они используют общий UUID сервера
+    client_uuid = Column(String(36), nullable=True)
+    
     # Конфигурация
     config_data = Column(Text, nullable=False)  # JSON конфигурация
     config_url = Column(Text, nullable=False)    # VLESS URL
@@ -63,8 +76,9 @@ class Config(Base):
     expires_at = Column(DateTime, nullable=True)
     
     # Использование
-    bytes_uploaded = Column(Integer, default=0)
-    bytes_downloaded = Column(Integer, default=0)
+    bytes_uploaded = Column(BigInteger, default=0)
+    bytes_downloaded = Column(BigInteger, default=0)
+    traffic_limit = Column(BigInteger, nullable=True)  # байт, None - TRAFFIC_QUOTA_BYTES
     last_used = Column(DateTime, nullable=True)
     
     # Временные метки
@@ -125,6 +139,9 @@ class SNIDomain(Base):
 class ServerMetrics(Base):
     """Модель метрик сервера"""
     __tablename__ = "server_metrics"
+    __table_args__ = (
+        Index("idx_server_metrics_server_timestamp", "server_id", "timestamp"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     server_id = Column(Integer, ForeignKey("servers.id"), nullable=False)
@@ -142,19 +159,54 @@ class ServerMetrics(Base):
     # Связи
     server = relationship("Server")
 
+class IdSequence(Base):
+    """Счетчик для блочной выдачи идентификаторов"""
+    __tablename__ = "id_sequences"
+    
+    name = Column(String(50), primary_key=True)
+    next_value = Column(BigInteger, nullable=False)
+
+class ServerMetricsRollup(Base):
+    """Агрегат метрики сервера за интервал (1m, 1h, 1d)"""
+    __tablename__ = "server_metrics_rollup"
+    __table_args__ = (
+        UniqueConstraint("server_id", "tier", "metric", "bucket", name="uq_server_metrics_rollup"),
+        Index("idx_server_metrics_rollup_tier_bucket", "tier", "bucket"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    server_id = Column(Integer, ForeignKey("servers.id"), nullable=False)
+    tier = Column(String(4), nullable=False)
+    metric = Column(String(32), nullable=False)
+    bucket = Column(DateTime, nullable=False)
+    
+    # Статистика интервала
+    count = Column(Integer, nullable=False, default=0)
+    sum = Column(Float, nullable=False, default=0.0)
+    min = Column(Float, nullable=False)
+    max = Column(Float, nullable=False)
+    p95 = Column(Float, nullable=False)
+    histogram = Column(Text, nullable=False)  # JSON {бин: количество}
+    
+    # Связи
+    server = relationship("Server")
+
 class ConfigUsage(Base):
-    """Модель использования конфигурации"""
+    """Модель использования конфигурации (часовые корзины)"""
     __tablename__ = "config_usage"
+    __table_args__ = (
+        UniqueConstraint("config_id", "timestamp", name="uq_config_usage_config_hour"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     config_id = Column(Integer, ForeignKey("configs.id"), nullable=False)
     
     # Использование
-    bytes_uploaded = Column(Integer, default=0)
-    bytes_downloaded = Column(Integer, default=0)
+    bytes_uploaded = Column(BigInteger, default=0)
+    bytes_downloaded = Column(BigInteger, default=0)
     connection_time = Column(Integer, default=0)  # в секундах
     
-    # Временная метка
+    # Временная метка: начало часа
     timestamp = Column(DateTime, default=func.now())
     
     # Связи
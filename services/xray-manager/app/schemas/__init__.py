@@ -28,6 +28,10 @@ class ServerCreate(ServerBase):
     reality_public_key: str = Field(..., description="Публичный ключ Reality")
     reality_short_id: str = Field(..., description="Короткий ID Reality")
 
+class ServerBulkCreate(BaseModel):
+    """Схема массовой регистрации серверов"""
+    servers: List[ServerCreate] = Field(..., min_items=1, description="Серверы для регистрации")
+
 class ServerUpdate(BaseModel):
     """Схема обновления сервера"""
     name: Optional[str] = None
@@ -68,11 +72,23 @@ class ConfigCreate(ConfigBase):
     """Схема создания конфигурации"""
     expires_at: Optional[datetime] = None
 
+class ConfigBulkCreate(BaseModel):
+    """Схема массового создания конфигураций"""
+    user_ids: List[int] = Field(..., min_items=1, description="ID пользователей")
+    server_id: Optional[int] = Field(None, description="ID сервера (по умолчанию автоматически)")
+    expires_at: Optional[datetime] = None
+
+class ConfigRevoke(BaseModel):
+    """Схема отзыва конфигураций пользователей"""
+    user_ids: List[int] = Field(..., min_items=1, description="ID пользователей")
+    reason: Optional[str] = Field(None, description="Причина отзыва")
+
 class ConfigUpdate(BaseModel):
     """Схема обновления конфигурации"""
     status: Optional[ConfigStatus] = None
     expires_at: Optional[datetime] = None
     sni_domain: Optional[str] = None
+    traffic_limit: Optional[int] = Field(None, ge=0, description="Квота трафика в байтах")
 
 class ConfigResponse(ConfigBase):
     """Схема ответа конфигурации"""
@@ -86,6 +102,7 @@ class ConfigResponse(ConfigBase):
     expires_at: Optional[datetime]
     bytes_uploaded: int
     bytes_downloaded: int
+    traffic_limit: Optional[int] = None
     last_used: Optional[datetime]
     created_at: datetime
     updated_at: datetime
@@ -200,17 +217,20 @@ class ErrorResponse(BaseModel):
 
 # Pagination Schemas
 class PaginationParams(BaseModel):
-    """Параметры пагинации"""
+    """Параметры пагинации: номер страницы или курсор"""
     page: int = Field(1, ge=1, description="Номер страницы")
     size: int = Field(20, ge=1, le=100, description="Размер страницы")
+    cursor: Optional[str] = Field(None, description="Курсор из next_cursor предыдущего ответа")
 
 class PaginatedResponse(BaseModel):
     """Схема пагинированного ответа"""
     items: List[dict]
     total: int
-    page: int
+    page: Optional[int] = None
     size: int
     pages: int
+    next_cursor: Optional[str] = Field(None, description="Курсор следующей страницы")
+    total_is_approximate: bool = Field(False, description="total взят из кэша")
 
 # Utility Schemas
 class MessageResponse(BaseModel):
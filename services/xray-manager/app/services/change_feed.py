@@ -0,0 +1,109 @@
+import asyncio
+import json
+import logging
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, List, Optional
+
+from sqlalchemy import ARRAY, Text, cast, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+ChangeHandler = Callable[[str, str], Awaitable[None]]
+
+
+class ChangeFeed(ABC):
+    """Лента изменений серверов для инвалидации кэшей в памяти"""
+
+    def __init__(self, channel: str = settings.SERVER_CHANGE_CHANNEL):
+        self.channel = channel
+        self.handlers: List[ChangeHandler] = []
+
+    def subscribe(self, handler: ChangeHandler):
+        """Подписка на изменения (op, server_id)"""
+        self.handlers.append(handler)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    async def publish(self, db: AsyncSession, op: str, server_id: str):
+        """Публикация изменения после фиксации транзакции"""
+
+    async def publish_many(self, db: AsyncSession, op: str, server_ids: List[str]):
+        """Публикация изменений нескольких серверов"""
+        for server_id in server_ids:
+            await self.publish(db, op, server_id)
+
+    async def _dispatch(self, op: str, server_id: str):
+        for handler in self.handlers:
+            try:
+                await handler(op, server_id)
+            except Exception as e:
+                logger.error(f"Ошибка обработки изменения {op} {server_id}: {e}")
+
+
+class LocalChangeFeed(ChangeFeed):
+    """Pub/sub внутри процесса (для одного воркера и локальных тестов)"""
+
+    async def publish(self, db: AsyncSession, op: str, server_id: str):
+        await self._dispatch(op, server_id)
+
+
+class PostgresChangeFeed(ChangeFeed):
+    """Лента изменений через PostgreSQL LISTEN/NOTIFY"""
+
+    def __init__(self, dsn: str = settings.DATABASE_URL, **kwargs):
+        super().__init__(**kwargs)
+        self.dsn = dsn.replace("postgresql+asyncpg://", "postgresql://")
+        self._connection = None
+
+    async def start(self):
+        import asyncpg
+
+        self._connection = await asyncpg.connect(self.dsn)
+        await self._connection.add_listener(self.channel, self._on_notify)
+        logger.info(f"Подписка на канал изменений серверов: {self.channel}")
+
+    async def stop(self):
+        if self._connection is not None:
+            await self._connection.remove_listener(self.channel, self._on_notify)
+            await self._connection.close()
+            self._connection = None
+
+    async def publish(self, db: AsyncSession, op: str, server_id: str):
+        payload = json.dumps({"op": op, "server_id": server_id})
+        await db.execute(select(func.pg_notify(self.channel, payload)))
+        await db.commit()
+
+    async def publish_many(self, db: AsyncSession, op: str, server_ids: List[str]):
+        # Один запрос на пакет вместо round trip на каждый сервер
+        payloads = [json.dumps({"op": op, "server_id": server_id}) for server_id in server_ids]
+        if not payloads:
+            return
+        payload = func.unnest(cast(payloads, ARRAY(Text))).column_valued("payload")
+        await db.execute(select(func.pg_notify(self.channel, payload)))
+        await db.commit()
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Некорректное уведомление в канале {channel}: {payload}")
+            return
+        asyncio.create_task(self._dispatch(message["op"], message["server_id"]))
+
+
+def create_change_feed(backend: Optional[str] = None) -> ChangeFeed:
+    """Выбор реализации ленты изменений по настройкам"""
+    backend = backend or settings.SERVER_CHANGE_FEED
+    if backend == "auto":
+        backend = "postgres" if settings.DATABASE_URL.startswith("postgresql") else "local"
+    if backend == "postgres":
+        return PostgresChangeFeed()
+    return LocalChangeFeed()
@@ -0,0 +1,57 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class CountCache:
+    """Кэш результатов COUNT по фильтру с временем жизни
+
+    Значение считается приблизительным: между пересчетами таблица может
+    измениться. Параллельные промахи по одному ключу выполняют один запрос.
+    Размер ограничен max_size: при переполнении удаляются истекшие записи,
+    затем самые старые. Блокировка ключа живет только на время загрузки.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._values: Dict[Hashable, Tuple[float, int]] = {}
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[int]]) -> Tuple[int, bool]:
+        """Количество по ключу и признак того, что оно взято из кэша"""
+        cached = self._values.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1], True
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        try:
+            async with lock:
+                cached = self._values.get(key)
+                if cached is not None and cached[0] > time.monotonic():
+                    return cached[1], True
+                value = await loader()
+                self._store(key, value)
+                return value, False
+        finally:
+            # Ожидающие держат ссылку на блокировку, новые запросы найдут значение
+            if not lock.locked() and self._locks.get(key) is lock:
+                del self._locks[key]
+
+    def _store(self, key: Hashable, value: int):
+        now = time.monotonic()
+        self._values.pop(key, None)
+        if len(self._values) >= self.max_size:
+            self._values = {k: v for k, v in self._values.items() if v[0] > now}
+            while len(self._values) >= self.max_size:
+                del self._values[next(iter(self._values))]
+        self._values[key] = (now + self.ttl, value)
+
+    def invalidate(self, key: Any = None):
+        """Сброс одного ключа или всего кэша"""
+        if key is None:
+            self._values.clear()
+        else:
+            self._values.pop(key, None)
@@ -0,0 +1,216 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import select, update
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Config
+
+logger = logging.getLogger(__name__)
+
+# (configs.id, config_id, servers.id) отозванной конфигурации
+ExpiredConfig = Tuple[int, str, int]
+
+
+class ExpiryScheduler:
+    """Отзыв конфигураций по expires_at
+
+    В памяти держится min-heap ближайших истечений в окне
+    EXPIRY_HORIZON. Окно пополняется инкрементально: раз в
+    EXPIRY_RELOAD_INTERVAL читается только следующий отрезок
+    (loaded_until, now + horizon] по индексу (status, expires_at), без
+    полного прохода по таблице. Новые конфигурации внутри уже
+    загруженного отрезка добавляются через schedule().
+
+    Наступившие истечения отзываются пачками до EXPIRY_BATCH_SIZE одним
+    UPDATE ... RETURNING. Условие на status и expires_at в UPDATE
+    отбрасывает устаревшие записи кучи (продленные или уже отключенные
+    конфигурации), поэтому куча не требует точной инвалидации.
+    """
+
+    def __init__(
+        self,
+        on_expired: Optional[Callable[[List[ExpiredConfig]], Awaitable[None]]] = None,
+        horizon: int = settings.EXPIRY_HORIZON,
+        reload_interval: int = settings.EXPIRY_RELOAD_INTERVAL,
+        batch_size: int = settings.EXPIRY_BATCH_SIZE
+    ):
+        self.on_expired = on_expired
+        self.horizon = timedelta(seconds=horizon)
+        self.reload_interval = reload_interval
+        self.batch_size = batch_size
+        self._heap: List[Tuple[datetime, int]] = []
+        self._loaded_until: Optional[datetime] = None
+        self._next_reload = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.revoked_total = 0
+
+    def start(self):
+        """Запуск планировщика"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка планировщика"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def schedule(self, config_id: int, expires_at: Optional[datetime]):
+        """Новая или продленная конфигурация внутри загруженного окна"""
+        # Дальние истечения подхватит следующая догрузка окна
+        if expires_at is None or self._loaded_until is None or expires_at > self._loaded_until:
+            return
+        heapq.heappush(self._heap, (expires_at, config_id))
+        if self._heap[0][1] == config_id:
+            self._wakeup.set()
+
+    def get_status(self) -> Dict[str, object]:
+        """Состояние кучи истечений"""
+        return {
+            "scheduled": len(self._heap),
+            "next_expiry": self._heap[0][0] if self._heap else None,
+            "loaded_until": self._loaded_until,
+            "revoked_total": self.revoked_total
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                if time.monotonic() >= self._next_reload:
+                    await self.reload()
+                await self.revoke_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка планировщика истечения конфигураций: {e}")
+
+            # Сон до ближайшего истечения или догрузки окна
+            delay = self._next_reload - time.monotonic()
+            if self._heap:
+                delay = min(delay, (self._heap[0][0] - datetime.now()).total_seconds())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, delay))
+            except asyncio.TimeoutError:
+                pass
+
+    async def reload(self):
+        """Догрузка следующего отрезка окна по индексу (status, expires_at)"""
+        until = datetime.now() + self.horizon
+        conditions = [
+            Config.status == "active",
+            Config.expires_at.is_not(None),
+            Config.expires_at <= until
+        ]
+        if self._loaded_until is not None:
+            conditions.append(Config.expires_at > self._loaded_until)
+
+        loaded = 0
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(
+                select(Config.expires_at, Config.id)
+                .where(*conditions)
+                .order_by(Config.expires_at)
+                .execution_options(yield_per=self.batch_size)
+            )
+            async for partition in result.partitions():
+                for expires_at, config_id in partition:
+                    heapq.heappush(self._heap, (expires_at, config_id))
+                loaded += len(partition)
+
+        self._loaded_until = until
+        self._next_reload = time.monotonic() + self.reload_interval
+        if loaded:
+            logger.info(f"Загружено истечений конфигураций: {loaded}, в очереди {len(self._heap)}")
+
+    async def revoke_due(self) -> int:
+        """Отзыв наступивших истечений пачками"""
+        revoked = 0
+        while self._heap and self._heap[0][0] <= datetime.now():
+            now = datetime.now()
+            batch = []
+            while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+                batch.append(heapq.heappop(self._heap)[1])
+
+            try:
+                expired = await self._expire(batch, now)
+            except Exception:
+                # Пачка вернется в кучу и будет отозвана на следующем проходе
+                for config_id in batch:
+                    heapq.heappush(self._heap, (now, config_id))
+                raise
+
+            revoked += len(expired)
+            if expired and self.on_expired:
+                try:
+                    await self.on_expired(expired)
+                except Exception as e:
+                    logger.error(f"Ошибка обработки истекших конфигураций: {e}")
+
+        if revoked:
+            self.revoked_total += revoked
+            logger.info(f"Отозвано истекших конфигураций: {revoked}")
+        return revoked
+
+    async def revoke_users(self, user_ids: List[int]) -> int:
+        """Отзыв всех активных конфигураций пользователей (конец подписки)
+
+        Идентификаторы обрабатываются пачками до EXPIRY_BATCH_SIZE, каждая
+        пачка - один UPDATE ... RETURNING по индексу configs(user_id).
+        """
+        revoked = 0
+        for offset in range(0, len(user_ids), self.batch_size):
+            table = Config.__table__
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(
+                    update(table)
+                    .where(
+                        table.c.user_id.in_(user_ids[offset:offset + self.batch_size]),
+                        table.c.status == "active"
+                    )
+                    .values(status="expired")
+                    .returning(table.c.id, table.c.config_id, table.c.server_id)
+                )
+                expired = [tuple(row) for row in result.all()]
+                await db.commit()
+
+            revoked += len(expired)
+            if expired and self.on_expired:
+                try:
+                    await self.on_expired(expired)
+                except Exception as e:
+                    logger.error(f"Ошибка обработки отозванных конфигураций: {e}")
+
+        if revoked:
+            self.revoked_total += revoked
+            logger.info(f"Отозвано конфигураций по окончании подписки: {revoked} ({len(user_ids)} пользователей)")
+        return revoked
+
+    @staticmethod
+    async def _expire(config_ids: List[int], now: datetime) -> List[ExpiredConfig]:
+        table = Config.__table__
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(table)
+                .where(
+                    table.c.id.in_(config_ids),
+                    table.c.status == "active",
+                    table.c.expires_at <= now
+                )
+                .values(status="expired")
+                .returning(table.c.id, table.c.config_id, table.c.server_id)
+            )
+            expired = [tuple(row) for row in result.all()]
+            await db.commit()
+        return expired
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from datetime import datetime
+from typing import Callable, Dict, List, Any, NamedTuple, Optional, Sequence
+
+from sqlalchemy import case, select, update
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Server
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы латентности (секунды), как у Prometheus
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class ProbeTarget(NamedTuple):
+    """Сервер, который нужно проверить"""
+    id: int
+    server_id: str
+    host: str
+    port: int
+
+
+class ProbeResult(NamedTuple):
+    """Результат одной TCP проверки"""
+    id: int
+    server_id: str
+    ok: bool
+    latency: float
+    error: Optional[str]
+
+
+class LatencyHistogram:
+    """Гистограмма латентности проверок с фиксированными корзинами"""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.failures = 0
+
+    def observe(self, latency: float, ok: bool = True):
+        """Учет одного измерения"""
+        self.counts[bisect_left(self.buckets, latency)] += 1
+        self.count += 1
+        self.sum += latency
+        if not ok:
+            self.failures += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Снимок гистограммы в формате кумулятивных корзин"""
+        cumulative = 0
+        buckets = {}
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            cumulative += bucket_count
+            buckets[str(bound)] = cumulative
+        buckets["+Inf"] = self.count
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "failures": self.failures,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": buckets
+        }
+
+
+class HealthChecker:
+    """Неблокирующая параллельная проверка здоровья всего парка серверов"""
+
+    def __init__(
+        self,
+        timeout: float = settings.HEALTH_CHECK_TIMEOUT,
+        concurrency: int = settings.HEALTH_CHECK_CONCURRENCY,
+        interval: float = settings.HEALTH_CHECK_INTERVAL,
+        on_results: Optional[Callable[[List[ProbeResult]], None]] = None
+    ):
+        self.timeout = timeout
+        self.on_results = on_results
+        self.interval = interval
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.histogram = LatencyHistogram()
+        self.server_histograms: Dict[str, LatencyHistogram] = {}
+        self.last_sweep: Dict[str, Any] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запуск периодических проверок"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Запущен планировщик проверок здоровья (интервал {self.interval} с)")
+
+    async def stop(self):
+        """Остановка периодических проверок"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            logger.info("Планировщик проверок здоровья остановлен")
+
+    async def _run(self):
+        """Цикл планировщика"""
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка проверки здоровья серверов: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def probe(self, host: str, port: int) -> ProbeResult:
+        """Проверка TCP соединения с дедлайном без блокировки event loop
+
+        Разовые проверки адреса не попадают в гистограммы серверов.
+        """
+        return await self._probe(ProbeTarget(0, f"{host}:{port}", host, port), per_server=False)
+
+    async def _probe(self, target: ProbeTarget, per_server: bool = True) -> ProbeResult:
+        started = time.perf_counter()
+        error = None
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(target.host, target.port),
+                timeout=self.timeout
+            )
+            writer.close()
+            try:
+                await asyncio.wait_for(writer.wait_closed(), timeout=self.timeout)
+            except (asyncio.TimeoutError, OSError):
+                pass
+            ok = True
+        except asyncio.TimeoutError:
+            ok, error = False, "timeout"
+        except OSError as e:
+            ok, error = False, str(e) or type(e).__name__
+        latency = time.perf_counter() - started
+
+        self.histogram.observe(latency, ok)
+        if per_server:
+            histogram = self.server_histograms.get(target.server_id)
+            if histogram is None:
+                histogram = self.server_histograms[target.server_id] = LatencyHistogram()
+            histogram.observe(latency, ok)
+
+        return ProbeResult(target.id, target.server_id, ok, latency, error)
+
+    async def _probe_bounded(self, target: ProbeTarget) -> ProbeResult:
+        async with self.semaphore:
+            return await self._probe(target)
+
+    async def sweep(self) -> Dict[str, Any]:
+        """Проверка всех серверов за один проход"""
+        started = time.perf_counter()
+        targets = await self._load_targets()
+        # Гистограммы удаленных и выведенных из работы серверов
+        known = {target.server_id for target in targets}
+        for server_id in self.server_histograms.keys() - known:
+            del self.server_histograms[server_id]
+        results = await asyncio.gather(*(self._probe_bounded(t) for t in targets))
+
+        if results:
+            await self._store_results(results)
+            if self.on_results:
+                self.on_results(results)
+
+        failed = [r.server_id for r in results if not r.ok]
+        self.last_sweep = {
+            "checked": len(results),
+            "healthy": len(results) - len(failed),
+            "failed": failed,
+            "duration": round(time.perf_counter() - started, 3),
+            "timestamp": datetime.now().isoformat()
+        }
+        logger.info(
+            f"Проверка здоровья: {self.last_sweep['healthy']}/{len(results)} OK "
+            f"за {self.last_sweep['duration']} с"
+        )
+        return self.last_sweep
+
+    async def _load_targets(self) -> List[ProbeTarget]:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Server.id, Server.server_id, Server.host, Server.port)
+                .where(Server.status != "inactive")
+            )
+            return [ProbeTarget(*row) for row in result.all()]
+
+    async def _store_results(self, results: List[ProbeResult]):
+        """Запись результатов одним UPDATE"""
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(Server)
+                .where(Server.id.in_([r.id for r in results]))
+                .values(
+                    is_healthy=case({r.id: r.ok for r in results}, value=Server.id),
+                    last_health_check=datetime.now()
+                )
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+
+    def get_latency_stats(self) -> Dict[str, Any]:
+        """Гистограммы латентности проверок"""
+        return {
+            "total": self.histogram.snapshot(),
+            "servers": {
+                server_id: histogram.snapshot()
+                for server_id, histogram in self.server_histograms.items()
+            },
+            "last_sweep": self.last_sweep
+        }
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from typing import List, Tuple
+
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import IdSequence, Server
+
+logger = logging.getLogger(__name__)
+
+
+class IdAllocator:
+    """Выдача последовательных идентификаторов блоками из памяти
+
+    Счетчик хранится в id_sequences и сдвигается одним атомарным
+    UPDATE ... RETURNING на целый блок, в отдельной транзакции. Внутри
+    блока номера выдаются без обращения к БД. Блок, не израсходованный до
+    перезапуска, оставляет пропуск в нумерации, но номера не повторяются
+    даже между несколькими процессами.
+    """
+
+    def __init__(self, name: str, prefix: str, block_size: int):
+        self.name = name
+        self.prefix = prefix
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._lock = asyncio.Lock()
+
+    async def next_id(self) -> str:
+        return (await self.allocate(1))[0]
+
+    async def allocate(self, count: int) -> List[str]:
+        """count новых идентификаторов"""
+        numbers: List[int] = []
+        async with self._lock:
+            while len(numbers) < count:
+                if self._next >= self._end:
+                    self._next, self._end = await self._reserve(max(self.block_size, count - len(numbers)))
+                take = min(self._end - self._next, count - len(numbers))
+                numbers.extend(range(self._next, self._next + take))
+                self._next += take
+        return [f"{self.prefix}{number}" for number in numbers]
+
+    async def _reserve(self, size: int) -> Tuple[int, int]:
+        """Резервирование диапазона [start, end) в БД"""
+        async with AsyncSessionLocal() as db:
+            for _ in range(3):
+                result = await db.execute(
+                    update(IdSequence)
+                    .where(IdSequence.name == self.name)
+                    .values(next_value=IdSequence.next_value + size)
+                    .returning(IdSequence.next_value)
+                )
+                end = result.scalar()
+                if end is not None:
+                    await db.commit()
+                    return end - size, end
+
+                # Первый запуск: счетчик начинается после существующих записей
+                await db.rollback()
+                start = await self._initial_value(db)
+                try:
+                    await db.execute(insert(IdSequence).values(name=self.name, next_value=start))
+                    await db.commit()
+                    logger.info(f"Создан счетчик идентификаторов {self.name} с {start}")
+                except IntegrityError:
+                    # Счетчик создан параллельно другим процессом
+                    await db.rollback()
+        raise RuntimeError(f"Не удалось зарезервировать идентификаторы {self.name}")
+
+    async def _initial_value(self, db) -> int:
+        # Старые идентификаторы server-{count + 1} не превышают id своей строки
+        max_id = await db.scalar(select(func.max(Server.id)))
+        return (max_id or 0) + 1
+
+
+# Идентификаторы серверов server-N
+server_ids = IdAllocator("servers", "server-", settings.SERVER_ID_BLOCK_SIZE)
@@ -0,0 +1,111 @@
+import csv
+import io
+import json
+from datetime import datetime
+from typing import AsyncIterator, List, Tuple
+
+# Форматы выгрузки метрик и их MIME типы
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream"
+}
+
+Chunks = AsyncIterator[Tuple[List[str], List[tuple]]]
+
+
+def arrow_available() -> bool:
+    """Установлен ли pyarrow (опциональная зависимость)"""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+async def encode_ndjson(chunks: Chunks) -> AsyncIterator[bytes]:
+    """Одна JSON строка на точку"""
+    async for columns, rows in chunks:
+        lines = [
+            json.dumps(dict(zip(columns, row)), default=_json_default, separators=(",", ":"))
+            for row in rows
+        ]
+        if lines:
+            yield ("\n".join(lines) + "\n").encode()
+
+
+async def encode_csv(chunks: Chunks) -> AsyncIterator[bytes]:
+    """CSV с заголовком из имен колонок"""
+    header_written = False
+    async for columns, rows in chunks:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if not header_written:
+            writer.writerow(columns)
+            header_written = True
+        writer.writerows(
+            (row[0].isoformat(),) + tuple("" if value is None else value for value in row[1:])
+            for row in rows
+        )
+        yield buffer.getvalue().encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Файловый приемник Arrow writer, из которого байты забираются по батчам"""
+
+    def __init__(self):
+        self.parts: List[bytes] = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.parts.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+async def encode_arrow(chunks: Chunks) -> AsyncIterator[bytes]:
+    """Arrow IPC stream: один record batch на чанк"""
+    import pyarrow as pa
+
+    sink = _ChunkSink()
+    writer = None
+    async for columns, rows in chunks:
+        arrays = [pa.array([row[0] for row in rows], type=pa.timestamp("s"))]
+        arrays += [
+            pa.array([row[index] for row in rows], type=pa.float64())
+            for index in range(1, len(columns))
+        ]
+        batch = pa.RecordBatch.from_arrays(arrays, names=columns)
+        if writer is None:
+            writer = pa.ipc.new_stream(sink, batch.schema)
+        writer.write_batch(batch)
+        yield sink.drain()
+
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return float(value)
+
+
+ENCODERS = {
+    "ndjson": encode_ndjson,
+    "csv": encode_csv,
+    "arrow": encode_arrow
+}
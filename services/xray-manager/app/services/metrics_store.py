@@ -0,0 +1,592 @@
+import asyncio
+import json
+import logging
+import math
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List, Any, Iterable, NamedTuple, Optional, Tuple
+
+from sqlalchemy import Integer, case, cast, delete, func, insert, select, tuple_
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import ServerMetrics, ServerMetricsRollup
+from app.services.sni_service import parse_interval
+
+logger = logging.getLogger(__name__)
+
+# Метрики, которые пишутся в server_metrics
+METRIC_FIELDS = ("cpu_usage", "memory_usage", "disk_usage", "connection_count", "bandwidth_usage")
+
+# Уровни агрегации: имя и длина интервала в секундах
+TIERS: Tuple[Tuple[str, int], ...] = (("1m", 60), ("1h", 3600), ("1d", 86400))
+
+# Логарифмические бины гистограммы: относительная ошибка p95 около 2.5%
+HISTOGRAM_BASE = 1.05
+LOG_BASE = math.log(HISTOGRAM_BASE)
+ZERO_BIN = -10000
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def floor_time(timestamp: datetime, step: int) -> datetime:
+    """Начало интервала длиной step секунд, в который попадает timestamp"""
+    seconds = int((timestamp - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=seconds - seconds % step)
+
+
+def histogram_bin(value: float) -> int:
+    if value <= 0:
+        return ZERO_BIN
+    return math.floor(math.log(value) / LOG_BASE)
+
+
+def bin_value(index: int) -> float:
+    """Представитель бина: геометрическая середина его границ"""
+    if index == ZERO_BIN:
+        return 0.0
+    return HISTOGRAM_BASE ** (index + 0.5)
+
+
+class RollupRow(NamedTuple):
+    """Агрегат интервала в виде строки server_metrics_rollup"""
+    bucket: datetime
+    metric: str
+    count: int
+    sum: float
+    min: float
+    max: float
+    p95: float
+
+
+class Rollup:
+    """Агрегат одной метрики за один интервал"""
+
+    __slots__ = ("count", "sum", "min", "max", "histogram", "dirty", "synced")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.histogram: Dict[int, int] = {}
+        self.dirty = False
+        # Состояние из БД уже учтено (важно после перезапуска)
+        self.synced = False
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        index = histogram_bin(value)
+        self.histogram[index] = self.histogram.get(index, 0) + 1
+        self.dirty = True
+
+    def merge_row(self, row):
+        """Добавление агрегата, уже сохраненного в БД"""
+        self.count += row.count
+        self.sum += row.sum
+        self.min = min(self.min, row.min)
+        self.max = max(self.max, row.max)
+        for index, count in json.loads(row.histogram).items():
+            index = int(index)
+            self.histogram[index] = self.histogram.get(index, 0) + count
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.histogram):
+            seen += self.histogram[index]
+            if seen >= rank:
+                return min(max(bin_value(index), self.min), self.max)
+        return self.max
+
+    def copy(self) -> "Rollup":
+        rollup = Rollup()
+        rollup.count, rollup.sum, rollup.min, rollup.max = self.count, self.sum, self.min, self.max
+        rollup.histogram = dict(self.histogram)
+        rollup.synced = self.synced
+        return rollup
+
+    def to_row(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "p95": self.quantile(0.95),
+            "histogram": json.dumps(self.histogram, separators=(",", ":"))
+        }
+
+
+def _epoch_bucket(column, step: int, dialect: str):
+    """SQL выражение начала интервала step секунд в секундах от эпохи"""
+    if dialect == "postgresql":
+        return func.floor(func.extract("epoch", column) / step) * step
+    return cast(cast(func.strftime("%s", column), Integer) / step, Integer) * step
+
+
+def _upsert_statement(dialect: str):
+    """INSERT ... ON CONFLICT DO UPDATE для server_metrics_rollup"""
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+
+    table = ServerMetricsRollup.__table__
+    statement = dialect_insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=["server_id", "tier", "metric", "bucket"],
+        set_={
+            column: statement.excluded[column]
+            for column in ("count", "sum", "min", "max", "p95", "histogram")
+        }
+    )
+
+
+class MetricsStore:
+    """Хранилище временных рядов метрик серверов
+
+    Сырые точки пакетно пишутся в server_metrics, агрегаты 1m/1h/1d
+    поддерживаются в памяти при приеме и сбрасываются upsert'ом. У каждого
+    уровня свой срок хранения. Запросы сами выбирают уровень по длине
+    диапазона и возвращают колонки массивов, а не словарь на точку.
+    """
+
+    def __init__(self):
+        self._raw: List[Dict[str, Any]] = []
+        # Точки, которые пишутся текущим сбросом
+        self._inflight_raw: List[Dict[str, Any]] = []
+        self._rollups: Dict[Tuple[int, str, str, datetime], Rollup] = {}
+        self._flush_lock = asyncio.Lock()
+        self._tasks: List[asyncio.Task] = []
+        self.retention = {
+            "raw": parse_interval(settings.METRICS_RETENTION_RAW),
+            "1m": parse_interval(settings.METRICS_RETENTION_1M),
+            "1h": parse_interval(settings.METRICS_RETENTION_1H),
+            "1d": parse_interval(settings.METRICS_RETENTION_1D)
+        }
+
+    async def start(self):
+        """Запуск фоновых сброса и очистки"""
+        self._tasks = [
+            asyncio.create_task(self._loop(self.flush, settings.METRICS_FLUSH_INTERVAL)),
+            asyncio.create_task(self._loop(self.apply_retention, 3600))
+        ]
+
+    async def stop(self):
+        """Остановка фоновых задач и финальный сброс"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения метрик: {e}")
+
+    async def _loop(self, job, interval: int):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка фоновой задачи метрик: {e}")
+
+    def ingest(self, server_id: int, sample: Dict[str, Any], timestamp: Optional[datetime] = None):
+        """Прием одной точки метрик сервера (без обращения к БД)"""
+        timestamp = timestamp or datetime.now()
+        row = {"server_id": server_id, "timestamp": timestamp}
+        for field in METRIC_FIELDS:
+            row[field] = sample.get(field) or 0
+        self._raw.append(row)
+
+        for tier, step in TIERS:
+            bucket = floor_time(timestamp, step)
+            for field in METRIC_FIELDS:
+                key = (server_id, tier, field, bucket)
+                rollup = self._rollups.get(key)
+                if rollup is None:
+                    rollup = self._rollups[key] = Rollup()
+                rollup.add(float(row[field]))
+
+    async def flush(self):
+        """Пакетная запись сырых точек и измененных агрегатов"""
+        async with self._flush_lock:
+            raw, self._raw = self._raw, []
+            self._inflight_raw = raw
+            dirty = [(key, rollup) for key, rollup in self._rollups.items() if rollup.dirty]
+            if not raw and not dirty:
+                return
+            # Флаг снимается до ожиданий: новые точки снова пометят агрегат
+            for _, rollup in dirty:
+                rollup.dirty = False
+
+            try:
+                async with AsyncSessionLocal() as db:
+                    if raw:
+                        await db.execute(insert(ServerMetrics), raw)
+
+                    if dirty:
+                        await self._merge_stored(db, [item for item in dirty if not item[1].synced])
+                        rows = [
+                            {"server_id": key[0], "tier": key[1], "metric": key[2], "bucket": key[3], **rollup.to_row()}
+                            for key, rollup in dirty
+                        ]
+                        statement = _upsert_statement(db.bind.dialect.name)
+                        await db.execute(statement, rows)
+
+                    await db.commit()
+            except Exception:
+                # Точки и агрегаты попадут в следующий сброс
+                self._raw[:0] = raw
+                for _, rollup in dirty:
+                    rollup.dirty = True
+                raise
+            finally:
+                self._inflight_raw = []
+
+            self._evict_closed()
+            logger.debug(f"Сброшено метрик: {len(raw)} точек, {len(dirty)} агрегатов")
+
+    async def _merge_stored(self, db, items: List[Tuple[Tuple, Rollup]]):
+        """Учет агрегатов, записанных до перезапуска процесса"""
+        if not items:
+            return
+        keys = [key for key, _ in items]
+        by_key = dict(items)
+        table = ServerMetricsRollup
+        for offset in range(0, len(keys), 500):
+            chunk = keys[offset:offset + 500]
+            result = await db.execute(
+                select(table.server_id, table.tier, table.metric, table.bucket,
+                       table.count, table.sum, table.min, table.max, table.histogram)
+                .where(tuple_(table.server_id, table.tier, table.metric, table.bucket).in_(chunk))
+            )
+            for row in result.all():
+                rollup = by_key.get((row.server_id, row.tier, row.metric, row.bucket))
+                if rollup is not None:
+                    rollup.merge_row(row)
+        for _, rollup in items:
+            rollup.synced = True
+
+    def _evict_closed(self):
+        """Удаление из памяти сохраненных агрегатов закрытых интервалов"""
+        now = datetime.now()
+        steps = dict(TIERS)
+        closed = [
+            key for key, rollup in self._rollups.items()
+            if not rollup.dirty and key[3] + timedelta(seconds=steps[key[1]]) < now
+        ]
+        for key in closed:
+            del self._rollups[key]
+
+    async def apply_retention(self):
+        """Удаление данных старше срока хранения своего уровня"""
+        now = datetime.now()
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                delete(ServerMetrics)
+                .where(ServerMetrics.timestamp < now - timedelta(seconds=self.retention["raw"]))
+            )
+            for tier, _ in TIERS:
+                await db.execute(
+                    delete(ServerMetricsRollup)
+                    .where(
+                        ServerMetricsRollup.tier == tier,
+                        ServerMetricsRollup.bucket < now - timedelta(seconds=self.retention[tier])
+                    )
+                )
+            await db.commit()
+        logger.info("Применены сроки хранения метрик")
+
+    def choose_tier(self, start: datetime, end: datetime, max_points: Optional[int] = None) -> Tuple[str, int]:
+        """Самый подробный уровень, который укладывается в max_points и срок хранения"""
+        max_points = max_points or settings.METRICS_MAX_POINTS
+        span = max((end - start).total_seconds(), 1)
+        age = (datetime.now() - start).total_seconds()
+        for tier, step in (("raw", settings.METRICS_RAW_INTERVAL),) + TIERS:
+            if span / step <= max_points and age <= self.retention[tier]:
+                return tier, step
+        return TIERS[-1]
+
+    async def query(
+        self,
+        server_id: int,
+        start: datetime,
+        end: Optional[datetime] = None,
+        metrics: Optional[Iterable[str]] = None,
+        max_points: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Метрики сервера за диапазон в колоночном виде
+
+        Для уровня raw значения min/max/avg/p95 совпадают и ссылаются на
+        один массив.
+        """
+        end = end or datetime.now()
+        metrics = [m for m in (metrics or METRIC_FIELDS) if m in METRIC_FIELDS]
+        tier, step = self.choose_tier(start, end, max_points)
+        # Несброшенные точки берутся из памяти: чтение не пишет в БД. Снимок
+        # делается до запроса, поэтому точка, сброшенная во время чтения,
+        # окажется либо в снимке, либо в выборке
+        if tier == "raw":
+            pending = [
+                row for row in self._inflight_raw + self._raw
+                if row["server_id"] == server_id and start <= row["timestamp"] <= end
+            ]
+        else:
+            first_bucket = floor_time(start, step)
+            pending = {
+                (key[2], key[3]): rollup.copy()
+                for key, rollup in list(self._rollups.items())
+                if key[0] == server_id and key[1] == tier and key[2] in metrics
+                and first_bucket <= key[3] <= end
+            }
+
+        async with AsyncSessionLocal() as db:
+            if tier == "raw":
+                columns = [getattr(ServerMetrics, m) for m in metrics]
+                result = await db.execute(
+                    select(ServerMetrics.timestamp, *columns)
+                    .where(
+                        ServerMetrics.server_id == server_id,
+                        ServerMetrics.timestamp >= start,
+                        ServerMetrics.timestamp <= end
+                    )
+                    .order_by(ServerMetrics.timestamp.asc())
+                )
+                rows = result.all()
+                if pending:
+                    merged = {row[0]: tuple(row) for row in rows}
+                    for point in pending:
+                        merged[point["timestamp"]] = (point["timestamp"], *(point[m] for m in metrics))
+                    rows = [merged[timestamp] for timestamp in sorted(merged)]
+                timestamps = [row[0] for row in rows]
+                series = {}
+                for index, metric in enumerate(metrics, start=1):
+                    values = [row[index] for row in rows]
+                    series[metric] = {"min": values, "max": values, "avg": values, "p95": values}
+            else:
+                table = ServerMetricsRollup
+                columns = [table.bucket, table.metric, table.count, table.sum, table.min, table.max, table.p95]
+                # Гистограммы нужны, только чтобы сложить агрегат из памяти,
+                # еще не объединенный с сохраненным до перезапуска
+                unsynced = any(not rollup.synced for rollup in pending.values())
+                if unsynced:
+                    columns.append(table.histogram)
+                result = await db.execute(
+                    select(*columns)
+                    .where(
+                        table.server_id == server_id,
+                        table.tier == tier,
+                        table.metric.in_(metrics),
+                        table.bucket >= floor_time(start, step),
+                        table.bucket <= end
+                    )
+                    .order_by(table.bucket.asc())
+                )
+                rows = result.all()
+                if pending:
+                    rows = self._overlay_rollups(rows, pending)
+                timestamps, series = self._pivot(rows, metrics)
+
+        return {
+            "server_id": server_id,
+            "tier": tier,
+            "step": step,
+            "from": start,
+            "to": end,
+            "timestamps": timestamps,
+            "series": series
+        }
+
+    def choose_source(self, start: datetime, step: int) -> Optional[Tuple[str, int]]:
+        """Самый подробный хранящийся источник, способный дать интервалы step
+
+        Сырые точки группируются по любому step. Агрегат уровня подходит,
+        только если его интервал делит step: иначе интервалы выгрузки
+        резали бы агрегаты. None - такого источника нет.
+        """
+        age = (datetime.now() - start).total_seconds()
+        if age <= self.retention["raw"]:
+            return "raw", settings.METRICS_RAW_INTERVAL
+        for tier, tier_step in TIERS:
+            if step % tier_step == 0 and age <= self.retention[tier]:
+                return tier, tier_step
+        return None
+
+    async def export(
+        self,
+        server_id: int,
+        start: datetime,
+        end: datetime,
+        step: Optional[int] = None,
+        metrics: Optional[Iterable[str]] = None,
+        chunk_size: Optional[int] = None
+    ) -> AsyncIterator[Tuple[List[str], List[tuple]]]:
+        """Потоковая выгрузка метрик: пары (колонки, строки) по чанкам
+
+        Без step отдаются сырые точки, если диапазон укладывается в
+        METRICS_MAX_POINTS, иначе step выбирается автоматически. Со step
+        агрегация (min/max/avg/p95) выполняется в SQL, строки читаются
+        серверным курсором по chunk_size.
+
+        Выгрузка только читает БД: точки, еще не сброшенные из памяти
+        (последние METRICS_FLUSH_INTERVAL секунд), в нее не попадают.
+        step, для которого choose_source не находит источник, - ValueError.
+        """
+        metrics = [m for m in (metrics or METRIC_FIELDS) if m in METRIC_FIELDS]
+        chunk_size = chunk_size or settings.METRICS_EXPORT_CHUNK_SIZE
+        if step and self.choose_source(start, step) is None:
+            raise ValueError(f"Нет хранящихся метрик для шага {step} с")
+
+        async with AsyncSessionLocal() as db:
+            dialect = db.bind.dialect.name
+            if not step:
+                tier, step = self.choose_tier(start, end)
+                if tier == "raw":
+                    statement = self._raw_points(server_id, start, end, metrics)
+                    columns = ["timestamp"] + metrics
+                    async for chunk in self._stream(db, statement, chunk_size):
+                        yield columns, chunk
+                    return
+
+            tier, _ = self.choose_source(start, step) or TIERS[-1]
+            if tier == "raw":
+                statement = self._aggregate_raw(server_id, start, end, step, metrics, dialect)
+            else:
+                statement = self._aggregate_rollups(server_id, tier, start, end, step, metrics, dialect)
+
+            columns = ["timestamp"] + [
+                f"{metric}_{stat}" for metric in metrics for stat in ("min", "max", "avg", "p95")
+            ]
+            async for chunk in self._stream(db, statement, chunk_size):
+                yield columns, [
+                    (EPOCH + timedelta(seconds=int(row[0])),) + tuple(row[1:])
+                    for row in chunk
+                ]
+
+    @staticmethod
+    async def _stream(db, statement, chunk_size: int) -> AsyncIterator[List[tuple]]:
+        result = await db.stream(statement.execution_options(yield_per=chunk_size))
+        async for partition in result.partitions():
+            yield [tuple(row) for row in partition]
+
+    @staticmethod
+    def _raw_points(server_id: int, start: datetime, end: datetime, metrics: List[str]):
+        return (
+            select(ServerMetrics.timestamp, *[getattr(ServerMetrics, m) for m in metrics])
+            .where(
+                ServerMetrics.server_id == server_id,
+                ServerMetrics.timestamp >= start,
+                ServerMetrics.timestamp <= end
+            )
+            .order_by(ServerMetrics.timestamp.asc())
+        )
+
+    @staticmethod
+    def _aggregate_raw(server_id, start, end, step, metrics, dialect):
+        """GROUP BY интервала по сырым точкам"""
+        bucket = _epoch_bucket(ServerMetrics.timestamp, step, dialect).label("bucket")
+        aggregates = []
+        for metric in metrics:
+            column = getattr(ServerMetrics, metric)
+            if dialect == "postgresql":
+                p95 = func.percentile_cont(0.95).within_group(column)
+            else:
+                # В SQLite нет перцентилей: верхняя оценка
+                p95 = func.max(column)
+            aggregates += [func.min(column), func.max(column), func.avg(column), p95]
+        return (
+            select(bucket, *aggregates)
+            .where(
+                ServerMetrics.server_id == server_id,
+                ServerMetrics.timestamp >= start,
+                ServerMetrics.timestamp <= end
+            )
+            .group_by(bucket)
+            .order_by(bucket)
+        )
+
+    @staticmethod
+    def _aggregate_rollups(server_id, tier, start, end, step, metrics, dialect):
+        """Укрупнение агрегатов уровня tier до step, метрики разворачиваются в колонки"""
+        table = ServerMetricsRollup
+        bucket = _epoch_bucket(table.bucket, step, dialect).label("bucket")
+        aggregates = []
+        for metric in metrics:
+            selected = table.metric == metric
+            aggregates += [
+                func.min(case((selected, table.min))),
+                func.max(case((selected, table.max))),
+                func.sum(case((selected, table.sum))) / func.nullif(func.sum(case((selected, table.count))), 0),
+                # p95 укрупненного интервала оценивается сверху максимумом p95 частей
+                func.max(case((selected, table.p95)))
+            ]
+        return (
+            select(bucket, *aggregates)
+            .where(
+                table.server_id == server_id,
+                table.tier == tier,
+                table.metric.in_(metrics),
+                table.bucket >= floor_time(start, step),
+                table.bucket <= end
+            )
+            .group_by(bucket)
+            .order_by(bucket)
+        )
+
+    @staticmethod
+    def _overlay_rollups(rows, pending: Dict[Tuple[str, datetime], Rollup]) -> List[RollupRow]:
+        """Агрегаты из памяти поверх строк БД
+
+        Агрегат, уже объединенный с БД (synced), содержит полное состояние
+        интервала и заменяет строку; иначе строка и агрегат складываются.
+        """
+        merged: Dict[Tuple[str, datetime], RollupRow] = {
+            (row.metric, row.bucket): RollupRow(row.bucket, row.metric, row.count, row.sum, row.min, row.max, row.p95)
+            for row in rows
+        }
+        stored = {(row.metric, row.bucket): row for row in rows}
+        for (metric, bucket), rollup in pending.items():
+            row = stored.get((metric, bucket))
+            if not rollup.synced and row is not None:
+                rollup.merge_row(row)
+            merged[(metric, bucket)] = RollupRow(
+                bucket, metric, rollup.count, rollup.sum, rollup.min, rollup.max, rollup.quantile(0.95)
+            )
+        return sorted(merged.values(), key=lambda row: row.bucket)
+
+    @staticmethod
+    def _pivot(rows, metrics: List[str]) -> Tuple[List[datetime], Dict[str, Dict[str, List]]]:
+        """Строки (интервал, метрика) в массивы по метрикам"""
+        timestamps: List[datetime] = []
+        positions: Dict[datetime, int] = {}
+        for row in rows:
+            if row.bucket not in positions:
+                positions[row.bucket] = len(timestamps)
+                timestamps.append(row.bucket)
+
+        size = len(timestamps)
+        series = {
+            metric: {name: [None] * size for name in ("min", "max", "avg", "p95")}
+            for metric in metrics
+        }
+        for row in rows:
+            position = positions[row.bucket]
+            columns = series[row.metric]
+            columns["min"][position] = row.min
+            columns["max"][position] = row.max
+            columns["avg"][position] = row.sum / row.count if row.count else None
+            columns["p95"][position] = row.p95
+        return timestamps, series
+
+
+# Общее хранилище метрик
+metrics_store = MetricsStore()
@@ -0,0 +1,486 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+import grpc
+from sqlalchemy import or_, select
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Config, Server
+from app.services.server_registry import ServerRegistry
+from app.utils.xray_proto import (
+    ALTER_INBOUND_METHOD,
+    encode_add_user_request,
+    encode_remove_user_request
+)
+from shared.xray_config import generate_server_config, vless_client
+
+logger = logging.getLogger(__name__)
+
+# Размер партии при загрузке клиентов из БД
+LOAD_CHUNK_SIZE = 5000
+# Предел паузы между повторами для недоступного узла, секунд
+MAX_RETRY_DELAY = 60
+# Доставка config.json через node agent включает перезапуск Xray
+AGENT_PUSH_TIMEOUT = 60
+
+
+class NodeClients:
+    """Желаемый и примененный списки клиентов узла: email -> UUID"""
+
+    __slots__ = (
+        "desired", "applied", "written", "delivered", "dirty", "snapshot_dirty",
+        "api_supported", "failures", "retry_at", "last_full_sync"
+    )
+
+    def __init__(self):
+        self.desired: Dict[str, str] = {}
+        # None - состояние узла неизвестно, нужна полная сверка
+        self.applied: Optional[Dict[str, str]] = None
+        # Клиенты из локального снимка: подсказка, кого удалить при сверке
+        self.written: Optional[Dict[str, str]] = None
+        # Клиенты config.json, доставленного на узел агентом: с ними Xray стартует
+        self.delivered: Optional[Dict[str, str]] = None
+        self.dirty = False
+        self.snapshot_dirty = False
+        self.api_supported = True
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_full_sync = 0.0
+
+
+class NodeSync:
+    """Синхронизация списков клиентов VLESS инбаундов узлов Xray
+
+    Для каждого узла в памяти хранится желаемый набор клиентов (активные
+    конфигурации) и набор, уже примененный на узле. Изменения копятся
+    NODE_SYNC_DEBOUNCE секунд, затем разница отправляется вызовами
+    HandlerService.AlterInbound (add/remove user) по одному gRPC каналу
+    на узел, до NODE_SYNC_CONCURRENCY вызовов одновременно. Xray не
+    перезапускается и файл конфигурации не переписывается.
+
+    Если состояние узла неизвестно (старт менеджера, перезапуск Xray),
+    полный набор клиентов отправляется через AlterInbound поверх пустого:
+    "already exists" считается успехом, а клиенты из локального снимка,
+    которых больше нет в желаемом наборе, удаляются. Клиенты считаются
+    примененными только после ответа узла.
+
+    Узлу без HandlerService полный config.json доставляется через node
+    agent (PUT /config, агент перезаписывает файл и перезапускает Xray)
+    не чаще NODE_SYNC_SNAPSHOT_INTERVAL. Локальный снимок в
+    NODE_SYNC_CONFIG_DIR пишется с тем же периодом и узлами не читается.
+    """
+
+    def __init__(
+        self,
+        registry: ServerRegistry,
+        sni_domains: Callable[[], List[str]],
+        debounce: float = settings.NODE_SYNC_DEBOUNCE,
+        concurrency: int = settings.NODE_SYNC_CONCURRENCY,
+        timeout: float = settings.NODE_SYNC_TIMEOUT,
+        snapshot_interval: int = settings.NODE_SYNC_SNAPSHOT_INTERVAL,
+        config_dir: Optional[str] = settings.NODE_SYNC_CONFIG_DIR
+    ):
+        self.registry = registry
+        self.sni_domains = sni_domains
+        self.debounce = debounce
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.snapshot_interval = snapshot_interval
+        self.config_dir = config_dir or os.path.join(settings.XRAY_CONFIG_DIR, "nodes")
+        self.inbound_tag = settings.XRAY_INBOUND_TAG
+        self._nodes: Dict[str, NodeClients] = {}
+        self._channels: Dict[str, Tuple[str, grpc.aio.Channel, Any]] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        """Загрузка желаемого состояния и запуск фоновых задач"""
+        await self.load()
+        self._wakeup.set()
+        self._tasks = [
+            asyncio.create_task(self._run()),
+            asyncio.create_task(self._snapshot_loop())
+        ]
+
+    async def stop(self):
+        """Остановка с финальным снимком и закрытием каналов"""
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        try:
+            await self.write_snapshots()
+        except Exception as e:
+            logger.error(f"Ошибка финального снимка конфигураций узлов: {e}")
+        for _, channel, _ in self._channels.values():
+            await channel.close()
+        self._channels.clear()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def load(self):
+        """Желаемые клиенты из активных конфигураций; состояние узлов неизвестно до сверки"""
+        now = datetime.now()
+        active = [
+            Config.status == "active",
+            or_(Config.expires_at.is_(None), Config.expires_at > now)
+        ]
+        desired: Dict[str, Dict[str, str]] = {}
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(
+                select(Server.server_id, Config.config_id, Config.client_uuid)
+                .join(Server, Server.id == Config.server_id)
+                .where(Config.client_uuid.is_not(None), *active)
+                .execution_options(yield_per=LOAD_CHUNK_SIZE)
+            )
+            async for partition in result.partitions():
+                for server_id, email, client_id in partition:
+                    desired.setdefault(server_id, {})[email] = client_id
+
+            # Старые конфигурации без своего UUID делят UUID сервера
+            result = await db.execute(
+                select(Server.server_id, Server.uuid)
+                .join(Config, Config.server_id == Server.id)
+                .where(Config.client_uuid.is_(None), *active)
+                .group_by(Server.server_id, Server.uuid)
+            )
+            for server_id, client_id in result.all():
+                desired.setdefault(server_id, {})[self._shared_email(server_id)] = client_id
+
+        for record in self.registry:
+            node = self._nodes.setdefault(record.server_id, NodeClients())
+            node.desired = desired.get(record.server_id, {})
+            node.written = await asyncio.to_thread(self._read_snapshot, record.server_id)
+            node.applied = None
+            node.dirty = bool(node.desired or node.written)
+            node.snapshot_dirty = node.written != node.desired
+
+        total = sum(len(clients) for clients in desired.values())
+        logger.info(f"Синхронизация узлов: {total} клиентов на {len(self._nodes)} узлах")
+
+    @staticmethod
+    def _shared_email(server_id: str) -> str:
+        return f"{server_id}-shared"
+
+    def add_client(self, server_id: str, email: str, client_id: str):
+        """Клиент должен появиться на узле"""
+        node = self._nodes.setdefault(server_id, NodeClients())
+        if node.desired.get(email) != client_id:
+            node.desired[email] = client_id
+            self._mark(node)
+
+    def remove_client(self, server_id: str, email: str):
+        """Клиент должен исчезнуть с узла"""
+        node = self._nodes.get(server_id)
+        if node is not None and node.desired.pop(email, None) is not None:
+            self._mark(node)
+
+    def remove_clients(self, server_id: str, emails: List[str]):
+        """Пакетное удаление клиентов узла одной отметкой изменений"""
+        node = self._nodes.get(server_id)
+        if node is None:
+            return
+        removed = [email for email in emails if node.desired.pop(email, None) is not None]
+        if removed:
+            self._mark(node)
+
+    def forget_server(self, server_id: str):
+        """Сервер удален: состояние и канал больше не нужны"""
+        self._nodes.pop(server_id, None)
+        cached = self._channels.pop(server_id, None)
+        if cached is not None:
+            asyncio.create_task(cached[1].close())
+
+    def node_restarted(self, server_id: str):
+        """Xray перезапущен: клиенты, добавленные через API, потеряны
+
+        Если config.json доставлялся агентом, Xray стартовал с ним, иначе
+        состояние узла неизвестно и нужна полная сверка.
+        """
+        node = self._nodes.get(server_id)
+        if node is None:
+            return
+        node.applied = dict(node.delivered) if node.delivered is not None else None
+        self._mark(node)
+        logger.info(f"Узел {server_id} перезапущен, список клиентов будет досинхронизирован")
+
+    def _mark(self, node: NodeClients):
+        node.dirty = True
+        node.snapshot_dirty = True
+        self._wakeup.set()
+
+    def get_status(self) -> Dict[str, Any]:
+        """Расхождения желаемого и примененного по узлам"""
+        nodes = {}
+        for server_id, node in self._nodes.items():
+            applied = node.applied or {}
+            nodes[server_id] = {
+                "desired": len(node.desired),
+                "applied": len(applied) if node.applied is not None else None,
+                "pending": sum(1 for email, client_id in node.desired.items() if applied.get(email) != client_id)
+                + sum(1 for email in applied if email not in node.desired),
+                "api_supported": node.api_supported,
+                "failures": node.failures
+            }
+        return {"nodes": nodes, "total_clients": sum(len(node.desired) for node in self._nodes.values())}
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Окно debounce: изменения за это время уйдут одной пачкой
+            await asyncio.sleep(self.debounce)
+            self._wakeup.clear()
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка синхронизации узлов: {e}")
+
+            # Отложенные узлы разбудят цикл, когда подойдет время повтора
+            retry_at = [node.retry_at for node in self._nodes.values() if node.dirty]
+            if retry_at and not self._wakeup.is_set():
+                delay = max(0.0, min(retry_at) - time.monotonic())
+                asyncio.get_running_loop().call_later(delay, self._wakeup.set)
+
+    async def sync(self) -> Dict[str, int]:
+        """Применение разницы на всех узлах с изменениями"""
+        now = time.monotonic()
+        server_ids = [
+            server_id for server_id, node in self._nodes.items()
+            if node.dirty and node.retry_at <= now and self.registry.get(server_id) is not None
+        ]
+        results = await asyncio.gather(*(self.sync_node(server_id) for server_id in server_ids))
+        totals = {"nodes": len(server_ids), "added": 0, "removed": 0, "full": 0, "failed": 0}
+        for result in results:
+            for key in ("added", "removed", "full", "failed"):
+                totals[key] += result.get(key, 0)
+        if server_ids:
+            logger.info(
+                f"Синхронизация узлов: {totals['nodes']} узлов, +{totals['added']} -{totals['removed']}, "
+                f"полных перезаписей {totals['full']}, ошибок {totals['failed']}"
+            )
+        return totals
+
+    async def sync_node(self, server_id: str) -> Dict[str, int]:
+        """Разница желаемого и примененного одного узла"""
+        node = self._nodes[server_id]
+        record = self.registry.get(server_id)
+        node.dirty = False
+        desired = dict(node.desired)
+
+        if not node.api_supported:
+            return await self._deliver_config(server_id, node, desired)
+
+        reconcile = node.applied is None
+        if reconcile:
+            # Полный набор поверх пустого; снимок подсказывает, кого удалить
+            applied: Dict[str, str] = {}
+            to_remove = [
+                email for email, client_id in (node.written or {}).items()
+                if desired.get(email) != client_id
+            ]
+        else:
+            applied = node.applied
+            # Смена UUID - удаление и повторное добавление
+            to_remove = [email for email, client_id in applied.items() if desired.get(email) != client_id]
+        to_add = [(email, client_id) for email, client_id in desired.items() if applied.get(email) != client_id]
+        if not to_remove and not to_add:
+            node.applied = applied
+            node.failures = 0
+            return {}
+
+        call = self._alter_inbound(server_id, record.host)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        stats = {"added": 0, "removed": 0, "failed": 0}
+        unimplemented = False
+
+        async def apply(request: bytes, tolerated: str) -> bool:
+            nonlocal unimplemented
+            async with semaphore:
+                try:
+                    await call(request, timeout=self.timeout)
+                except grpc.aio.AioRpcError as e:
+                    if e.code() == grpc.StatusCode.UNIMPLEMENTED:
+                        unimplemented = True
+                        return False
+                    # Повтор уже примененной операции считается успехом
+                    if tolerated not in (e.details() or "").lower():
+                        raise
+            return True
+
+        async def remove(email: str):
+            if await apply(encode_remove_user_request(self.inbound_tag, email), "not found"):
+                applied.pop(email, None)
+                stats["removed"] += 1
+
+        async def add(email: str, client_id: str):
+            if await apply(encode_add_user_request(self.inbound_tag, email, client_id), "already exists"):
+                applied[email] = client_id
+                stats["added"] += 1
+
+        results = await asyncio.gather(*(remove(email) for email in to_remove), return_exceptions=True)
+        results += await asyncio.gather(*(add(email, client_id) for email, client_id in to_add), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+
+        if unimplemented:
+            logger.warning(f"Узел {server_id} без HandlerService, переход на доставку config.json через агент")
+            node.api_supported = False
+            return await self._deliver_config(server_id, node, desired)
+
+        if errors:
+            stats["failed"] = len(errors)
+            self._retry_later(node)
+            logger.error(f"Ошибка синхронизации узла {server_id}: {len(errors)} операций, {errors[0]}")
+        else:
+            node.failures = 0
+            if reconcile:
+                node.applied = applied
+                logger.info(f"Узел {server_id} сверен: {len(applied)} клиентов")
+        # Неудачная сверка повторяется целиком: состояние остается неизвестным
+        return stats
+
+    def _retry_later(self, node: NodeClients):
+        node.dirty = True
+        node.failures += 1
+        node.retry_at = time.monotonic() + min(MAX_RETRY_DELAY, 2 ** node.failures)
+
+    async def _deliver_config(self, server_id: str, node: NodeClients, desired: Dict[str, str]) -> Dict[str, int]:
+        """Узел без HandlerService: полный config.json через node agent"""
+        # Xray перезапускается при каждой доставке, поэтому не чаще периода снимков
+        wait = node.last_full_sync + self.snapshot_interval - time.monotonic()
+        if node.delivered is not None and wait > 0:
+            node.dirty = True
+            node.retry_at = time.monotonic() + wait
+            return {}
+
+        record = self.registry.get(server_id)
+        try:
+            config = await self._build_config(server_id, desired)
+            await self._push_config(record.host, config)
+        except Exception as e:
+            self._retry_later(node)
+            logger.error(f"Ошибка доставки конфигурации узла {server_id} через агент: {e}")
+            return {"failed": 1}
+
+        node.delivered = dict(desired)
+        node.applied = dict(desired)
+        node.failures = 0
+        node.last_full_sync = time.monotonic()
+        logger.info(f"Конфигурация узла {server_id} доставлена агентом: {len(desired)} клиентов")
+        return {"full": 1}
+
+    async def _push_config(self, host: str, config: Dict[str, Any]):
+        """PUT /config node agent; успех - только ответ 2xx"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=AGENT_PUSH_TIMEOUT))
+        headers = {"X-Agent-Token": settings.NODE_AGENT_TOKEN} if settings.NODE_AGENT_TOKEN else {}
+        url = f"http://{host}:{settings.NODE_AGENT_PORT}/config"
+        async with self._session.put(url, json=config, headers=headers) as response:
+            if response.status >= 400:
+                raise RuntimeError(f"агент ответил {response.status}: {(await response.text())[:200]}")
+
+    def _alter_inbound(self, server_id: str, host: str):
+        """Вызов AlterInbound по общему каналу узла (порт API Xray)"""
+        target = f"{host}:{settings.XRAY_STATS_PORT}"
+        cached = self._channels.get(server_id)
+        if cached is None or cached[0] != target:
+            if cached is not None:
+                asyncio.create_task(cached[1].close())
+            channel = grpc.aio.insecure_channel(target)
+            cached = self._channels[server_id] = (target, channel, channel.unary_unary(ALTER_INBOUND_METHOD))
+        return cached[2]
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.write_snapshots()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка записи снимков конфигураций узлов: {e}")
+
+    async def write_snapshots(self):
+        """Запись config.json узлов, чьи клиенты менялись с прошлого снимка"""
+        for server_id, node in list(self._nodes.items()):
+            if not node.snapshot_dirty or self.registry.get(server_id) is None:
+                continue
+            desired = dict(node.desired)
+            node.snapshot_dirty = False
+            try:
+                await self._write_config(server_id, desired)
+                node.written = desired
+            except Exception as e:
+                node.snapshot_dirty = True
+                logger.error(f"Ошибка снимка конфигурации узла {server_id}: {e}")
+
+    def _config_path(self, server_id: str) -> str:
+        return os.path.join(self.config_dir, f"{server_id}.json")
+
+    async def _write_config(self, server_id: str, clients: Dict[str, str]):
+        """Атомарная запись локального снимка config.json узла"""
+        config = await self._build_config(server_id, clients)
+        await asyncio.to_thread(self._dump, self._config_path(server_id), config)
+
+    async def _build_config(self, server_id: str, clients: Dict[str, str]) -> Dict[str, Any]:
+        """Полный config.json узла с заданными клиентами"""
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Server.host, Server.port, Server.reality_private_key, Server.reality_short_id)
+                .where(Server.server_id == server_id)
+            )
+            server = result.first()
+        if server is None:
+            raise ValueError(f"Сервер {server_id} не найден")
+
+        config = generate_server_config(
+            server_id,
+            server.host,
+            server.port,
+            {"private_key": server.reality_private_key, "short_id": server.reality_short_id},
+            clients=[vless_client(client_id, email) for email, client_id in clients.items()],
+            sni_domains=self.sni_domains(),
+            inbound_tag=self.inbound_tag,
+            api_port=settings.XRAY_STATS_PORT
+        )
+        return config
+
+    @staticmethod
+    def _dump(path: str, config: Dict[str, Any]):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(config, f, separators=(",", ":"))
+        os.replace(temporary, path)
+
+    def _read_snapshot(self, server_id: str) -> Optional[Dict[str, str]]:
+        """Клиенты инбаунда из записанного ранее config.json"""
+        try:
+            with open(self._config_path(server_id)) as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка чтения конфигурации узла {server_id}: {e}")
+            return None
+        for inbound in config.get("inbounds", []):
+            if inbound.get("tag") == self.inbound_tag:
+                return {
+                    client.get("email", ""): client["id"]
+                    for client in inbound.get("settings", {}).get("clients", [])
+                }
+        return None
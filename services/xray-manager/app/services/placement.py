@@ -0,0 +1,182 @@
+import hashlib
+import logging
+import random
+from abc import ABC, abstractmethod
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.services.server_registry import ServerRecord, ServerRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class PlacementStrategy(ABC):
+    """Базовая стратегия выбора сервера для пользователя"""
+
+    name = "base"
+
+    @abstractmethod
+    def select(self, registry: ServerRegistry, user_id: Optional[int] = None) -> Optional[ServerRecord]:
+        """Сервер для пользователя или None, если подходящих нет"""
+
+
+class LeastLoadStrategy(PlacementStrategy):
+    """Наименее загруженный сервер из кучи реестра, O(log n)"""
+
+    name = "least_load"
+
+    def select(self, registry: ServerRegistry, user_id: Optional[int] = None) -> Optional[ServerRecord]:
+        return registry.pick()
+
+
+class WeightedRandomStrategy(PlacementStrategy):
+    """Случайный выбор с весом, пропорциональным свободной емкости"""
+
+    name = "weighted_random"
+
+    def __init__(self, rng: Optional[random.Random] = None):
+        self.rng = rng or random.Random()
+
+    def select(self, registry: ServerRegistry, user_id: Optional[int] = None) -> Optional[ServerRecord]:
+        candidates = registry.available()
+        if not candidates:
+            return None
+        weights = [max(1.0 - record.load(), 0.0) for record in candidates]
+        if not any(weights):
+            return min(candidates, key=ServerRecord.load)
+        return self.rng.choices(candidates, weights=weights)[0]
+
+
+class PowerOfTwoChoicesStrategy(PlacementStrategy):
+    """Два случайных кандидата, выбирается менее загруженный"""
+
+    name = "p2c"
+
+    def __init__(self, rng: Optional[random.Random] = None):
+        self.rng = rng or random.Random()
+
+    def select(self, registry: ServerRegistry, user_id: Optional[int] = None) -> Optional[ServerRecord]:
+        candidates = registry.available()
+        if len(candidates) < 2:
+            return candidates[0] if candidates else None
+        first, second = self.rng.sample(candidates, 2)
+        return first if first.load() <= second.load() else second
+
+
+class ConsistentHashStrategy(PlacementStrategy):
+    """Консистентное хеширование по user_id с ограничением нагрузки
+
+    Пользователь попадает на один и тот же сервер, пока тот доступен и не
+    перегружен; иначе выбирается следующий узел по кольцу.
+    """
+
+    name = "consistent_hash"
+
+    def __init__(self, replicas: int = settings.PLACEMENT_HASH_REPLICAS, max_load: float = 1.0):
+        self.replicas = replicas
+        self.max_load = max_load
+        self._ring: List[Tuple[int, ServerRecord]] = []
+        self._points: List[int] = []
+        self._members: Optional[List[ServerRecord]] = None
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def _rebuild(self, candidates: List[ServerRecord]):
+        ring = [
+            (self._hash(f"{record.server_id}#{replica}"), record)
+            for record in candidates
+            for replica in range(self.replicas)
+        ]
+        ring.sort(key=lambda point: point[0])
+        self._ring = ring
+        self._points = [point for point, _ in ring]
+        self._members = candidates
+
+    def select(self, registry: ServerRegistry, user_id: Optional[int] = None) -> Optional[ServerRecord]:
+        candidates = registry.available()
+        if not candidates:
+            return None
+        if candidates is not self._members:
+            self._rebuild(candidates)
+
+        start = bisect_right(self._points, self._hash(str(user_id)))
+        seen = set()
+        for offset in range(len(self._ring)):
+            record = self._ring[(start + offset) % len(self._ring)][1]
+            if record.server_id in seen:
+                continue
+            if record.load() < self.max_load:
+                return record
+            seen.add(record.server_id)
+            if len(seen) == len(candidates):
+                break
+        return min(candidates, key=ServerRecord.load)
+
+
+STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (
+        LeastLoadStrategy,
+        WeightedRandomStrategy,
+        PowerOfTwoChoicesStrategy,
+        ConsistentHashStrategy
+    )
+}
+
+
+class PlacementEngine:
+    """Размещение пользователей по серверам с учетом назначений в полете
+
+    Каждое назначение сразу увеличивает pending у выбранного сервера, поэтому
+    параллельные вызовы видят растущую нагрузку, не дожидаясь обновления
+    connection_count из телеметрии.
+    """
+
+    def __init__(self, registry: ServerRegistry, strategy: Optional[PlacementStrategy] = None):
+        self.registry = registry
+        self.strategy = strategy or create_strategy(settings.PLACEMENT_STRATEGY)
+        self.assignments: Dict[str, int] = {}
+
+    def reserve(self, user_id: Optional[int] = None) -> Optional[ServerRecord]:
+        """Выбор сервера и резервирование места на нем"""
+        record = self.strategy.select(self.registry, user_id)
+        if record is None:
+            return None
+        self.registry.update(record.server_id, pending=record.pending + 1)
+        self.assignments[record.server_id] = self.assignments.get(record.server_id, 0) + 1
+        return record
+
+    def release(self, server_id: str, count: int = 1):
+        """Отмена резервирования (конфигурация не была создана)"""
+        record = self.registry.get(server_id)
+        if record is not None:
+            self.registry.update(server_id, pending=max(record.pending - count, 0))
+
+    def counters_refreshed(self, server_id: str, connection_count: int, **fields):
+        """Новые счетчики сервера уже учитывают выданные назначения"""
+        self.registry.update(server_id, connection_count=connection_count, pending=0, **fields)
+
+    def imbalance(self) -> Dict[str, float]:
+        """Метрики дисбаланса текущей нагрузки по доступным серверам"""
+        loads = [record.load() for record in self.registry.available()]
+        if not loads:
+            return {"servers": 0, "max_to_mean": 0.0, "cv": 0.0}
+        mean = sum(loads) / len(loads)
+        variance = sum((load - mean) ** 2 for load in loads) / len(loads)
+        return {
+            "servers": len(loads),
+            "max_to_mean": max(loads) / mean if mean else 0.0,
+            "cv": variance ** 0.5 / mean if mean else 0.0
+        }
+
+
+def create_strategy(name: str) -> PlacementStrategy:
+    """Создание стратегии по имени из настроек"""
+    strategy = STRATEGIES.get(name)
+    if strategy is None:
+        logger.warning(f"Неизвестная стратегия размещения {name}, используется p2c")
+        strategy = PowerOfTwoChoicesStrategy
+    return strategy()
@@ -0,0 +1,209 @@
+import heapq
+import logging
+from typing import Dict, List, Any, Optional, Tuple
+
+from app.config import settings
+from app.models import Server
+
+logger = logging.getLogger(__name__)
+
+
+class ServerRecord:
+    """Запись сервера в памяти для горячего пути"""
+
+    __slots__ = (
+        "id", "server_id", "name", "host", "port", "uuid",
+        "reality_public_key", "reality_short_id", "status", "is_healthy",
+        "cpu_usage", "memory_usage", "connection_count", "bandwidth_usage",
+        "pending", "version"
+    )
+
+    def __init__(
+        self,
+        id: int,
+        server_id: str,
+        name: str,
+        host: str,
+        port: int,
+        uuid: str,
+        reality_public_key: str,
+        reality_short_id: str,
+        status: str = "active",
+        is_healthy: bool = True,
+        cpu_usage: float = 0.0,
+        memory_usage: float = 0.0,
+        connection_count: int = 0,
+        bandwidth_usage: float = 0.0
+    ):
+        self.id = id
+        self.server_id = server_id
+        self.name = name
+        self.host = host
+        self.port = port
+        self.uuid = uuid
+        self.reality_public_key = reality_public_key
+        self.reality_short_id = reality_short_id
+        self.status = status
+        self.is_healthy = is_healthy
+        self.cpu_usage = cpu_usage or 0.0
+        self.memory_usage = memory_usage or 0.0
+        self.connection_count = connection_count or 0
+        self.bandwidth_usage = bandwidth_usage or 0.0
+        # Назначения, еще не отраженные в connection_count
+        self.pending = 0
+        self.version = 0
+
+    @classmethod
+    def from_model(cls, server: Server) -> "ServerRecord":
+        """Создание записи из ORM модели"""
+        return cls(
+            id=server.id,
+            server_id=server.server_id,
+            name=server.name,
+            host=server.host,
+            port=server.port,
+            uuid=server.uuid,
+            reality_public_key=server.reality_public_key,
+            reality_short_id=server.reality_short_id,
+            status=server.status,
+            is_healthy=bool(server.is_healthy),
+            cpu_usage=server.cpu_usage,
+            memory_usage=server.memory_usage,
+            connection_count=server.connection_count,
+            bandwidth_usage=server.bandwidth_usage
+        )
+
+    @property
+    def is_available(self) -> bool:
+        """Можно ли выдавать конфигурации на этот сервер"""
+        return self.status == "active" and self.is_healthy
+
+    def load(self) -> float:
+        """Загрузка сервера в долях от 0 до 1 по самому узкому ресурсу"""
+        connections = (self.connection_count + self.pending) / settings.PLACEMENT_CONNECTION_CAPACITY
+        bandwidth = self.bandwidth_usage / settings.PLACEMENT_BANDWIDTH_CAPACITY
+        return max(
+            self.cpu_usage / 100.0,
+            self.memory_usage / 100.0,
+            bandwidth,
+            connections
+        )
+
+    def score(self) -> Tuple[int, float]:
+        """Ключ сортировки в куче: сначала здоровье, затем нагрузка"""
+        return (0 if self.is_available else 1, self.load())
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.server_id,
+            "name": self.name,
+            "status": self.status,
+            "is_healthy": self.is_healthy,
+            "cpu_usage": self.cpu_usage,
+            "memory_usage": self.memory_usage,
+            "connection_count": self.connection_count,
+            "pending": self.pending,
+            "load": round(self.load(), 4)
+        }
+
+
+class ServerRegistry:
+    """Индекс серверов в памяти с кучей по нагрузке и здоровью
+
+    Записи в куче не удаляются при изменении сервера: у каждой записи есть
+    версия, устаревшие элементы отбрасываются при чтении вершины.
+    """
+
+    def __init__(self):
+        self.records: Dict[str, ServerRecord] = {}
+        self._by_id: Dict[int, ServerRecord] = {}
+        self._heap: List[Tuple[Tuple[int, float], int, str]] = []
+        self._available: Optional[List[ServerRecord]] = None
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def get(self, server_id: str) -> Optional[ServerRecord]:
+        return self.records.get(server_id)
+
+    def get_by_id(self, id: int) -> Optional[ServerRecord]:
+        return self._by_id.get(id)
+
+    def upsert(self, record: ServerRecord):
+        """Добавление или замена записи сервера"""
+        previous = self.records.get(record.server_id)
+        if previous is not None:
+            record.version = previous.version + 1
+            record.pending = previous.pending
+            if previous.id != record.id:
+                self._by_id.pop(previous.id, None)
+        self.records[record.server_id] = record
+        self._by_id[record.id] = record
+        self._available = None
+        self._push(record)
+
+    def remove(self, server_id: str) -> Optional[ServerRecord]:
+        """Удаление сервера из индекса"""
+        record = self.records.pop(server_id, None)
+        if record is not None:
+            self._by_id.pop(record.id, None)
+            self._available = None
+            # Устаревшие элементы кучи будут отброшены при чтении
+            record.version += 1
+        return record
+
+    def update(self, server_id: str, **fields) -> Optional[ServerRecord]:
+        """Обновление полей записи с переупорядочиванием в куче"""
+        record = self.records.get(server_id)
+        if record is None:
+            return None
+        for field, value in fields.items():
+            setattr(record, field, value)
+        if "status" in fields or "is_healthy" in fields:
+            self._available = None
+        record.version += 1
+        self._push(record)
+        return record
+
+    def pick(self) -> Optional[ServerRecord]:
+        """Наименее загруженный доступный сервер за O(log n)"""
+        heap = self._heap
+        while heap:
+            _, version, server_id = heap[0]
+            record = self.records.get(server_id)
+            if record is not None and record.version == version:
+                return record if record.is_available else None
+            heapq.heappop(heap)
+        return None
+
+    def available(self) -> List[ServerRecord]:
+        """Список доступных серверов (кэшируется до изменения состава)"""
+        if self._available is None:
+            self._available = [r for r in self.records.values() if r.is_available]
+        return self._available
+
+    def _push(self, record: ServerRecord):
+        heapq.heappush(self._heap, (record.score(), record.version, record.server_id))
+        if len(self._heap) > 2 * len(self.records) + 64:
+            self._compact()
+
+    def _compact(self):
+        """Перестроение кучи без устаревших элементов"""
+        self._heap = [
+            (record.score(), record.version, record.server_id)
+            for record in self.records.values()
+        ]
+        heapq.heapify(self._heap)
+
+    def status(self) -> Dict[str, Any]:
+        """Сводка по серверам без обращения к БД"""
+        records = list(self.records.values())
+        return {
+            "total": len(records),
+            "active": sum(1 for r in records if r.status == "active"),
+            "healthy": sum(1 for r in records if r.is_healthy),
+            "servers": [r.to_dict() for r in records]
+        }
@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import random
+import ssl
+import time
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Tuple
+
+from sqlalchemy import bindparam, select, update
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import SNIDomain
+
+logger = logging.getLogger(__name__)
+
+# Латентность по умолчанию для доменов без измерений (секунды)
+DEFAULT_LATENCY = 0.2
+# Затухание счетчика недавних выборов при каждом новом выборе
+SHARE_DECAY = 0.995
+
+
+def parse_interval(value: str) -> int:
+    """Перевод интервала вида 30s/5m/6h в секунды"""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    value = str(value).strip()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+class DomainScore:
+    """Скользящая оценка SNI домена"""
+
+    __slots__ = (
+        "id", "domain", "latency", "success", "usage_delta",
+        "recent", "probed", "last_checked"
+    )
+
+    def __init__(self, id: Optional[int], domain: str, latency: float = 0.0, success_rate: float = 100.0):
+        self.id = id
+        self.domain = domain
+        self.latency = latency / 1000.0 if latency else DEFAULT_LATENCY
+        self.success = (success_rate if success_rate is not None else 100.0) / 100.0
+        self.usage_delta = 0
+        self.recent = 0.0
+        self.probed = False
+        self.last_checked: Optional[datetime] = None
+
+    @property
+    def is_available(self) -> bool:
+        return self.success >= settings.SNI_MIN_SUCCESS_RATE
+
+    def observe(self, ok: bool, latency: float, alpha: float):
+        """Экспоненциально взвешенное обновление оценки"""
+        self.success += alpha * ((1.0 if ok else 0.0) - self.success)
+        if ok:
+            self.latency += alpha * (latency - self.latency)
+        self.probed = True
+        self.last_checked = datetime.now()
+
+    def weight(self) -> float:
+        """Вес домена при выборе: надежность, деленная на латентность"""
+        return self.success ** 2 / (self.latency + 0.05)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "domain": self.domain,
+            "latency_ms": round(self.latency * 1000, 1),
+            "success_rate": round(self.success * 100, 1),
+            "is_available": self.is_available,
+            "weight": round(self.weight(), 3),
+            "last_checked": self.last_checked.isoformat() if self.last_checked else None
+        }
+
+
+class SNIService:
+    """Выбор SNI доменов по живым TLS пробам
+
+    Каждый домен периодически проверяется TLS рукопожатием, результаты
+    сглаживаются EWMA. Выбор взвешенно-случайный и ограничен долей
+    SNI_MAX_SHARE, чтобы ни один домен не нес всех пользователей.
+    Накопленные оценки сбрасываются в sni_domains пакетно.
+    """
+
+    def __init__(self):
+        self.scores: Dict[str, DomainScore] = {}
+        self.alpha = settings.SNI_SCORE_ALPHA
+        self.max_share = settings.SNI_MAX_SHARE
+        self.rng = random.Random()
+        self._semaphore = asyncio.Semaphore(settings.SNI_PROBE_CONCURRENCY)
+        self._ssl_context = self._create_ssl_context()
+        self._tasks: List[asyncio.Task] = []
+
+    async def initialize(self):
+        """Загрузка доменов и запуск фоновых проб"""
+        logger.info("Инициализация SNI сервиса...")
+        await self._load_domains()
+        self._tasks = [
+            asyncio.create_task(self._loop(self.probe_all, parse_interval(settings.SNI_HEALTH_CHECK_INTERVAL))),
+            asyncio.create_task(self._loop(self.flush, settings.SNI_FLUSH_INTERVAL))
+        ]
+        logger.info(f"SNI сервис инициализирован: {len(self.scores)} доменов")
+
+    async def cleanup(self):
+        """Остановка проб и финальный сброс оценок"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения оценок SNI: {e}")
+        logger.info("SNI сервис очищен")
+
+    async def _loop(self, job, interval: int):
+        while True:
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка фоновой задачи SNI: {e}")
+            await asyncio.sleep(interval)
+
+    async def _load_domains(self):
+        """Загрузка активных доменов с сохраненными метриками"""
+        try:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(
+                    select(SNIDomain.id, SNIDomain.domain, SNIDomain.latency, SNIDomain.success_rate)
+                    .where(SNIDomain.is_active == True)
+                )
+                rows = result.all()
+        except Exception as e:
+            logger.error(f"Ошибка загрузки SNI доменов: {e}")
+            rows = []
+
+        if not rows:
+            rows = [(None, domain, 0.0, 100.0) for domain in settings.SNI_DOMAINS]
+        self.scores = {
+            domain: DomainScore(id, domain, latency, success_rate)
+            for id, domain, latency, success_rate in rows
+        }
+
+    def _create_ssl_context(self) -> ssl.SSLContext:
+        context = ssl.create_default_context()
+        if not settings.SNI_PROBE_VERIFY:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def _probe_address(self, domain: str) -> Tuple[str, int]:
+        """Адрес пробы: сам домен или локальная заглушка из настроек"""
+        if settings.SNI_PROBE_ADDRESS:
+            host, _, port = settings.SNI_PROBE_ADDRESS.rpartition(":")
+            return host, int(port)
+        return domain, settings.SNI_PROBE_PORT
+
+    async def probe(self, domain: str) -> Tuple[bool, float]:
+        """TLS рукопожатие с доменом, возвращает (успех, латентность)"""
+        host, port = self._probe_address(domain)
+        async with self._semaphore:
+            return await self._handshake(domain, host, port)
+
+    async def _handshake(self, domain: str, host: str, port: int) -> Tuple[bool, float]:
+        started = time.perf_counter()
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    host, port,
+                    ssl=self._ssl_context,
+                    server_hostname=domain
+                ),
+                timeout=settings.SNI_PROBE_TIMEOUT
+            )
+            latency = time.perf_counter() - started
+            writer.close()
+            try:
+                await asyncio.wait_for(writer.wait_closed(), timeout=settings.SNI_PROBE_TIMEOUT)
+            except (asyncio.TimeoutError, OSError, ssl.SSLError):
+                pass
+            return True, latency
+        except (asyncio.TimeoutError, OSError, ssl.SSLError) as e:
+            logger.debug(f"Проба SNI {domain} не прошла: {e}")
+            return False, time.perf_counter() - started
+
+    async def probe_all(self) -> List[Dict[str, Any]]:
+        """Параллельная проба всех доменов"""
+        domains = list(self.scores)
+        results = await asyncio.gather(*(self.probe(domain) for domain in domains))
+        for domain, (ok, latency) in zip(domains, results):
+            score = self.scores.get(domain)
+            if score is not None:
+                score.observe(ok, latency, self.alpha)
+        available = sum(1 for score in self.scores.values() if score.is_available)
+        logger.info(f"Проба SNI: доступно {available}/{len(domains)} доменов")
+        return self.get_scores()
+
+    def select_domain(self) -> Optional[str]:
+        """Взвешенный выбор домена с ограничением доли"""
+        candidates = [score for score in self.scores.values() if score.is_available]
+        if not candidates:
+            candidates = list(self.scores.values())
+        if not candidates:
+            return None
+
+        total_recent = sum(score.recent for score in self.scores.values())
+        if len(candidates) > 1 and total_recent > 0:
+            limited = [
+                score for score in candidates
+                if score.recent / total_recent < self.max_share
+            ]
+            candidates = limited or candidates
+
+        chosen = self.rng.choices(candidates, weights=[score.weight() for score in candidates])[0]
+        for score in self.scores.values():
+            score.recent *= SHARE_DECAY
+        chosen.recent += 1.0
+        chosen.usage_delta += 1
+        return chosen.domain
+
+    async def flush(self):
+        """Пакетная запись оценок и счетчиков использования в sni_domains"""
+        rows = [
+            {
+                "_id": score.id,
+                "_latency": round(score.latency * 1000, 2),
+                "_success_rate": round(score.success * 100, 2),
+                "_usage": score.usage_delta,
+                "_available": score.is_available,
+                "_checked": score.last_checked or datetime.now()
+            }
+            for score in self.scores.values()
+            if score.id is not None and (score.probed or score.usage_delta)
+        ]
+        if not rows:
+            return
+
+        table = SNIDomain.__table__
+        statement = (
+            update(table)
+            .where(table.c.id == bindparam("_id"))
+            .values(
+                latency=bindparam("_latency"),
+                success_rate=bindparam("_success_rate"),
+                usage_count=table.c.usage_count + bindparam("_usage"),
+                is_available=bindparam("_available"),
+                last_checked=bindparam("_checked")
+            )
+        )
+        async with AsyncSessionLocal() as db:
+            await db.execute(statement, rows)
+            await db.commit()
+
+        # Выборы, сделанные во время записи, попадут в следующий сброс
+        flushed = {row["_id"]: row["_usage"] for row in rows}
+        for score in self.scores.values():
+            if score.id in flushed:
+                score.usage_delta -= flushed[score.id]
+                score.probed = False
+
+    def get_scores(self) -> List[Dict[str, Any]]:
+        return [score.to_dict() for score in self.scores.values()]
+
+    async def get_sni_status(self) -> Dict[str, Any]:
+        """Статус SNI доменов для health check"""
+        return {
+            "total": len(self.scores),
+            "available": sum(1 for score in self.scores.values() if score.is_available),
+            "domains": self.get_scores()
+        }
+
+
+# Общий экземпляр сервиса
+sni_service = SNIService()
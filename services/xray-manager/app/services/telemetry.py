@@ -0,0 +1,313 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Any, NamedTuple, Optional, Tuple
+
+import aiohttp
+import grpc
+from sqlalchemy import bindparam, func, select, update
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Config, Server
+from app.services.metrics_store import metrics_store
+from app.services.server_registry import ServerRecord
+from app.services.traffic_accounting import traffic_accountant
+from app.utils.xray_proto import (
+    QUERY_STATS_METHOD,
+    decode_query_stats_response,
+    encode_query_stats_request
+)
+
+logger = logging.getLogger(__name__)
+
+# Счетчики трафика пользователей: user>>>{email}>>>traffic>>>{uplink|downlink}
+USER_STATS_PATTERN = "user>>>"
+# Предел кэша соответствий email -> configs.id
+CONFIG_ID_CACHE_SIZE = 100000
+
+
+class NodeSample(NamedTuple):
+    """Телеметрия одного узла за один проход"""
+    id: int
+    server_id: str
+    ok: bool
+    cpu_usage: Optional[float]
+    memory_usage: Optional[float]
+    disk_usage: Optional[float]
+    connection_count: Optional[int]
+    bandwidth_usage: Optional[float]
+    # email клиента -> (uplink, downlink) байт с прошлого прохода
+    traffic: Dict[str, Tuple[int, int]]
+    # Счетчики StatsService уменьшились: Xray перезапускался
+    restarted: bool
+    error: Optional[str]
+
+
+class NodeState:
+    """Предыдущие значения кумулятивных счетчиков узла"""
+
+    __slots__ = ("cpu_total", "cpu_idle", "net_bytes", "sampled_at", "user_counters")
+
+    def __init__(self):
+        self.cpu_total: Optional[int] = None
+        self.cpu_idle: Optional[int] = None
+        self.net_bytes: Optional[int] = None
+        self.sampled_at: Optional[float] = None
+        self.user_counters: Dict[Tuple[str, str], int] = {}
+
+
+def counter_delta(current: int, previous: Optional[int]) -> int:
+    """Прирост кумулятивного счетчика; уменьшение значит перезапуск Xray"""
+    if previous is None:
+        return 0
+    return current - previous if current >= previous else current
+
+
+class TelemetryCollector:
+    """Сбор телеметрии с узлов Xray
+
+    С каждого узла параллельно читаются счетчики трафика пользователей
+    через gRPC StatsService и системные метрики node agent по HTTP.
+    Каналы gRPC и HTTP соединения переиспользуются между проходами.
+    Результаты прохода пишутся пакетно: точки в хранилище метрик,
+    приращения трафика в учет трафика (часовые корзины в памяти) и горячие
+    поля servers одним UPDATE.
+    """
+
+    def __init__(
+        self,
+        targets: Callable[[], Iterable[ServerRecord]],
+        interval: int = settings.TELEMETRY_INTERVAL,
+        timeout: float = settings.TELEMETRY_TIMEOUT,
+        concurrency: int = settings.TELEMETRY_CONCURRENCY,
+        on_results: Optional[Callable[[List[NodeSample]], None]] = None
+    ):
+        self.targets = targets
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.on_results = on_results
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._channels: Dict[str, Tuple[str, grpc.aio.Channel, Any]] = {}
+        self._states: Dict[str, NodeState] = {}
+        self._config_ids: Dict[str, int] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запуск периодического сбора"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка сбора и закрытие соединений"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for _, channel, _ in self._channels.values():
+            await channel.close()
+        self._channels.clear()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.collect()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка сбора телеметрии: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def collect(self) -> Dict[str, Any]:
+        """Один проход по всем узлам"""
+        targets = list(self.targets())
+        if not targets:
+            return {"total": 0, "ok": 0}
+
+        started = time.perf_counter()
+        samples = await asyncio.gather(*(self._collect_node(target) for target in targets))
+        await self._store(samples)
+        self._forget_removed({target.server_id for target in targets})
+
+        if self.on_results:
+            self.on_results(samples)
+
+        ok = sum(1 for sample in samples if sample.ok)
+        elapsed = time.perf_counter() - started
+        logger.info(f"Телеметрия: {ok}/{len(samples)} узлов за {elapsed:.2f}с")
+        return {"total": len(samples), "ok": ok, "elapsed": round(elapsed, 3)}
+
+    async def _collect_node(self, target: ServerRecord) -> NodeSample:
+        async with self._semaphore:
+            agent, stats = await asyncio.gather(
+                self._query_agent(target.host),
+                self._query_stats(target.server_id, target.host),
+                return_exceptions=True
+            )
+
+        state = self._states.setdefault(target.server_id, NodeState())
+        errors = [str(result) or type(result).__name__ for result in (agent, stats) if isinstance(result, BaseException)]
+        system = self._system_metrics(state, agent) if not isinstance(agent, BaseException) else {}
+        traffic, restarted = self._traffic(state, stats) if not isinstance(stats, BaseException) else ({}, False)
+
+        return NodeSample(
+            id=target.id,
+            server_id=target.server_id,
+            ok=not errors,
+            cpu_usage=system.get("cpu_usage"),
+            memory_usage=system.get("memory_usage"),
+            disk_usage=system.get("disk_usage"),
+            connection_count=system.get("connection_count"),
+            bandwidth_usage=system.get("bandwidth_usage"),
+            traffic=traffic,
+            restarted=restarted,
+            error="; ".join(errors) or None
+        )
+
+    async def _query_agent(self, host: str) -> Dict[str, Any]:
+        """Системные метрики node agent"""
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=max(60, 2 * self.interval)),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        headers = {"X-Agent-Token": settings.NODE_AGENT_TOKEN} if settings.NODE_AGENT_TOKEN else {}
+        url = f"http://{host}:{settings.NODE_AGENT_PORT}/metrics"
+        async with self._session.get(url, headers=headers) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def _query_stats(self, server_id: str, host: str) -> List[Tuple[str, int]]:
+        """Кумулятивные счетчики пользователей из Xray StatsService"""
+        target = f"{host}:{settings.XRAY_STATS_PORT}"
+        cached = self._channels.get(server_id)
+        if cached is None or cached[0] != target:
+            if cached is not None:
+                await cached[1].close()
+            channel = grpc.aio.insecure_channel(target)
+            # Сообщения кодируются вручную, поэтому сериализаторы не нужны
+            query = channel.unary_unary(QUERY_STATS_METHOD)
+            cached = self._channels[server_id] = (target, channel, query)
+
+        request = encode_query_stats_request(USER_STATS_PATTERN, reset=False)
+        response = await cached[2](request, timeout=self.timeout)
+        return decode_query_stats_response(response)
+
+    def _system_metrics(self, state: NodeState, agent: Dict[str, Any]) -> Dict[str, Any]:
+        now = time.monotonic()
+        metrics = {
+            "memory_usage": float(agent.get("memory_usage", 0.0)),
+            "disk_usage": float(agent.get("disk_usage", 0.0)),
+            "connection_count": int(agent.get("connections", 0))
+        }
+
+        cpu_total, cpu_idle = int(agent.get("cpu_total", 0)), int(agent.get("cpu_idle", 0))
+        net_bytes = int(agent.get("rx_bytes", 0)) + int(agent.get("tx_bytes", 0))
+        if state.cpu_total is not None and cpu_total > state.cpu_total:
+            busy = (cpu_total - state.cpu_total) - (cpu_idle - state.cpu_idle)
+            metrics["cpu_usage"] = round(100.0 * busy / (cpu_total - state.cpu_total), 2)
+        if state.net_bytes is not None and now > state.sampled_at:
+            # Мбит/с, как PLACEMENT_BANDWIDTH_CAPACITY
+            transferred = counter_delta(net_bytes, state.net_bytes)
+            metrics["bandwidth_usage"] = round(transferred * 8 / (now - state.sampled_at) / 1e6, 3)
+
+        state.cpu_total, state.cpu_idle = cpu_total, cpu_idle
+        state.net_bytes, state.sampled_at = net_bytes, now
+        return metrics
+
+    @staticmethod
+    def _traffic(state: NodeState, stats: List[Tuple[str, int]]) -> Tuple[Dict[str, Tuple[int, int]], bool]:
+        traffic: Dict[str, Tuple[int, int]] = {}
+        counters: Dict[Tuple[str, str], int] = {}
+        restarted = False
+        for name, value in stats:
+            parts = name.split(">>>")
+            if len(parts) != 4 or parts[0] != "user" or parts[2] != "traffic":
+                continue
+            key = (parts[1], parts[3])
+            counters[key] = value
+            previous = state.user_counters.get(key)
+            if previous is not None and value < previous:
+                restarted = True
+            delta = counter_delta(value, previous)
+            if delta:
+                uplink, downlink = traffic.get(parts[1], (0, 0))
+                if parts[3] == "uplink":
+                    uplink += delta
+                else:
+                    downlink += delta
+                traffic[parts[1]] = (uplink, downlink)
+        # Клиенты, удаленные с узла, не копятся в памяти
+        state.user_counters = counters
+        return traffic, restarted
+
+    def _forget_removed(self, server_ids: set):
+        for server_id in [s for s in self._states if s not in server_ids]:
+            del self._states[server_id]
+            cached = self._channels.pop(server_id, None)
+            if cached is not None:
+                asyncio.create_task(cached[1].close())
+
+    async def _store(self, samples: List[NodeSample]):
+        """Пакетная запись результатов прохода"""
+        now = datetime.now()
+        measured = [sample for sample in samples if sample.connection_count is not None]
+        for sample in measured:
+            # Первый проход дает только базу для CPU и трафика
+            if sample.cpu_usage is not None:
+                metrics_store.ingest(sample.id, sample._asdict(), now)
+
+        traffic = {email: usage for sample in samples for email, usage in sample.traffic.items()}
+        async with AsyncSessionLocal() as db:
+            if traffic:
+                config_ids = await self._resolve_config_ids(db, list(traffic))
+                traffic_accountant.record(
+                    {config_ids[email]: usage for email, usage in traffic.items() if email in config_ids},
+                    self.interval,
+                    now
+                )
+
+            if measured:
+                table = Server.__table__
+                await db.execute(
+                    update(table)
+                    .where(table.c.id == bindparam("_id"))
+                    .values(
+                        cpu_usage=func.coalesce(bindparam("_cpu"), table.c.cpu_usage),
+                        memory_usage=bindparam("_memory"),
+                        connection_count=bindparam("_connections"),
+                        bandwidth_usage=func.coalesce(bindparam("_bandwidth"), table.c.bandwidth_usage)
+                    ),
+                    [
+                        {
+                            "_id": sample.id,
+                            "_cpu": sample.cpu_usage,
+                            "_memory": sample.memory_usage,
+                            "_connections": sample.connection_count,
+                            "_bandwidth": sample.bandwidth_usage
+                        }
+                        for sample in measured
+                    ]
+                )
+            await db.commit()
+
+    async def _resolve_config_ids(self, db, emails: List[str]) -> Dict[str, int]:
+        """Соответствие email клиента (config_id) -> configs.id одним запросом"""
+        missing = [email for email in emails if email not in self._config_ids]
+        if missing:
+            if len(self._config_ids) + len(missing) > CONFIG_ID_CACHE_SIZE:
+                self._config_ids.clear()
+            result = await db.execute(
+                select(Config.config_id, Config.id).where(Config.config_id.in_(missing))
+            )
+            self._config_ids.update(result.all())
+        return {email: self._config_ids[email] for email in emails if email in self._config_ids}
@@ -0,0 +1,263 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, func, select, update
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Config, ConfigUsage, User
+
+logger = logging.getLogger(__name__)
+
+# Размер пачки идентификаторов в IN (...) при проверке квот
+QUOTA_CHECK_CHUNK = 1000
+
+
+def hour_bucket(timestamp: datetime) -> datetime:
+    """Начало часа, к которому относится момент времени"""
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def _upsert_statement(dialect: str):
+    """INSERT ... ON CONFLICT DO UPDATE для часовых строк config_usage
+
+    Строка накапливает приращения: повторный сброс в тот же час
+    прибавляется к уже записанным байтам, а не заменяет их.
+    """
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+
+    table = ConfigUsage.__table__
+    statement = dialect_insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=["config_id", "timestamp"],
+        set_={
+            column: table.c[column] + statement.excluded[column]
+            for column in ("bytes_uploaded", "bytes_downloaded", "connection_time")
+        }
+    )
+
+
+class TrafficAccountant:
+    """Учет трафика конфигураций
+
+    Сборщик телеметрии передает приращения кумулятивных счетчиков Xray,
+    они складываются в памяти в часовые корзины по конфигурации. Сброс
+    раз в TRAFFIC_FLUSH_INTERVAL пишет все корзины одним upsert'ом,
+    увеличивает итоги configs и last_used одним UPDATE и отключает
+    конфигурации, превысившие квоту. Между сбросами база не трогается.
+    """
+
+    def __init__(
+        self,
+        flush_interval: int = settings.TRAFFIC_FLUSH_INTERVAL,
+        on_quota_exceeded: Optional[Callable[[List[Tuple[int, str, int]]], Awaitable[None]]] = None
+    ):
+        self.flush_interval = flush_interval
+        self.on_quota_exceeded = on_quota_exceeded
+        # (configs.id, час) -> [uplink, downlink, секунды соединения]
+        self._buckets: Dict[Tuple[int, datetime], List[int]] = {}
+        # configs.id -> [uplink, downlink, последнее использование]
+        self._totals: Dict[int, List[Any]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Запуск фонового сброса"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Остановка со сбросом накопленного"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка финального сброса трафика: {e}")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка сброса трафика: {e}")
+
+    def record(self, traffic: Dict[int, Tuple[int, int]], connection_time: int, timestamp: datetime):
+        """Приращения трафика за проход: configs.id -> (uplink, downlink)"""
+        bucket = hour_bucket(timestamp)
+        for config_id, (uplink, downlink) in traffic.items():
+            if not uplink and not downlink:
+                continue
+            self._add(config_id, bucket, uplink, downlink, connection_time, timestamp)
+
+    def _add(self, config_id: int, bucket: datetime, uplink: int, downlink: int, seconds: int, used_at: datetime):
+        usage = self._buckets.get((config_id, bucket))
+        if usage is None:
+            self._buckets[(config_id, bucket)] = [uplink, downlink, seconds]
+        else:
+            usage[0] += uplink
+            usage[1] += downlink
+            usage[2] += seconds
+
+        total = self._totals.get(config_id)
+        if total is None:
+            self._totals[config_id] = [uplink, downlink, used_at]
+        else:
+            total[0] += uplink
+            total[1] += downlink
+            total[2] = max(total[2], used_at)
+
+    def pending(self) -> Dict[str, int]:
+        """Объем несброшенных данных"""
+        return {"buckets": len(self._buckets), "configs": len(self._totals)}
+
+    async def flush(self):
+        """Сброс корзин одним upsert'ом и итогов одним UPDATE"""
+        async with self._flush_lock:
+            buckets, self._buckets = self._buckets, {}
+            totals, self._totals = self._totals, {}
+            if not buckets:
+                return
+
+            try:
+                async with AsyncSessionLocal() as db:
+                    statement = _upsert_statement(db.bind.dialect.name)
+                    await db.execute(statement, [
+                        {
+                            "config_id": config_id,
+                            "timestamp": bucket,
+                            "bytes_uploaded": uplink,
+                            "bytes_downloaded": downlink,
+                            "connection_time": seconds
+                        }
+                        for (config_id, bucket), (uplink, downlink, seconds) in buckets.items()
+                    ])
+
+                    table = Config.__table__
+                    await db.execute(
+                        update(table)
+                        .where(table.c.id == bindparam("_id"))
+                        .values(
+                            bytes_uploaded=func.coalesce(table.c.bytes_uploaded, 0) + bindparam("_uplink"),
+                            bytes_downloaded=func.coalesce(table.c.bytes_downloaded, 0) + bindparam("_downlink"),
+                            last_used=bindparam("_last_used")
+                        ),
+                        [
+                            {"_id": config_id, "_uplink": uplink, "_downlink": downlink, "_last_used": last_used}
+                            for config_id, (uplink, downlink, last_used) in totals.items()
+                        ]
+                    )
+
+                    exceeded = await self._enforce_quotas(db, list(totals))
+                    await db.commit()
+            except Exception:
+                # Приращения вернутся в память и попадут в следующий сброс
+                for (config_id, bucket), (uplink, downlink, seconds) in buckets.items():
+                    self._add(config_id, bucket, uplink, downlink, seconds, totals[config_id][2])
+                raise
+
+            logger.debug(f"Сброшен трафик: {len(buckets)} корзин, {len(totals)} конфигураций")
+            if exceeded:
+                logger.info(f"Квота трафика исчерпана: {len(exceeded)} конфигураций")
+                if self.on_quota_exceeded:
+                    try:
+                        await self.on_quota_exceeded(exceeded)
+                    except Exception as e:
+                        logger.error(f"Ошибка обработки превышения квоты: {e}")
+
+    async def _enforce_quotas(self, db, config_ids: List[int]) -> List[Tuple[int, str, int]]:
+        """Перевод в suspended конфигураций сверх квоты среди обновленных
+
+        Возвращает (configs.id, config_id, servers.id) отключенных.
+        """
+        table = Config.__table__
+        limit = func.coalesce(table.c.traffic_limit, settings.TRAFFIC_QUOTA_BYTES)
+        exceeded: List[Tuple[int, str, int]] = []
+        for offset in range(0, len(config_ids), QUOTA_CHECK_CHUNK):
+            result = await db.execute(
+                update(table)
+                .where(
+                    table.c.id.in_(config_ids[offset:offset + QUOTA_CHECK_CHUNK]),
+                    table.c.status == "active",
+                    limit > 0,
+                    table.c.bytes_uploaded + table.c.bytes_downloaded >= limit
+                )
+                .values(status="suspended")
+                .returning(table.c.id, table.c.config_id, table.c.server_id)
+            )
+            exceeded.extend(tuple(row) for row in result.all())
+        return exceeded
+
+    async def get_user_usage(self, telegram_id: int) -> Dict[str, Any]:
+        """Итоги и трафик за сутки по конфигурациям пользователя"""
+        since = hour_bucket(datetime.now()) - timedelta(hours=23)
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(
+                    Config.id, Config.config_id, Config.status, Config.expires_at,
+                    Config.bytes_uploaded, Config.bytes_downloaded,
+                    Config.traffic_limit, Config.last_used
+                )
+                .join(User, User.id == Config.user_id)
+                .where(User.telegram_id == telegram_id)
+            )
+            configs = result.all()
+
+            daily: Dict[int, Tuple[int, int]] = {}
+            if configs:
+                result = await db.execute(
+                    select(
+                        ConfigUsage.config_id,
+                        func.sum(ConfigUsage.bytes_uploaded),
+                        func.sum(ConfigUsage.bytes_downloaded)
+                    )
+                    .where(
+                        ConfigUsage.config_id.in_([row.id for row in configs]),
+                        ConfigUsage.timestamp >= since
+                    )
+                    .group_by(ConfigUsage.config_id)
+                )
+                daily = {row[0]: (int(row[1] or 0), int(row[2] or 0)) for row in result.all()}
+
+        items = []
+        for row in configs:
+            uplink, downlink = row.bytes_uploaded or 0, row.bytes_downloaded or 0
+            limit = row.traffic_limit if row.traffic_limit is not None else settings.TRAFFIC_QUOTA_BYTES
+            day_uplink, day_downlink = daily.get(row.id, (0, 0))
+            items.append({
+                "config_id": row.config_id,
+                "status": row.status,
+                "expires_at": row.expires_at,
+                "bytes_uploaded": uplink,
+                "bytes_downloaded": downlink,
+                "bytes_total": uplink + downlink,
+                "bytes_last_24h": day_uplink + day_downlink,
+                "traffic_limit": limit or None,
+                "bytes_remaining": max(0, limit - uplink - downlink) if limit else None,
+                "last_used": row.last_used
+            })
+
+        return {
+            "telegram_id": telegram_id,
+            "configs": items,
+            "bytes_total": sum(item["bytes_total"] for item in items),
+            "bytes_last_24h": sum(item["bytes_last_24h"] for item in items),
+            "updated_at": datetime.now()
+        }
+
+
+# Глобальный экземпляр учета трафика
+traffic_accountant = TrafficAccountant()
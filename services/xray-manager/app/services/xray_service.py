@@ -2,16 +2,30 @@ import asyncio
 import json
 import uuid
 import logging
-from typing import List, Dict, Optional, Any
-from datetime import datetime, timedelta
+from typing import AsyncIterator, List, Dict, Optional, Any
+from datetime import datetime
 import subprocess
 import os
 import yaml
 
 from app.config import settings
-from app.database import SessionLocal
+from sqlalchemy import insert, select
+
+from app.database import AsyncSessionLocal
 from app.models import Server, Config, SNIDomain, ServerMetrics
 from app.schemas import ServerCreate, ConfigCreate
+from app.services.change_feed import create_change_feed
+from app.services.count_cache import CountCache
+from app.services.expiry_scheduler import ExpiryScheduler
+from app.services.health_checker import HealthChecker, ProbeResult
+from app.services.metrics_store import metrics_store
+from app.services.node_sync import NodeSync
+from app.services.placement import PlacementEngine
+from app.services.server_registry import ServerRecord, ServerRegistry
+from app.services.sni_service import sni_service
+from app.services.telemetry import NodeSample, TelemetryCollector
+from app.services.traffic_accounting import traffic_accountant
+from shared.share_links import invalidate_server, render_vless_url
 
 logger = logging.getLogger(__name__)
 
@@ -19,9 +33,19 @@ class XrayService:
     """Сервис для управления Xray серверами"""
     
     def __init__(self):
-        self.servers = {}
+        self.registry = ServerRegistry()
+        self.placement = PlacementEngine(self.registry)
         self.config_templates = {}
         self.sni_domains = []
+        self.health_checker = HealthChecker(on_results=self._apply_health_results)
+        self.telemetry = TelemetryCollector(lambda: list(self.registry), on_results=self._apply_telemetry)
+        self.change_feed = create_change_feed()
+        self.change_feed.subscribe(self._on_server_changed)
+        self.server_counts = CountCache(settings.SERVER_COUNT_CACHE_TTL)
+        self.usage_cache = CountCache(settings.TRAFFIC_USAGE_CACHE_TTL, settings.TRAFFIC_USAGE_CACHE_SIZE)
+        self.node_sync = NodeSync(self.registry, lambda: self.sni_domains)
+        self.expiry = ExpiryScheduler(on_expired=self._on_configs_expired)
+        traffic_accountant.on_quota_exceeded = self._on_quota_exceeded
         
     async def initialize(self):
         """Инициализация сервиса"""
@@ -30,12 +54,32 @@ class XrayService:
         # Загрузка конфигурации
         await self._load_config()
         
-        # Инициализация серверов
+        # Инициализация серверов и подписка на их изменения
         await self._initialize_servers()
+        await self.change_feed.start()
         
         # Загрузка SNI доменов
         await self._load_sni_domains()
         
+        # Списки клиентов узлов
+        if settings.NODE_SYNC_ENABLED:
+            await self.node_sync.start()
+        
+        # Отзыв истекших конфигураций
+        if settings.EXPIRY_ENABLED:
+            self.expiry.start()
+        
+        # Запуск периодических проверок здоровья
+        self.health_checker.start()
+        
+        # Фоновые сброс и очистка метрик
+        await metrics_store.start()
+        await traffic_accountant.start()
+        
+        # Сбор телеметрии с узлов
+        if settings.TELEMETRY_ENABLED:
+            self.telemetry.start()
+        
         logger.info("Xray сервис инициализирован")
     
     async def cleanup(self):
@@ -43,8 +87,15 @@ class XrayService:
         logger.info("Очистка Xray сервиса...")
         
         # Остановка мониторинга
-        for server_id in self.servers:
-            await self._stop_server_monitoring(server_id)
+        await self.health_checker.stop()
+        await self.telemetry.stop()
+        await self.change_feed.stop()
+        await self.expiry.stop()
+        await self.node_sync.stop()
+        await metrics_store.stop()
+        await traffic_accountant.stop()
+        for record in self.registry:
+            await self._stop_server_monitoring(record.server_id)
         
         logger.info("Xray сервис очищен")
     
@@ -89,30 +140,127 @@ class XrayService:
     
     async def _initialize_servers(self):
         """Инициализация серверов из БД"""
-        db = SessionLocal()
-        try:
-            servers = db.query(Server).filter(Server.status == "active").all()
-            for server in servers:
-                await self._add_server_to_memory(server)
-        finally:
-            db.close()
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(Server))
+            servers = result.scalars().all()
+        
+        for server in servers:
+            await self._add_server_to_memory(server)
     
     async def _add_server_to_memory(self, server: Server):
         """Добавление сервера в память"""
-        self.servers[server.server_id] = {
-            'id': server.id,
-            'host': server.host,
-            'port': server.port,
-            'uuid': server.uuid,
-            'reality_private_key': server.reality_private_key,
-            'reality_public_key': server.reality_public_key,
-            'reality_short_id': server.reality_short_id,
-            'status': server.status,
-            'is_healthy': server.is_healthy
-        }
+        previous = self.registry.get(server.server_id)
+        record = ServerRecord.from_model(server)
+        self.registry.upsert(record)
+        
+        # Шаблоны ссылок со старым адресом или ключами больше не нужны
+        if previous is not None and (
+            (previous.host, previous.port, previous.reality_public_key, previous.reality_short_id)
+            != (record.host, record.port, record.reality_public_key, record.reality_short_id)
+        ):
+            invalidate_server(server.server_id)
+        is_new = previous is None
         
         # Запуск мониторинга
-        await self._start_server_monitoring(server.server_id)
+        if is_new:
+            await self._start_server_monitoring(server.server_id)
+    
+    async def _on_server_changed(self, op: str, server_id: str):
+        """Синхронизация реестра по ленте изменений"""
+        self.server_counts.invalidate()
+        if op == "delete":
+            invalidate_server(server_id)
+            self.node_sync.forget_server(server_id)
+            if self.registry.remove(server_id):
+                await self._stop_server_monitoring(server_id)
+            return
+        
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(Server).where(Server.server_id == server_id))
+            server = result.scalars().first()
+        
+        if server:
+            await self._add_server_to_memory(server)
+            return
+        self.node_sync.forget_server(server_id)
+        if self.registry.remove(server_id):
+            await self._stop_server_monitoring(server_id)
+    
+    async def notify_server_changed(self, db, op: str, server_id: str):
+        """Публикация изменения сервера после commit (upsert/delete)"""
+        try:
+            await self.change_feed.publish(db, op, server_id)
+        except Exception as e:
+            logger.error(f"Ошибка публикации изменения сервера {server_id}: {e}")
+    
+    async def notify_servers_changed(self, db, op: str, server_ids: List[str]):
+        """Пакетная публикация изменений серверов после commit"""
+        try:
+            await self.change_feed.publish_many(db, op, server_ids)
+        except Exception as e:
+            logger.error(f"Ошибка публикации изменений {len(server_ids)} серверов: {e}")
+    
+    def _apply_telemetry(self, samples: List[NodeSample]):
+        """Реальные счетчики узлов в реестр: pending сбрасывается"""
+        for sample in samples:
+            if sample.restarted:
+                self.node_sync.node_restarted(sample.server_id)
+            if sample.connection_count is None:
+                continue
+            fields = {"memory_usage": sample.memory_usage}
+            if sample.cpu_usage is not None:
+                fields["cpu_usage"] = sample.cpu_usage
+            if sample.bandwidth_usage is not None:
+                fields["bandwidth_usage"] = sample.bandwidth_usage
+            self.placement.counters_refreshed(sample.server_id, sample.connection_count, **fields)
+    
+    async def collect_telemetry(self) -> Dict[str, Any]:
+        """Внеочередной сбор телеметрии со всех узлов"""
+        return await self.telemetry.collect()
+    
+    async def _on_quota_exceeded(self, configs: List[tuple]):
+        """Конфигурации, переведенные в suspended по квоте трафика"""
+        for _, config_id, server_id in configs:
+            logger.warning(f"Конфигурация {config_id} отключена: квота трафика исчерпана")
+            record = self.registry.get_by_id(server_id)
+            if record:
+                self.node_sync.remove_client(record.server_id, config_id)
+        # Пользователи увидят новый статус без ожидания TTL
+        self.usage_cache.invalidate()
+    
+    async def _on_configs_expired(self, configs: List[tuple]):
+        """Удаление истекших клиентов с узлов, сгруппированное по серверу"""
+        by_server: Dict[int, List[str]] = {}
+        for _, config_id, server_id in configs:
+            by_server.setdefault(server_id, []).append(config_id)
+        for server_id, config_ids in by_server.items():
+            record = self.registry.get_by_id(server_id)
+            if record:
+                self.node_sync.remove_clients(record.server_id, config_ids)
+        self.usage_cache.invalidate()
+    
+    async def revoke_user_configs(self, user_ids: List[int]) -> int:
+        """Отзыв конфигураций пользователей, у которых закончилась подписка"""
+        return await self.expiry.revoke_users(list(dict.fromkeys(user_ids)))
+    
+    def get_node_sync_status(self) -> Dict[str, Any]:
+        """Состояние синхронизации клиентов узлов"""
+        return self.node_sync.get_status()
+    
+    async def get_user_usage(self, telegram_id: int) -> Dict[str, Any]:
+        """Трафик пользователя с кэшем на TRAFFIC_USAGE_CACHE_TTL"""
+        usage, cached = await self.usage_cache.get(
+            telegram_id,
+            lambda: traffic_accountant.get_user_usage(telegram_id)
+        )
+        return {**usage, "cached": cached}
+    
+    def _apply_health_results(self, results: List[ProbeResult]):
+        """Перенос результатов проверки здоровья в реестр"""
+        for result in results:
+            record = self.registry.get(result.server_id)
+            if record is not None and record.is_healthy != result.ok:
+                self.registry.update(result.server_id, is_healthy=result.ok)
     
     async def _start_server_monitoring(self, server_id: str):
         """Запуск мониторинга сервера"""
@@ -125,89 +273,60 @@ class XrayService:
     
     async def _load_sni_domains(self):
         """Загрузка SNI доменов"""
-        db = SessionLocal()
-        try:
-            domains = db.query(SNIDomain).filter(SNIDomain.is_active == True).all()
-            self.sni_domains = [domain.domain for domain in domains]
-        finally:
-            db.close()
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(SNIDomain.domain).where(SNIDomain.is_active == True)
+            )
+            self.sni_domains = list(result.scalars().all())
     
     async def get_servers_status(self) -> Dict[str, Any]:
         """Получить статус всех серверов"""
-        db = SessionLocal()
-        try:
-            servers = db.query(Server).all()
-            status = {
-                'total': len(servers),
-                'active': len([s for s in servers if s.status == 'active']),
-                'healthy': len([s for s in servers if s.is_healthy]),
-                'servers': []
-            }
-            
-            for server in servers:
-                status['servers'].append({
-                    'id': server.server_id,
-                    'name': server.name,
-                    'status': server.status,
-                    'is_healthy': server.is_healthy,
-                    'cpu_usage': server.cpu_usage,
-                    'memory_usage': server.memory_usage,
-                    'connection_count': server.connection_count
-                })
-            
-            return status
-        finally:
-            db.close()
+        return self.registry.status()
     
     async def get_server_detailed_status(self, server_id: int) -> Dict[str, Any]:
         """Получить детальный статус сервера"""
-        db = SessionLocal()
-        try:
-            server = db.query(Server).filter(Server.id == server_id).first()
-            if not server:
-                return {}
-            
-            # Проверка доступности сервера
-            is_reachable = await self._check_server_reachability(server.host, server.port)
-            
-            # Получение метрик
-            metrics = await self._get_server_metrics(server_id)
-            
-            return {
-                'server_id': server.server_id,
-                'host': server.host,
-                'port': server.port,
-                'is_reachable': is_reachable,
-                'is_healthy': server.is_healthy,
-                'status': server.status,
-                'last_health_check': server.last_health_check,
-                'metrics': metrics
-            }
-        finally:
-            db.close()
+        async with AsyncSessionLocal() as db:
+            server = await db.get(Server, server_id)
+        if not server:
+            return {}
+        
+        # Проверка доступности сервера (без удержания соединения с БД)
+        is_reachable = await self._check_server_reachability(server.host, server.port)
+        
+        # Получение метрик
+        metrics = await self._get_server_metrics(server_id)
+        
+        return {
+            'server_id': server.server_id,
+            'host': server.host,
+            'port': server.port,
+            'is_reachable': is_reachable,
+            'is_healthy': server.is_healthy,
+            'status': server.status,
+            'last_health_check': server.last_health_check,
+            'metrics': metrics
+        }
     
     async def _check_server_reachability(self, host: str, port: int) -> bool:
         """Проверка доступности сервера"""
         try:
-            # Простая проверка TCP соединения
-            import socket
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(5)
-            result = sock.connect_ex((host, port))
-            sock.close()
-            return result == 0
+            result = await self.health_checker.probe(host, port)
+            return result.ok
         except Exception as e:
             logger.error(f"Ошибка проверки доступности {host}:{port}: {e}")
             return False
     
     async def _get_server_metrics(self, server_id: int) -> Dict[str, Any]:
         """Получить метрики сервера"""
-        db = SessionLocal()
-        try:
+        async with AsyncSessionLocal() as db:
             # Получение последних метрик
-            metrics = db.query(ServerMetrics).filter(
-                ServerMetrics.server_id == server_id
-            ).order_by(ServerMetrics.timestamp.desc()).first()
+            result = await db.execute(
+                select(ServerMetrics)
+                .where(ServerMetrics.server_id == server_id)
+                .order_by(ServerMetrics.timestamp.desc())
+                .limit(1)
+            )
+            metrics = result.scalars().first()
             
             if metrics:
                 return {
@@ -227,168 +346,279 @@ class XrayService:
                     'bandwidth_usage': 0.0,
                     'timestamp': datetime.now()
                 }
-        finally:
-            db.close()
     
-    async def get_server_metrics(self, server_id: int, hours: int = 24) -> List[Dict[str, Any]]:
-        """Получить метрики сервера за период"""
-        db = SessionLocal()
-        try:
-            since = datetime.now() - timedelta(hours=hours)
-            metrics = db.query(ServerMetrics).filter(
-                ServerMetrics.server_id == server_id,
-                ServerMetrics.timestamp >= since
-            ).order_by(ServerMetrics.timestamp.asc()).all()
-            
-            return [
-                {
-                    'timestamp': metric.timestamp,
-                    'cpu_usage': metric.cpu_usage,
-                    'memory_usage': metric.memory_usage,
-                    'disk_usage': metric.disk_usage,
-                    'connection_count': metric.connection_count,
-                    'bandwidth_usage': metric.bandwidth_usage
-                }
-                for metric in metrics
-            ]
-        finally:
-            db.close()
+    def record_server_metrics(self, server_id: int, sample: Dict[str, Any], timestamp: Optional[datetime] = None):
+        """Прием точки метрик сервера в хранилище временных рядов"""
+        metrics_store.ingest(server_id, sample, timestamp)
+    
+    async def get_server_metrics(
+        self,
+        server_id: int,
+        start: datetime,
+        end: Optional[datetime] = None,
+        metrics: Optional[List[str]] = None,
+        max_points: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Получить метрики сервера за период в колоночном виде"""
+        return await metrics_store.query(server_id, start, end, metrics, max_points)
+    
+    def can_export_metrics(self, start: datetime, step: int) -> bool:
+        """Есть ли хранящийся источник метрик для шага step"""
+        return metrics_store.choose_source(start, step) is not None
+    
+    def export_server_metrics(
+        self,
+        server_id: int,
+        start: datetime,
+        end: datetime,
+        step: Optional[int] = None,
+        metrics: Optional[List[str]] = None
+    ):
+        """Потоковая выгрузка метрик сервера чанками (колонки, строки)"""
+        return metrics_store.export(server_id, start, end, step, metrics)
     
     async def check_server_health(self, server_id: int):
         """Проверка здоровья сервера"""
-        db = SessionLocal()
-        try:
-            server = db.query(Server).filter(Server.id == server_id).first()
-            if not server:
-                return
-            
-            # Проверка доступности
-            is_reachable = await self._check_server_reachability(server.host, server.port)
-            
-            # Обновление статуса
-            server.is_healthy = is_reachable
-            server.last_health_check = datetime.now()
-            
-            if is_reachable:
-                # Получение метрик (здесь можно добавить реальный мониторинг)
-                server.cpu_usage = 0.0  # Заглушка
-                server.memory_usage = 0.0  # Заглушка
-                server.connection_count = 0  # Заглушка
-            
-            db.commit()
-            
-            logger.info(f"Проверка здоровья сервера {server.server_id}: {'OK' if is_reachable else 'FAIL'}")
-            
-        except Exception as e:
-            logger.error(f"Ошибка проверки здоровья сервера {server_id}: {e}")
-            db.rollback()
-        finally:
-            db.close()
+        async with AsyncSessionLocal() as db:
+            try:
+                server = await db.get(Server, server_id)
+                if not server:
+                    return
+                # Соединение возвращается в пул на время проверки
+                await db.commit()
+                
+                # Проверка доступности
+                is_reachable = await self._check_server_reachability(server.host, server.port)
+                
+                # Обновление статуса; нагрузку пишет сборщик телеметрии
+                server.is_healthy = is_reachable
+                server.last_health_check = datetime.now()
+                
+                await db.commit()
+                await self.notify_server_changed(db, "upsert", server.server_id)
+                
+                logger.info(f"Проверка здоровья сервера {server.server_id}: {'OK' if is_reachable else 'FAIL'}")
+                
+            except Exception as e:
+                logger.error(f"Ошибка проверки здоровья сервера {server_id}: {e}")
+                await db.rollback()
+    
+    async def check_all_servers_health(self) -> Dict[str, Any]:
+        """Параллельная проверка здоровья всех серверов"""
+        return await self.health_checker.sweep()
+    
+    def get_health_latency_stats(self) -> Dict[str, Any]:
+        """Гистограммы латентности проверок здоровья"""
+        return self.health_checker.get_latency_stats()
     
     async def restart_server(self, server_id: int):
         """Перезапуск сервера"""
-        db = SessionLocal()
-        try:
-            server = db.query(Server).filter(Server.id == server_id).first()
-            if not server:
-                return
-            
-            # Здесь можно добавить логику перезапуска Xray сервиса
-            # Например, через systemctl или docker
-            
-            logger.info(f"Перезапуск сервера {server.server_id}")
-            
-            # Обновление статуса
-            server.status = "maintenance"
-            db.commit()
-            
-            # Симуляция перезапуска
-            await asyncio.sleep(5)
-            
-            server.status = "active"
-            server.is_healthy = True
-            server.last_health_check = datetime.now()
-            db.commit()
-            
-            logger.info(f"Сервер {server.server_id} перезапущен")
-            
-        except Exception as e:
-            logger.error(f"Ошибка перезапуска сервера {server_id}: {e}")
-            db.rollback()
-        finally:
-            db.close()
+        async with AsyncSessionLocal() as db:
+            try:
+                server = await db.get(Server, server_id)
+                if not server:
+                    return
+                
+                # Здесь можно добавить логику перезапуска Xray сервиса
+                # Например, через systemctl или docker
+                
+                logger.info(f"Перезапуск сервера {server.server_id}")
+                
+                # Обновление статуса
+                server.status = "maintenance"
+                await db.commit()
+                await self.notify_server_changed(db, "upsert", server.server_id)
+                
+                # Симуляция перезапуска
+                await asyncio.sleep(5)
+                
+                server.status = "active"
+                server.is_healthy = True
+                server.last_health_check = datetime.now()
+                await db.commit()
+                await self.notify_server_changed(db, "upsert", server.server_id)
+                
+                logger.info(f"Сервер {server.server_id} перезапущен")
+                
+            except Exception as e:
+                logger.error(f"Ошибка перезапуска сервера {server_id}: {e}")
+                await db.rollback()
     
     async def generate_config(self, user_id: int, server_id: Optional[int] = None) -> Dict[str, Any]:
         """Генерация конфигурации для пользователя"""
-        db = SessionLocal()
-        try:
-            # Выбор сервера
-            if server_id:
-                server = db.query(Server).filter(Server.id == server_id).first()
-            else:
-                # Выбор наименее загруженного сервера
-                server = db.query(Server).filter(
-                    Server.status == "active",
-                    Server.is_healthy == True
-                ).order_by(Server.connection_count.asc()).first()
-            
-            if not server:
-                raise Exception("Нет доступных серверов")
-            
-            # Выбор SNI домена
-            sni_domain = await self._get_best_sni_domain()
-            
-            # Генерация конфигурации
-            config_data = await self._create_vless_reality_config(
-                server, sni_domain
-            )
-            
-            # Создание записи в БД
-            config = Config(
-                config_id=f"config-{uuid.uuid4().hex[:8]}",
-                user_id=user_id,
-                server_id=server.id,
-                config_data=json.dumps(config_data),
-                config_url=self._generate_vless_url(config_data),
-                sni_domain=sni_domain,
-                sni_dest=f"{sni_domain}:443"
-            )
-            
-            db.add(config)
-            db.commit()
-            db.refresh(config)
-            
-            logger.info(f"Создана конфигурация {config.config_id} для пользователя {user_id}")
+        reserved = None
+        async with AsyncSessionLocal() as db:
+            try:
+                # Выбор сервера из реестра в памяти
+                if server_id:
+                    server = self.registry.get_by_id(server_id)
+                else:
+                    # Размещение с учетом назначений в полете
+                    server = reserved = self.placement.reserve(user_id)
+                
+                if not server:
+                    raise Exception("Нет доступных серверов")
+                
+                # Выбор SNI домена
+                sni_domain = await self._get_best_sni_domain()
+                
+                # Генерация конфигурации со своим UUID клиента
+                client_uuid = str(uuid.uuid4())
+                config_data = await self._create_vless_reality_config(
+                    server, sni_domain, client_uuid
+                )
+                
+                # Создание записи в БД
+                config = Config(
+                    config_id=self._new_config_id(),
+                    user_id=user_id,
+                    server_id=server.id,
+                    client_uuid=client_uuid,
+                    config_data=json.dumps(config_data),
+                    config_url=self._generate_vless_url(server, config_data),
+                    sni_domain=sni_domain,
+                    sni_dest=f"{sni_domain}:443"
+                )
+                
+                db.add(config)
+                await db.commit()
+                self.node_sync.add_client(server.server_id, config.config_id, client_uuid)
+                
+                logger.info(f"Создана конфигурация {config.config_id} для пользователя {user_id}")
+                
+                return {
+                    'config_id': config.config_id,
+                    'config_data': config_data,
+                    'config_url': config.config_url,
+                    'server_id': server.server_id,
+                    'sni_domain': sni_domain
+                }
+                
+            except Exception as e:
+                logger.error(f"Ошибка генерации конфигурации: {e}")
+                await db.rollback()
+                if reserved:
+                    self.placement.release(reserved.server_id)
+                raise
+    
+    async def generate_configs_bulk(
+        self,
+        user_ids: List[int],
+        server_id: Optional[int] = None,
+        expires_at: Optional[datetime] = None,
+        chunk_size: int = settings.CONFIG_BULK_CHUNK_SIZE
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Массовая генерация конфигураций с отчетом о прогрессе по чанкам
+        
+        Размещение и рендеринг URL выполняются в памяти, вставка в БД идет
+        одним executemany на чанк с отдельным commit.
+        """
+        total = len(user_ids)
+        created = 0
+        failed = 0
+        fixed_server = self.registry.get_by_id(server_id) if server_id else None
+        if server_id and not fixed_server:
+            yield {'status': 'error', 'error': f"Сервер {server_id} не найден"}
+            return
+        
+        for offset in range(0, total, chunk_size):
+            chunk = user_ids[offset:offset + chunk_size]
+            rows = []
+            items = []
+            reserved = []
             
-            return {
-                'config_id': config.config_id,
-                'config_data': config_data,
-                'config_url': config.config_url,
-                'server_id': server.server_id,
-                'sni_domain': sni_domain
-            }
+            # Размещение и рендеринг в памяти
+            for user_id in chunk:
+                server = fixed_server or self.placement.reserve(user_id)
+                if not server:
+                    break
+                if not fixed_server:
+                    reserved.append(server.server_id)
+                sni_domain = await self._get_best_sni_domain()
+                client_uuid = str(uuid.uuid4())
+                config_data = await self._create_vless_reality_config(server, sni_domain, client_uuid)
+                config_id = self._new_config_id()
+                config_url = self._generate_vless_url(server, config_data)
+                rows.append({
+                    'config_id': config_id,
+                    'user_id': user_id,
+                    'server_id': server.id,
+                    'client_uuid': client_uuid,
+                    'config_data': json.dumps(config_data),
+                    'config_url': config_url,
+                    'sni_domain': sni_domain,
+                    'sni_dest': f"{sni_domain}:443",
+                    'expires_at': expires_at
+                })
+                items.append({
+                    'user_id': user_id,
+                    'config_id': config_id,
+                    'server_id': server.server_id,
+                    'config_url': config_url
+                })
             
-        except Exception as e:
-            logger.error(f"Ошибка генерации конфигурации: {e}")
-            db.rollback()
-            raise
-        finally:
-            db.close()
+            try:
+                if len(rows) < len(chunk):
+                    raise Exception("Нет доступных серверов")
+                async with AsyncSessionLocal() as db:
+                    result = await db.execute(insert(Config).returning(Config.id), rows)
+                    ids = result.scalars().all()
+                    await db.commit()
+                for row, item in zip(rows, items):
+                    self.node_sync.add_client(item['server_id'], row['config_id'], row['client_uuid'])
+                for config_pk in ids:
+                    self.expiry.schedule(config_pk, expires_at)
+                created += len(rows)
+                yield {
+                    'status': 'progress',
+                    'created': created,
+                    'failed': failed,
+                    'total': total,
+                    'items': items
+                }
+            except Exception as e:
+                logger.error(f"Ошибка массовой генерации конфигураций (чанк {offset}): {e}")
+                for reserved_server_id in reserved:
+                    self.placement.release(reserved_server_id)
+                failed += len(chunk)
+                yield {
+                    'status': 'error',
+                    'created': created,
+                    'failed': failed,
+                    'total': total,
+                    'user_ids': chunk,
+                    'error': str(e)
+                }
+        
+        logger.info(f"Массовая генерация: создано {created} из {total} конфигураций")
+        yield {'status': 'done', 'created': created, 'failed': failed, 'total': total}
+    
+    @staticmethod
+    def _new_config_id() -> str:
+        """Идентификатор конфигурации (64 бита, без коллизий на больших пакетах)"""
+        return f"config-{uuid.uuid4().hex[:16]}"
     
     async def _get_best_sni_domain(self) -> str:
         """Выбор лучшего SNI домена"""
-        # Здесь можно добавить логику выбора домена
-        # на основе латентности и доступности
+        # Взвешенный выбор по живым пробам с ограничением доли домена
+        domain = sni_service.select_domain()
+        if domain:
+            return domain
         return self.sni_domains[0] if self.sni_domains else "vk.com"
     
-    async def _create_vless_reality_config(self, server: Server, sni_domain: str) -> Dict[str, Any]:
+    async def _create_vless_reality_config(
+        self,
+        server: ServerRecord,
+        sni_domain: str,
+        client_uuid: Optional[str] = None
+    ) -> Dict[str, Any]:
         """Создание VLESS + Reality конфигурации"""
         config = {
             "v": "2",
             "ps": f"Xray-{server.name}",
             "add": server.host,
             "port": str(server.port),
-            "id": server.uuid,
+            "id": client_uuid or server.uuid,
             "aid": "0",
             "scy": "auto",
             "net": "tcp",
@@ -404,16 +634,20 @@ class XrayService:
         }
         return config
     
-    def _generate_vless_url(self, config_data: Dict[str, Any]) -> str:
-        """Генерация VLESS URL"""
-        import base64
-        
-        # Создание строки конфигурации
-        config_str = f"vless://{config_data['id']}@{config_data['add']}:{config_data['port']}"
-        config_str += f"?encryption=none&security={config_data['security']}"
-        config_str += f"&type={config_data['net']}&host={config_data['host']}"
-        config_str += f"&sni={config_data['sni']}&pbk={config_data['pbk']}"
-        config_str += f"&sid={config_data['sid']}&fp={config_data['fp']}"
-        config_str += f"#{config_data['ps']}"
-        
-        return config_str
+    def _generate_vless_url(self, server: ServerRecord, config_data: Dict[str, Any]) -> str:
+        """Генерация VLESS URL по предкомпилированному шаблону сервера"""
+        return render_vless_url(
+            server.server_id,
+            host=config_data['add'],
+            port=config_data['port'],
+            public_key=config_data['pbk'],
+            sni=config_data['sni'],
+            client_id=config_data['id'],
+            remark=config_data['ps'],
+            short_id=config_data['sid'],
+            fingerprint=config_data['fp']
+        )
+
+
+# Общий экземпляр сервиса для приложения и роутеров
+xray_service = XrayService()
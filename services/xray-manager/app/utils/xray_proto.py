@@ -0,0 +1,205 @@
+"""
+Минимальный кодек protobuf для Xray StatsService и HandlerService.
+
+Сгенерированные stubs не нужны: используется всего несколько сообщений,
+поэтому они кодируются вручную по wire format protobuf.
+
+    message QueryStatsRequest { string pattern = 1; bool reset = 2; }
+    message Stat { string name = 1; int64 value = 2; }
+    message QueryStatsResponse { repeated Stat stat = 1; }
+
+    message TypedMessage { string type = 1; bytes value = 2; }
+    message AlterInboundRequest { string tag = 1; TypedMessage operation = 2; }
+    message AddUserOperation { User user = 1; }
+    message RemoveUserOperation { string email = 1; }
+    message User { uint32 level = 1; string email = 2; TypedMessage account = 3; }
+    message vless.Account { string id = 1; string flow = 2; string encryption = 3; }
+"""
+
+from typing import Iterator, List, Optional, Tuple
+
+# Полные имена методов gRPC
+QUERY_STATS_METHOD = "/xray.app.stats.command.StatsService/QueryStats"
+ALTER_INBOUND_METHOD = "/xray.app.proxyman.command.HandlerService/AlterInbound"
+
+# Имена типов TypedMessage
+ADD_USER_TYPE = "xray.app.proxyman.command.AddUserOperation"
+REMOVE_USER_TYPE = "xray.app.proxyman.command.RemoveUserOperation"
+VLESS_ACCOUNT_TYPE = "xray.proxy.vless.Account"
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_BYTES = 2
+WIRE_FIXED32 = 5
+
+
+def _encode_varint(value: int) -> bytes:
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _decode_varint(data: bytes, position: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise ValueError("Обрезанный varint")
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+        if shift >= 64:
+            raise ValueError("Слишком длинный varint")
+
+
+def _fields(data: bytes) -> Iterator[Tuple[int, int, object]]:
+    """Поля сообщения: (номер, тип, значение); bytes для length-delimited"""
+    position = 0
+    while position < len(data):
+        key, position = _decode_varint(data, position)
+        number, wire_type = key >> 3, key & 0x07
+        if wire_type == WIRE_VARINT:
+            value, position = _decode_varint(data, position)
+        elif wire_type == WIRE_BYTES:
+            length, position = _decode_varint(data, position)
+            value = data[position:position + length]
+            if len(value) != length:
+                raise ValueError("Обрезанное поле")
+            position += length
+        elif wire_type == WIRE_FIXED64:
+            value = int.from_bytes(data[position:position + 8], "little")
+            position += 8
+        elif wire_type == WIRE_FIXED32:
+            value = int.from_bytes(data[position:position + 4], "little")
+            position += 4
+        else:
+            raise ValueError(f"Неподдерживаемый wire type {wire_type}")
+        yield number, wire_type, value
+
+
+def _encode_bytes(number: int, value: bytes) -> bytes:
+    return _encode_varint(number << 3 | WIRE_BYTES) + _encode_varint(len(value)) + value
+
+
+def encode_query_stats_request(pattern: str = "", reset: bool = False) -> bytes:
+    out = b""
+    if pattern:
+        out += _encode_bytes(1, pattern.encode())
+    if reset:
+        out += _encode_varint(2 << 3 | WIRE_VARINT) + _encode_varint(1)
+    return out
+
+
+def decode_query_stats_request(data: bytes) -> Tuple[str, bool]:
+    pattern, reset = "", False
+    for number, wire_type, value in _fields(data):
+        if number == 1 and wire_type == WIRE_BYTES:
+            pattern = value.decode()
+        elif number == 2 and wire_type == WIRE_VARINT:
+            reset = bool(value)
+    return pattern, reset
+
+
+def encode_query_stats_response(stats: List[Tuple[str, int]]) -> bytes:
+    out = bytearray()
+    for name, value in stats:
+        stat = _encode_bytes(1, name.encode())
+        if value:
+            stat += _encode_varint(2 << 3 | WIRE_VARINT) + _encode_varint(value)
+        out += _encode_bytes(1, stat)
+    return bytes(out)
+
+
+def decode_query_stats_response(data: bytes) -> List[Tuple[str, int]]:
+    """Список (имя счетчика, значение)"""
+    stats = []
+    for number, wire_type, value in _fields(data):
+        if number != 1 or wire_type != WIRE_BYTES:
+            continue
+        name, counter = "", 0
+        for field, field_type, field_value in _fields(value):
+            if field == 1 and field_type == WIRE_BYTES:
+                name = field_value.decode()
+            elif field == 2 and field_type == WIRE_VARINT:
+                # int64: отрицательные значения приходят в дополнительном коде
+                counter = field_value - (1 << 64) if field_value >= 1 << 63 else field_value
+        stats.append((name, counter))
+    return stats
+
+
+def _encode_string(number: int, value: str) -> bytes:
+    return _encode_bytes(number, value.encode()) if value else b""
+
+
+def _encode_typed_message(number: int, type_name: str, value: bytes) -> bytes:
+    return _encode_bytes(number, _encode_string(1, type_name) + (_encode_bytes(2, value) if value else b""))
+
+
+def _decode_typed_message(data: bytes) -> Tuple[str, bytes]:
+    type_name, value = "", b""
+    for number, wire_type, field_value in _fields(data):
+        if number == 1 and wire_type == WIRE_BYTES:
+            type_name = field_value.decode()
+        elif number == 2 and wire_type == WIRE_BYTES:
+            value = field_value
+    return type_name, value
+
+
+def encode_add_user_request(tag: str, email: str, client_id: str, flow: str = "", level: int = 0) -> bytes:
+    """AlterInboundRequest с AddUserOperation для VLESS клиента"""
+    account = _encode_string(1, client_id) + _encode_string(2, flow) + _encode_string(3, "none")
+    user = b""
+    if level:
+        user += _encode_varint(1 << 3 | WIRE_VARINT) + _encode_varint(level)
+    user += _encode_string(2, email) + _encode_typed_message(3, VLESS_ACCOUNT_TYPE, account)
+    return _encode_string(1, tag) + _encode_typed_message(2, ADD_USER_TYPE, _encode_bytes(1, user))
+
+
+def encode_remove_user_request(tag: str, email: str) -> bytes:
+    """AlterInboundRequest с RemoveUserOperation"""
+    return _encode_string(1, tag) + _encode_typed_message(2, REMOVE_USER_TYPE, _encode_string(1, email))
+
+
+def decode_alter_inbound_request(data: bytes) -> Tuple[str, str, str, Optional[str]]:
+    """(тег, add|remove, email, id клиента или None)"""
+    tag, operation = "", (REMOVE_USER_TYPE, b"")
+    for number, wire_type, value in _fields(data):
+        if number == 1 and wire_type == WIRE_BYTES:
+            tag = value.decode()
+        elif number == 2 and wire_type == WIRE_BYTES:
+            operation = _decode_typed_message(value)
+
+    type_name, payload = operation
+    if type_name == REMOVE_USER_TYPE:
+        email = ""
+        for number, wire_type, value in _fields(payload):
+            if number == 1 and wire_type == WIRE_BYTES:
+                email = value.decode()
+        return tag, "remove", email, None
+    if type_name != ADD_USER_TYPE:
+        raise ValueError(f"Неподдерживаемая операция {type_name}")
+
+    email, client_id = "", None
+    for number, wire_type, value in _fields(payload):
+        if number != 1 or wire_type != WIRE_BYTES:
+            continue
+        for field, field_type, field_value in _fields(value):
+            if field == 2 and field_type == WIRE_BYTES:
+                email = field_value.decode()
+            elif field == 3 and field_type == WIRE_BYTES:
+                _, account = _decode_typed_message(field_value)
+                for account_field, account_type, account_value in _fields(account):
+                    if account_field == 1 and account_type == WIRE_BYTES:
+                        client_id = account_value.decode()
+    return tag, "add", email, client_id
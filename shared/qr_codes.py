@@ -0,0 +1,138 @@
+"""
+Кэш отрендеренных QR кодов для ссылок конфигураций.
+
+Ключ - хэш содержимого ссылки и формата, поэтому одна и та же ссылка
+рендерится один раз на процесс. Объем кэша ограничен в байтах, при
+переполнении вытесняются давно не использованные записи. Для каждой
+картинки хранится сильный ETag (хэш байтов), по которому повторные
+запросы отвечают 304 без передачи тела.
+"""
+
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import qrcode
+import qrcode.image.svg
+
+# Параметры рендеринга, общие для всех форматов
+BOX_SIZE = 10
+BORDER = 5
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+MEDIA_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml"
+}
+
+
+class QRImage:
+    """Отрендеренный QR код"""
+
+    __slots__ = ("body", "media_type", "etag")
+
+    def __init__(self, body: bytes, media_type: str):
+        self.body = body
+        self.media_type = media_type
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        """Совпадает ли заголовок If-None-Match с ETag картинки"""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        # If-None-Match сравнивается слабо (RFC 9110), префикс W/ игнорируется
+        return any(
+            tag.strip().removeprefix("W/") == self.etag
+            for tag in if_none_match.split(",")
+        )
+
+
+def render_qr(data: str, fmt: str = "png") -> QRImage:
+    """Рендеринг QR кода в PNG или SVG"""
+    if fmt not in MEDIA_TYPES:
+        raise ValueError(f"Неизвестный формат QR кода: {fmt}")
+
+    qr = qrcode.QRCode(box_size=BOX_SIZE, border=BORDER)
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    buffer = io.BytesIO()
+    if fmt == "svg":
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+    else:
+        qr.make_image(fill_color="black", back_color="white").save(buffer, format="PNG")
+    return QRImage(buffer.getvalue(), MEDIA_TYPES[fmt])
+
+
+class QRCodeCache:
+    """LRU кэш QR кодов с ограничением по суммарному размеру"""
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._images: "OrderedDict[Tuple[str, str], QRImage]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(data: str, fmt: str) -> Tuple[str, str]:
+        return hashlib.sha256(data.encode()).hexdigest(), fmt
+
+    def lookup(self, data: str, fmt: str = "png") -> Optional[QRImage]:
+        """QR код только из кэша, без рендеринга"""
+        key = self.key(data, fmt)
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+            return image
+
+    def get(self, data: str, fmt: str = "png") -> QRImage:
+        """QR код из кэша или свежий рендеринг"""
+        image = self.lookup(data, fmt)
+        if image is not None:
+            return image
+
+        # Рендеринг вне блокировки: гонка дает лишь повторную работу
+        image = render_qr(data, fmt)
+        self._store(self.key(data, fmt), image)
+        return image
+
+    def warm(self, data: str, formats: Tuple[str, ...] = ("png", "svg")):
+        """Предварительный рендеринг при выдаче новой ссылки"""
+        for fmt in formats:
+            self.get(data, fmt)
+
+    def _store(self, key: Tuple[str, str], image: QRImage):
+        size = len(image.body)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self.misses += 1
+            previous = self._images.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.body)
+            self._images[key] = image
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.size -= len(evicted.body)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._images),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+# Общий кэш процесса
+qr_cache = QRCodeCache()
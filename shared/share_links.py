@@ -0,0 +1,147 @@
+"""
+Рендеринг VLESS + Reality ссылок для всех сервисов.
+
+Для каждого набора (сервер, SNI, fingerprint) один раз собирается шаблон
+с уже закодированной query-строкой; при выдаче ссылки подставляются
+только UUID клиента и название профиля. Шаблоны хранятся в LRU кэше,
+ключ включает адрес и Reality ключи сервера, поэтому ротация ключей
+сама по себе приводит к промаху кэша, а invalidate() освобождает память.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+from urllib.parse import quote
+
+# Параметры по умолчанию для VLESS + Reality поверх TCP
+DEFAULT_FINGERPRINT = "chrome"
+DEFAULT_CACHE_SIZE = 1024
+
+# Значения из этих символов не требуют процентного кодирования
+_is_safe = re.compile(r"[A-Za-z0-9._~-]*\Z").match
+
+
+def _quote(value: str) -> str:
+    """quote() с быстрым путем для UUID и ASCII названий"""
+    return value if _is_safe(value) else quote(value, safe="-_.~")
+
+
+class ShareLinkTemplate:
+    """Предкомпилированный шаблон vless:// ссылки одного сервера"""
+
+    __slots__ = ("suffix",)
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        public_key: str,
+        sni: str,
+        short_id: str = "",
+        fingerprint: str = DEFAULT_FINGERPRINT,
+        flow: str = "",
+        network: str = "tcp",
+        header_type: str = "none"
+    ):
+        if ":" in host and not host.startswith("["):
+            host = f"[{host}]"
+        params = [
+            ("encryption", "none"),
+            ("security", "reality"),
+            ("type", network),
+            ("headerType", header_type),
+            ("sni", sni),
+            ("fp", fingerprint),
+            ("pbk", public_key),
+            ("sid", short_id),
+            ("flow", flow)
+        ]
+        query = "&".join(
+            f"{name}={quote(str(value), safe='')}"
+            for name, value in params
+            if value
+        )
+        self.suffix = f"@{host}:{port}?{query}#"
+
+    def render(self, client_id: str, remark: str) -> str:
+        """Подстановка UUID клиента и названия профиля"""
+        return "vless://" + _quote(client_id) + self.suffix + _quote(remark)
+
+
+class ShareLinkRenderer:
+    """LRU кэш шаблонов ссылок с инвалидацией по серверу"""
+
+    def __init__(self, maxsize: int = DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._templates: "OrderedDict[Tuple, ShareLinkTemplate]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def template(
+        self,
+        server_key: Hashable,
+        host: str,
+        port: int,
+        public_key: str,
+        sni: str,
+        short_id: str = "",
+        fingerprint: str = DEFAULT_FINGERPRINT,
+        flow: str = ""
+    ) -> ShareLinkTemplate:
+        """Шаблон для (сервер, SNI, fingerprint) из кэша или новый"""
+        key = (server_key, host, port, public_key, short_id, sni, fingerprint, flow)
+        # Горячий путь без блокировки: операции OrderedDict атомарны под GIL
+        template = self._templates.get(key)
+        if template is not None:
+            try:
+                self._templates.move_to_end(key)
+            except KeyError:
+                pass
+            self.hits += 1
+            return template
+
+        template = ShareLinkTemplate(host, port, public_key, sni, short_id, fingerprint, flow)
+        with self._lock:
+            self.misses += 1
+            self._templates[key] = template
+            self._templates.move_to_end(key)
+            if len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return template
+
+    def render(
+        self,
+        server_key: Hashable,
+        host: str,
+        port: int,
+        public_key: str,
+        sni: str,
+        client_id: str,
+        remark: str,
+        short_id: str = "",
+        fingerprint: str = DEFAULT_FINGERPRINT,
+        flow: str = ""
+    ) -> str:
+        """Готовая vless:// ссылка для клиента"""
+        template = self.template(server_key, host, port, public_key, sni, short_id, fingerprint, flow)
+        return template.render(client_id, remark)
+
+    def invalidate(self, server_key: Optional[Hashable] = None):
+        """Удаление шаблонов сервера (или всех) после смены ключей"""
+        with self._lock:
+            if server_key is None:
+                self._templates.clear()
+                return
+            for key in [key for key in self._templates if key[0] == server_key]:
+                del self._templates[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._templates), "hits": self.hits, "misses": self.misses}
+
+
+# Общий рендерер процесса
+renderer = ShareLinkRenderer()
+render_vless_url = renderer.render
+invalidate_server = renderer.invalidate
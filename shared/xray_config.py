@@ -0,0 +1,145 @@
+"""
+Генерация config.json узла Xray (VLESS + Reality).
+
+Используется скриптом generate-reality-keys.py и синхронизацией узлов
+xray-manager как полная перезапись файла: клиенты инбаунда перечисляются
+целиком, а при заданном api_port включаются HandlerService/StatsService,
+через которые xray-manager меняет список клиентов без перезапуска.
+"""
+
+import uuid
+from typing import Any, Dict, Iterable, List, Optional
+
+# Тег VLESS инбаунда, к которому обращается AlterInbound
+DEFAULT_INBOUND_TAG = "vless-in"
+DEFAULT_SNI_DOMAINS = ["www.vk.com", "vk.com"]
+
+PRIVATE_NETWORKS = [
+    "0.0.0.0/8",
+    "10.0.0.0/8",
+    "100.64.0.0/10",
+    "127.0.0.0/8",
+    "169.254.0.0/16",
+    "172.16.0.0/12",
+    "192.0.0.0/24",
+    "192.0.2.0/24",
+    "192.168.0.0/16",
+    "198.18.0.0/15",
+    "198.51.100.0/24",
+    "203.0.113.0/24",
+    "::1/128",
+    "fc00::/7",
+    "fe80::/10"
+]
+
+
+def vless_client(client_id: str, email: str = "", flow: str = "", level: int = 0) -> Dict[str, Any]:
+    """Запись клиента VLESS инбаунда"""
+    client = {"id": client_id, "level": level}
+    if email:
+        client["email"] = email
+    if flow:
+        client["flow"] = flow
+    return client
+
+
+def generate_server_config(
+    server_id: str,
+    host: str,
+    port: int,
+    keys: Dict[str, str],
+    clients: Optional[Iterable[Dict[str, Any]]] = None,
+    sni_domains: Optional[List[str]] = None,
+    inbound_tag: str = DEFAULT_INBOUND_TAG,
+    api_port: Optional[int] = None
+) -> Dict[str, Any]:
+    """Генерация конфигурации сервера
+
+    clients - записи vless_client(); без них создается один случайный
+    клиент, как раньше.
+    """
+    if clients is None:
+        clients = [vless_client(str(uuid.uuid4()))]
+    server_names = list(sni_domains or DEFAULT_SNI_DOMAINS)
+
+    config = {
+        "log": {
+            "loglevel": "info",
+            "access": "/var/log/xray/access.log",
+            "error": "/var/log/xray/error.log"
+        },
+        "inbounds": [
+            {
+                "tag": inbound_tag,
+                "port": port,
+                "protocol": "vless",
+                "settings": {
+                    "clients": list(clients),
+                    "decryption": "none"
+                },
+                "streamSettings": {
+                    "network": "tcp",
+                    "security": "reality",
+                    "realitySettings": {
+                        "show": False,
+                        "dest": f"{server_names[0]}:443",
+                        "xver": 0,
+                        "serverNames": server_names,
+                        "privateKey": keys['private_key'],
+                        "shortIds": [
+                            keys['short_id']
+                        ]
+                    }
+                }
+            }
+        ],
+        "outbounds": [
+            {
+                "protocol": "freedom",
+                "settings": {}
+            },
+            {
+                "protocol": "blackhole",
+                "settings": {},
+                "tag": "blocked"
+            }
+        ],
+        "routing": {
+            "rules": [
+                {
+                    "type": "field",
+                    "ip": PRIVATE_NETWORKS,
+                    "outboundTag": "blocked"
+                },
+                {
+                    "type": "field",
+                    "outboundTag": "blocked",
+                    "protocol": [
+                        "bittorrent"
+                    ]
+                }
+            ]
+        }
+    }
+
+    if api_port:
+        # gRPC API для xray-manager: список клиентов и счетчики трафика
+        config["api"] = {"tag": "api", "services": ["HandlerService", "StatsService"]}
+        config["stats"] = {}
+        config["policy"] = {
+            "levels": {"0": {"statsUserUplink": True, "statsUserDownlink": True}}
+        }
+        config["inbounds"].append({
+            "tag": "api",
+            "listen": "0.0.0.0",
+            "port": api_port,
+            "protocol": "dokodemo-door",
+            "settings": {"address": "127.0.0.1"}
+        })
+        config["routing"]["rules"].insert(0, {
+            "type": "field",
+            "inboundTag": ["api"],
+            "outboundTag": "api"
+        })
+
+    return config